@@ -352,6 +352,30 @@ if __name__ == '__main__':
     except Exception as e:
         logger.warning(f"Error scanning profiles directory: {str(e)}")
     
+    # llama-serverを事前に起動してモデルをロードしておく（最初のチャットの待ち時間を短縮）
+    try:
+        if config.LLAMA_SERVER_AUTOSTART and config.SELECTED_MODEL_PATH:
+            from services.llama_server import start_llama_server_async, is_llama_server_available
+            if is_llama_server_available():
+                logger.info("Warming up llama-server in background")
+                start_llama_server_async()
+    except Exception as e:
+        logger.warning(f"Failed to warm up llama-server: {str(e)}")
+    
+    # 弱くなったメモリの定期整理を開始
+    try:
+        from services.memory_consolidation import start_memory_consolidation
+        start_memory_consolidation()
+    except Exception as e:
+        logger.warning(f"Failed to start memory consolidation: {str(e)}")
+
+    # 前回の終了時に残っていたインポートジョブを再開
+    try:
+        from services.import_jobs import IMPORT_JOBS
+        IMPORT_JOBS.start()
+    except Exception as e:
+        logger.warning(f"Failed to start import job workers: {str(e)}")
+
     # フロントエンドへのメッセージ
     logger.info("====================================================")
     logger.info("Server is ready! Use http://localhost:3000/debug to test the connection.")
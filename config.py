@@ -37,6 +37,15 @@ LLAMA_SERVER_PORT = int(os.getenv('LLAMA_SERVER_PORT', 8080))
 LLAMA_SERVER_URL = f"http://{LLAMA_SERVER_HOST}:{LLAMA_SERVER_PORT}/completion"
 LLAMA_SERVER_HEALTH_URL = f"http://{LLAMA_SERVER_HOST}:{LLAMA_SERVER_PORT}/health"
 
+# llama-serverとのHTTP通信設定（接続プール・タイムアウト・リトライ）
+LLAMA_SERVER_POOL_SIZE = int(os.getenv('LLAMA_SERVER_POOL_SIZE', 16))
+LLAMA_SERVER_CONNECT_TIMEOUT = float(os.getenv('LLAMA_SERVER_CONNECT_TIMEOUT', 3))
+LLAMA_SERVER_READ_TIMEOUT = float(os.getenv('LLAMA_SERVER_READ_TIMEOUT', 30))
+LLAMA_SERVER_MAX_RETRIES = int(os.getenv('LLAMA_SERVER_MAX_RETRIES', 2))
+LLAMA_SERVER_RETRY_BACKOFF = float(os.getenv('LLAMA_SERVER_RETRY_BACKOFF', 0.2))
+# llama-serverの状態をバックグラウンドで確認する間隔（秒）
+LLAMA_HEALTH_INTERVAL = float(os.getenv('LLAMA_HEALTH_INTERVAL', 5))
+
 # パス設定
 MODELS_DIR = os.getenv('MODELS_DIR', os.path.join(os.getcwd(), 'models'))
 PROFILES_DIR = os.getenv('PROFILES_DIR', os.path.join(os.getcwd(), 'profiles'))
@@ -89,8 +98,137 @@ if IS_WINDOWS:
 else:
     LLAMACPP_MAIN = os.path.join(LLAMACPP_PATH, 'main')
 
+# 常駐させるllama-serverの実行ファイル（全プラットフォーム共通）
+# モデルを一度だけロードし、チャットごとの再ロードを避ける
+LLAMACPP_SERVER = os.getenv(
+    'LLAMACPP_SERVER',
+    os.path.join(LLAMACPP_PATH, 'llama-server.exe' if IS_WINDOWS else 'llama-server')
+)
+
+# llama-serverの起動パラメータ
+LLAMA_CONTEXT_SIZE = int(os.getenv('LLAMA_CONTEXT_SIZE', 2048))
+LLAMA_GPU_LAYERS = int(os.getenv('LLAMA_GPU_LAYERS', 1))
+LLAMA_SERVER_STARTUP_TIMEOUT = int(os.getenv('LLAMA_SERVER_STARTUP_TIMEOUT', 60))
+# バックエンド起動時にllama-serverを起動してモデルをロードしておくか
+LLAMA_SERVER_AUTOSTART = os.getenv('LLAMA_SERVER_AUTOSTART', 'true').strip().lower() in ('1', 'true', 'yes')
+
+# llama-serverの同時処理数（--parallel）とリクエストキューの設定
+LLAMA_SERVER_PARALLEL = int(os.getenv('LLAMA_SERVER_PARALLEL', 1))
+LLAMA_QUEUE_MAX = int(os.getenv('LLAMA_QUEUE_MAX', 16))
+LLAMA_QUEUE_TIMEOUT = float(os.getenv('LLAMA_QUEUE_TIMEOUT', 60))
+
+# 複数のllama-serverを起動する場合の設定
+# インスタンスiはLLAMA_SERVER_PORT + iのポートで起動する
+LLAMA_SERVER_INSTANCES = int(os.getenv('LLAMA_SERVER_INSTANCES', 1))
+# インスタンスごとのスレッド数（0の場合、複数インスタンス時はCPU数を均等に分割）
+LLAMA_SERVER_THREADS = int(os.getenv('LLAMA_SERVER_THREADS', 0))
+# CPUアフィニティ（空: 設定しない / auto: CPUを均等に分割 / 例 "0-7;8-15": インスタンスごとに指定）
+LLAMA_SERVER_CPU_AFFINITY = os.getenv('LLAMA_SERVER_CPU_AFFINITY', '').strip()
+
+# LLMの応答キャッシュ（同じ質問に対する生成を省略する）
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').strip().lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# 空の場合はメモリ上のみ（指定するとSQLiteファイルに保存して再起動後も使う）
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', '').strip()
+# temperatureが0でない（毎回結果が変わりうる）リクエストもキャッシュするか
+RESPONSE_CACHE_SAMPLED = os.getenv('RESPONSE_CACHE_SAMPLED', 'false').strip().lower() in ('1', 'true', 'yes')
+
+# トークン数キャッシュに保持する文字列の数
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 4096))
+
+# メモリの埋め込みベクトル（意味検索）の設定
+# 外部で起動済みの埋め込み用サーバー（例: http://127.0.0.1:8090）
+EMBEDDING_SERVER_URL = os.getenv('EMBEDDING_SERVER_URL', '').strip()
+# 埋め込みモデルのパス（指定すると埋め込み専用のllama-serverを--embeddings付きで起動する）
+EMBEDDING_MODEL_PATH = os.getenv('EMBEDDING_MODEL_PATH', '').strip()
+EMBEDDING_SERVER_PORT = int(os.getenv('EMBEDDING_SERVER_PORT', LLAMA_SERVER_PORT + 10))
+# チャット用のllama-serverも--embeddings付きで起動して/embeddingを使うか
+# （llama.cppのバージョンによっては--embeddingsを付けると補完が使えなくなる）
+LLAMA_SERVER_EMBEDDINGS = os.getenv('LLAMA_SERVER_EMBEDDINGS', 'false').strip().lower() in ('1', 'true', 'yes')
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 32))
+# 埋め込みを計算する本文の最大文字数
+EMBEDDING_MAX_CHARS = int(os.getenv('EMBEDDING_MAX_CHARS', 2000))
+# メモリ数がこの値以上になると近似検索（IVF）を使う（0で無効）
+VECTOR_IVF_THRESHOLD = int(os.getenv('VECTOR_IVF_THRESHOLD', 50000))
+# 近似検索で調べるクラスタ数
+VECTOR_IVF_NPROBE = int(os.getenv('VECTOR_IVF_NPROBE', 8))
+
+# メモリの強度の設定
+# 強度が半分になる日数（0で減衰しない）
+MEMORY_STRENGTH_HALF_LIFE = float(os.getenv('MEMORY_STRENGTH_HALF_LIFE', 30))
+# チャットや検索で思い出したときに、上限までの残りのうち強くなる割合
+MEMORY_REINFORCE_BOOST = float(os.getenv('MEMORY_REINFORCE_BOOST', 0.2))
+# 強度がこの値を下回ったメモリを整理する
+MEMORY_PRUNE_THRESHOLD = float(os.getenv('MEMORY_PRUNE_THRESHOLD', 0.05))
+# 整理の方法（archive: アーカイブに移す / delete: 削除する）
+MEMORY_PRUNE_MODE = os.getenv('MEMORY_PRUNE_MODE', 'archive').strip().lower()
+# 整理を実行する間隔（秒、0で実行しない）
+MEMORY_CONSOLIDATION_INTERVAL = float(os.getenv('MEMORY_CONSOLIDATION_INTERVAL', 3600))
+
+# メモリの重複検出の設定
+# ほぼ同じ内容とみなす類似度（文字のshingleのJaccard係数）
+MEMORY_DEDUP_THRESHOLD = float(os.getenv('MEMORY_DEDUP_THRESHOLD', 0.8))
+MEMORY_DEDUP_SHINGLE_SIZE = int(os.getenv('MEMORY_DEDUP_SHINGLE_SIZE', 4))
+# 比較に使う本文の最大文字数
+MEMORY_DEDUP_MAX_CHARS = int(os.getenv('MEMORY_DEDUP_MAX_CHARS', 4000))
+# 重複したときの扱い（keep: 検出しない / flag: 作成して重複を報告 / skip: 作成しない / merge: 既存のメモリに統合）
+MEMORY_DEDUP_ON_CREATE = os.getenv('MEMORY_DEDUP_ON_CREATE', 'flag').strip().lower()
+MEMORY_DEDUP_ON_IMPORT = os.getenv('MEMORY_DEDUP_ON_IMPORT', 'merge').strip().lower()
+
+# テキストファイルのインポートで、文書を分割するパッセージの設定
+# 1パッセージの最大文字数と、前のパッセージと重ねる文字数
+MEMORY_CHUNK_MAX_CHARS = int(os.getenv('MEMORY_CHUNK_MAX_CHARS', 800))
+MEMORY_CHUNK_OVERLAP = int(os.getenv('MEMORY_CHUNK_OVERLAP', 100))
+# ファイルを読み込む単位（文字数）と、まとめて保存するパッセージの数
+MEMORY_CHUNK_READ_SIZE = int(os.getenv('MEMORY_CHUNK_READ_SIZE', 64 * 1024))
+MEMORY_IMPORT_BATCH_SIZE = int(os.getenv('MEMORY_IMPORT_BATCH_SIZE', 500))
+
+# チャットで関連するメモリをプロンプトに含める設定
+MEMORY_RAG_ENABLED = os.getenv('MEMORY_RAG_ENABLED', 'true').strip().lower() in ('1', 'true', 'yes')
+MEMORY_RAG_TOP_K = int(os.getenv('MEMORY_RAG_TOP_K', 5))
+# プロンプトに含めるメモリの合計トークン数の上限
+MEMORY_RAG_MAX_TOKENS = int(os.getenv('MEMORY_RAG_MAX_TOKENS', 256))
+# 意味検索で関連ありとみなす類似度の下限
+MEMORY_RAG_MIN_SIMILARITY = float(os.getenv('MEMORY_RAG_MIN_SIMILARITY', 0.3))
+# 新しさの重みが半分になる日数
+MEMORY_RAG_RECENCY_HALF_LIFE = float(os.getenv('MEMORY_RAG_RECENCY_HALF_LIFE', 30))
+
+# 会話履歴の設定
+# 1回の応答で生成する最大トークン数（コンテキストのうちこの分は応答用に空けておく）
+CHAT_MAX_TOKENS = int(os.getenv('CHAT_MAX_TOKENS', 1024))
+# 古い会話の要約に使うトークン数の上限
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv('CHAT_SUMMARY_MAX_TOKENS', 256))
+
 # ファイル許可設定
-ALLOWED_EXTENSIONS = {'pdf', 'txt', 'doc', 'docx', 'csv', 'json', 'md', 'py', 'js', 'ts', 'html', 'css'}
+ALLOWED_EXTENSIONS = {'pdf', 'txt', 'doc', 'docx', 'csv', 'json', 'md', 'py', 'js', 'ts', 'html', 'htm', 'css'}
+
+# 分割アップロードの設定
+# アップロード中のファイルを置くディレクトリ
+UPLOAD_PARTIAL_DIR = os.getenv('UPLOAD_PARTIAL_DIR', os.path.join(UPLOAD_FOLDER, '.partial'))
+# クライアントに推奨する1回の送信サイズ（リクエストの上限の16MBより小さくする）
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+# 更新が無いままこの秒数が過ぎたアップロードは破棄する
+UPLOAD_SESSION_TTL = int(os.getenv('UPLOAD_SESSION_TTL', 24 * 3600))
+# アップロードされたファイルを内容のハッシュごとに1つだけ保存するディレクトリ
+# （分割アップロードのファイルを名前の変更だけで移せるよう、UPLOAD_PARTIAL_DIRと同じドライブに置く）
+BLOB_STORE_DIR = os.getenv('BLOB_STORE_DIR', os.path.join(UPLOAD_FOLDER, 'blobs'))
+
+# PDF・DOCX・HTML・CSVからテキストを取り出す設定
+# 抽出に使うワーカープロセスの数
+DOCUMENT_EXTRACT_WORKERS = int(os.getenv('DOCUMENT_EXTRACT_WORKERS', max(1, min(4, (os.cpu_count() or 2) - 1))))
+# 取り出したテキストを、元のファイルのハッシュごとに保存しておくディレクトリ
+DOCUMENT_TEXT_CACHE_DIR = os.getenv('DOCUMENT_TEXT_CACHE_DIR', os.path.join(UPLOAD_FOLDER, 'text-cache'))
+# 取り出したテキストのキャッシュの合計サイズの上限（バイト、超えた分は古く使われたものから削除する。0で無制限）
+DOCUMENT_TEXT_CACHE_MAX_BYTES = int(os.getenv('DOCUMENT_TEXT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+# インポートジョブの設定
+# ジョブの待ち行列を保存するデータベース
+IMPORT_JOBS_DB = os.getenv('IMPORT_JOBS_DB', os.path.join(os.getcwd(), 'run', 'import_jobs.db'))
+# 同時に実行するジョブの数
+IMPORT_JOB_WORKERS = int(os.getenv('IMPORT_JOB_WORKERS', 2))
+# 終了したジョブの記録を残す秒数
+IMPORT_JOB_RETENTION = int(os.getenv('IMPORT_JOB_RETENTION', 7 * 24 * 3600))
 
 # llama-server.exeプロセス（グローバル変数）
 LLAMA_SERVER_PROCESS = None
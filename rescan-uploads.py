@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - アップロード記録の修復ツール
+アップロード記録（uploads.db）をアップロードディレクトリとブロブストアの内容から作り直すトラブルシューティングツール
+--gcを指定した場合は、続けて参照数が0になったブロブストアのファイルを削除する
+バックエンドサーバーを停止してから実行してください
+"""
+
+import sys
+import argparse
+from services.upload_manifest import iter_upload_dirs, count_blob_references, rescan_upload_dirs
+from services.blob_store import BLOB_STORE
+
+
+def rescan_uploads(collect_garbage=False):
+    """すべてのアップロードディレクトリの記録を作り直す"""
+    print("Second Me Windows アップロード記録の修復ツール")
+    print("="*50)
+
+    results = rescan_upload_dirs(list(iter_upload_dirs()))
+    if not results:
+        print("アップロードディレクトリが見つかりません")
+    for upload_dir, stats in results.items():
+        print(f"{upload_dir}: 記録を削除 {stats['removed']}件 / 追加 {stats['added']}件 / "
+              f"ブロブから復元 {stats['recovered']}件 / サイズを修正 {stats['updated']}件 / 変更なし {stats['kept']}件")
+
+    if collect_garbage:
+        stats = BLOB_STORE.collect_garbage(count_blob_references())
+        print(f"ブロブストア: 参照数を修正 {stats['corrected']}件 / 削除 {stats['removed']}件"
+              f"（{stats['freed_bytes']}バイト） / 記録が見つからず残したブロブ {stats['unaccounted']}件")
+
+    print("\nアップロード記録の修復が完了しました。")
+    print("="*50)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='アップロード記録をディレクトリの内容から作り直します')
+    parser.add_argument('--gc', action='store_true', help='参照数が0になったブロブストアのファイルを削除する')
+    args = parser.parse_args()
+    try:
+        rescan_uploads(collect_garbage=args.gc)
+    except Exception as e:
+        print(f"エラーが発生しました: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
@@ -7,11 +7,96 @@ LLMとのチャットを管理するエンドポイント
 """
 
 from datetime import datetime
-from flask import jsonify, request, Flask
-from config import logger, PROFILES_DIR, SELECTED_MODEL_PATH, ACTIVE_PROFILE, IS_WINDOWS, LLAMACPP_MAIN
+from flask import jsonify, request, Flask, Response
+import config as app_config
+from config import logger, SELECTED_MODEL_PATH, LLAMACPP_MAIN, CHAT_MAX_TOKENS
 import os
+import json
 import subprocess
-from services.llama_server import generate_llm_response
+from services.llama_server import (
+    generate_llm_response, stream_llm_response, is_llama_server_available,
+    parse_priority, LlamaServerBusyError
+)
+from services.prompt_cache import get_profile_prefix
+from services.conversation_store import CONVERSATION_STORE, normalize_conversation_id
+from services.chat_context import assemble_chat_prompt, record_exchange, MessageTooLongError
+
+
+def build_chat_prompt(message, conversation_id=None):
+    """
+    アクティブなプロファイル情報と会話履歴を含めたllama.cpp用のプロンプトを作成する関数
+    プロファイルごとのプレフィックスは毎回同一になるため、llama-serverのKVキャッシュが再利用される
+    戻り値は組み立て結果の辞書（prompt, message_tokens, max_tokensなど）
+    """
+    # プロファイルの切り替えを反映するため、実行時にconfigを参照する
+    profile_id = app_config.ACTIVE_PROFILE
+    
+    # 会話履歴はプロファイルごとに保存する
+    if get_profile_prefix(profile_id):
+        return assemble_chat_prompt(profile_id, normalize_conversation_id(conversation_id), message)
+    
+    return {'prompt': f"<s>[INST] {message} [/INST]</s>", 'max_tokens': CHAT_MAX_TOKENS}
+
+
+def _save_exchange(context, conversation_id, message, response, response_tokens=None):
+    """会話履歴に今回のやり取りを保存する関数（プロファイルが無い場合は保存しない）"""
+    if 'message_tokens' not in context or not response:
+        return
+    try:
+        record_exchange(
+            app_config.ACTIVE_PROFILE, normalize_conversation_id(conversation_id), message, response,
+            message_tokens=context['message_tokens'], response_tokens=response_tokens
+        )
+    except Exception as e:
+        logger.exception(f"Failed to save conversation history: {str(e)}")
+
+
+def _context_info(context):
+    """レスポンスに含める会話履歴の組み立て結果"""
+    return {key: value for key, value in context.items() if key not in ('prompt', 'max_tokens', 'retrieval_ms')}
+
+
+def _initial_timings(context):
+    """プロンプトの組み立てでかかった時間（関連するメモリの検索）をtimingsに含める"""
+    return {'retrieval_ms': context['retrieval_ms']} if 'retrieval_ms' in context else {}
+
+
+def _sse_event(payload):
+    """Server-Sent Events形式の1イベントを作成する関数"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _busy_response(error):
+    """キューが満杯の場合の503レスポンスを作成する関数"""
+    response = jsonify({
+        'message': "現在リクエストが混み合っています。しばらくしてから再度お試しください。",
+        'error': str(error),
+        'retry_after': error.retry_after,
+        'timestamp': datetime.now().isoformat()
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def _too_long_payload(error):
+    """メッセージがコンテキストに収まらない場合のレスポンス内容"""
+    return {
+        'message': str(error),
+        'error': 'message_too_long',
+        'message_tokens': error.message_tokens,
+        'available_tokens': error.available_tokens,
+        'timestamp': datetime.now().isoformat()
+    }
+
+
+def _sse_response(generator):
+    """ジェネレータからSSEレスポンスを作成する関数"""
+    response = Response(generator, mimetype='text/event-stream')
+    # プロキシやブラウザでバッファリング・キャッシュされないようにする
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 def register_routes(app: Flask):
@@ -43,28 +128,27 @@ def register_routes(app: Flask):
                 'timestamp': datetime.now().isoformat()
             })
         
+        conversation_id = data.get('conversation_id')
+        
         try:
-            # 現在のプロファイル名を取得（存在する場合）
-            profile_name = ""
-            if ACTIVE_PROFILE:
-                config_path = os.path.join(PROFILES_DIR, ACTIVE_PROFILE, 'config.json')
-                if os.path.exists(config_path):
-                    with open(config_path, 'r', encoding='utf-8') as f:
-                        import json
-                        config = json.load(f)
-                        profile_name = config.get('name', ACTIVE_PROFILE)
+            context = build_chat_prompt(message, conversation_id)
+            prompt = context['prompt']
             
-            # llama.cppへのプロンプト作成（プロファイル情報を含める）
-            if profile_name:
-                system_prompt = f"あなたは{profile_name}です。ユーザーの質問に丁寧に答えてください。"
-                prompt = f"<s>[INST] {system_prompt} [/INST]</s>\n\n[INST] {message} [/INST]"
-            else:
-                prompt = f"<s>[INST] {message} [/INST]</s>"
-            
-            # llama-server.exeを使用する場合（Windowsの場合）
-            if IS_WINDOWS and LLAMACPP_MAIN.endswith('llama-server.exe'):
+            # 常駐型のllama-serverを使用する場合（全プラットフォーム共通）
+            # モデルはロード済みなので、リクエストごとの再ロードが発生しない
+            if is_llama_server_available():
                 # llama-serverにリクエストを送信して応答を生成
-                generated_text, error = generate_llm_response(prompt)
+                # バッチ処理などは priority: "batch" を指定すると対話チャットの後に回される
+                # cache: false を指定すると応答キャッシュを使わずに必ず生成する
+                timings = _initial_timings(context)
+                # JSONの真偽値以外（"false"などの文字列）は指定なしとして扱う
+                cache = data.get('cache')
+                generated_text, error = generate_llm_response(
+                    prompt, max_tokens=context['max_tokens'],
+                    priority=parse_priority(data.get('priority')), timings=timings,
+                    cache_key=app_config.ACTIVE_PROFILE or None,
+                    use_cache=cache if isinstance(cache, bool) else None
+                )
                 
                 if error:
                     logger.error(f"Error generating response: {error}")
@@ -73,12 +157,17 @@ def register_routes(app: Flask):
                         'timestamp': datetime.now().isoformat()
                     })
                 
+                _save_exchange(context, conversation_id, message, generated_text,
+                               response_tokens=timings.get('completion_tokens'))
+                
                 return jsonify({
                     'message': generated_text,
+                    'timings': timings,
+                    'context': _context_info(context),
                     'timestamp': datetime.now().isoformat()
                 })
             
-            # 通常のmain実行ファイルを使用する場合
+            # llama-serverが無い環境向けのフォールバック（リクエストごとにmainを実行）
             else:
                 # llama.cppコマンドの構築
                 cmd = [
@@ -89,7 +178,7 @@ def register_routes(app: Flask):
                     '--temp', '0.7',
                     '--top-p', '0.9',
                     '--seed', '-1',
-                    '-n', '1024',
+                    '-n', str(context['max_tokens']),
                     '--repeat-penalty', '1.1',
                     '-ngl', '1'  # GPUレイヤー数（GPUを使用する場合）
                 ]
@@ -139,15 +228,160 @@ def register_routes(app: Flask):
                         'timestamp': datetime.now().isoformat()
                     })
                 
+                _save_exchange(context, conversation_id, message, assistant_response)
+                
                 # 成功レスポンス
                 return jsonify({
                     'message': assistant_response,
                     'timestamp': datetime.now().isoformat()
                 })
         
+        except MessageTooLongError as e:
+            logger.warning(f"Chat request rejected: {str(e)}")
+            return jsonify(_too_long_payload(e)), 413
+        
+        except LlamaServerBusyError as e:
+            logger.warning(f"Chat request rejected: {str(e)}")
+            return _busy_response(e)
+        
         except Exception as e:
             logger.exception(f"Error during chat processing: {str(e)}")
             return jsonify({
                 'message': f"エラーが発生しました: {str(e)}",
                 'timestamp': datetime.now().isoformat()
             })
+
+
+    @app.route('/api/chat/stream', methods=['GET', 'POST'])
+    def chat_stream():
+        """
+        ストリーミングチャットエンドポイント
+        llama-serverが生成したトークンをServer-Sent Eventsで逐次送信する
+        """
+        # EventSourceはGETのクエリパラメータでメッセージを送ってくる
+        data = request.args if request.method == 'GET' else (request.json or {})
+        message = data.get('message', '')
+        logger.info(f"Streaming chat request received with message: {message}")
+        
+        # EventSourceはエラー時のJSONを読めないため、エラーもSSEイベントとして返す
+        if not SELECTED_MODEL_PATH:
+            logger.warning("No model selected, returning error event")
+            return _sse_response(iter([_sse_event({
+                'error': True,
+                'text': "モデルが選択されていません。設定ページでモデルを選択してください。"
+            })]))
+        
+        if not os.path.exists(SELECTED_MODEL_PATH):
+            logger.error(f"Selected model file not found: {SELECTED_MODEL_PATH}")
+            return _sse_response(iter([_sse_event({
+                'error': True,
+                'text': f"選択されたモデルファイルが見つかりません: {SELECTED_MODEL_PATH}"
+            })]))
+        
+        conversation_id = data.get('conversation_id')
+        
+        try:
+            context = build_chat_prompt(message, conversation_id)
+        except MessageTooLongError as e:
+            logger.warning(f"Streaming chat request rejected: {str(e)}")
+            response = _sse_response(iter([_sse_event(dict(_too_long_payload(e), error=True, text=str(e)))]))
+            response.status_code = 413
+            return response
+        except Exception as e:
+            logger.exception(f"Error building chat prompt: {str(e)}")
+            return _sse_response(iter([_sse_event({
+                'error': True,
+                'text': f"エラーが発生しました: {str(e)}"
+            })]))
+        
+        priority = parse_priority(data.get('priority'))
+        
+        def generate():
+            buffer = ""
+            timings = _initial_timings(context)
+            try:
+                for text, error in stream_llm_response(context['prompt'], max_tokens=context['max_tokens'],
+                                                       priority=priority, timings=timings,
+                                                       cache_key=app_config.ACTIVE_PROFILE or None):
+                    if error:
+                        logger.error(f"Error streaming response: {error}")
+                        yield _sse_event({
+                            'error': True,
+                            'text': f"応答生成中にエラーが発生しました: {error}"
+                        })
+                        return
+                    
+                    buffer += text
+                    yield _sse_event({'text': text})
+            except LlamaServerBusyError as e:
+                logger.warning(f"Streaming chat request rejected: {str(e)}")
+                yield _sse_event({
+                    'error': True,
+                    'text': "現在リクエストが混み合っています。しばらくしてから再度お試しください。",
+                    'retry_after': e.retry_after
+                })
+                return
+            
+            _save_exchange(context, conversation_id, message, buffer,
+                           response_tokens=timings.get('completion_tokens'))
+            
+            yield _sse_event({
+                'finish': True,
+                'buffer': buffer,
+                'timings': timings,
+                'context': _context_info(context),
+                'timestamp': datetime.now().isoformat()
+            })
+        
+        return _sse_response(generate())
+
+
+    @app.route('/api/chat/history', methods=['GET'])
+    def get_chat_history():
+        """
+        会話履歴を取得するエンドポイント
+        ?conversation_id=...&limit=50 で最新のメッセージを古い順に返す
+        """
+        try:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
+                return jsonify({'error': 'アクティブなプロファイルがありません'}), 400
+            
+            conversation_id = normalize_conversation_id(request.args.get('conversation_id'))
+            limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+            
+            messages = CONVERSATION_STORE.tail(profile_id, conversation_id, limit)
+            summary = CONVERSATION_STORE.get_summary(profile_id, conversation_id)
+            
+            return jsonify({
+                'profile_id': profile_id,
+                'conversation_id': conversation_id,
+                'messages': messages,
+                'total': CONVERSATION_STORE.count(profile_id, conversation_id),
+                'summary': summary.get('summary', ''),
+                'summarized_messages': summary.get('summarized_until', 0),
+                'conversations': CONVERSATION_STORE.list_conversations(profile_id)
+            })
+        
+        except Exception as e:
+            logger.exception(f"Error getting chat history: {str(e)}")
+            return jsonify({'error': f'会話履歴の取得に失敗しました: {str(e)}'}), 500
+
+
+    @app.route('/api/chat/history', methods=['DELETE'])
+    def clear_chat_history():
+        """会話履歴と要約を削除するエンドポイント"""
+        try:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
+                return jsonify({'error': 'アクティブなプロファイルがありません'}), 400
+            
+            conversation_id = normalize_conversation_id(request.args.get('conversation_id'))
+            CONVERSATION_STORE.clear(profile_id, conversation_id)
+            logger.info(f"Cleared conversation history: {profile_id}/{conversation_id}")
+            
+            return jsonify({'success': True, 'conversation_id': conversation_id})
+        
+        except Exception as e:
+            logger.exception(f"Error clearing chat history: {str(e)}")
+            return jsonify({'error': f'会話履歴の削除に失敗しました: {str(e)}'}), 500
@@ -14,7 +14,7 @@ import os
 import sys
 import traceback
 import training_manager
-from services.llama_server import check_llama_server
+from services.llama_health import get_llama_server_state
 
 
 def register_routes(app: Flask):
@@ -30,8 +30,8 @@ def register_routes(app: Flask):
         try:
             uptime = (datetime.now() - START_TIME).total_seconds()
             
-            # llama-serverの状態も確認
-            llama_server_status = "running" if check_llama_server() else "stopped"
+            # llama-serverの状態も確認（バックグラウンドで確認した結果を使う）
+            llama_server_status = "running" if get_llama_server_state()['running'] else "stopped"
             
             response = jsonify({
                 'status': 'ok',
@@ -97,7 +97,7 @@ def register_routes(app: Flask):
                 'llama_server': {
                     'executable': LLAMACPP_MAIN,
                     'exists': os.path.exists(LLAMACPP_MAIN),
-                    'running': check_llama_server(),
+                    'running': get_llama_server_state()['running'],
                 },
                 'system': {
                     'start_time': START_TIME.isoformat(),
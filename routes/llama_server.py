@@ -6,12 +6,18 @@ Second Me Windows - llama-serverルート
 llama-serverの管理と制御のエンドポイント
 """
 
-from flask import jsonify, Flask
-from config import SELECTED_MODEL_PATH, LLAMA_SERVER_URL
+from flask import jsonify, request, Flask
+from config import logger, SELECTED_MODEL_PATH, LLAMA_SERVER_URL
 import os
 from services.llama_server import (
-    start_llama_server, stop_llama_server, check_llama_server
+    start_llama_server, stop_llama_server, get_scheduler_stats,
+    get_llama_server_instances, refresh_llama_server_health, get_embedding_server_status
 )
+from services.llama_health import get_health_prober
+from services.llama_client import get_llama_client_stats
+from services.prompt_cache import get_prefix_cache_stats
+from services.response_cache import get_response_cache_stats
+from services.tokenizer import count_tokens_batch, get_tokenizer_stats
 
 
 def register_routes(app: Flask):
@@ -19,13 +25,29 @@ def register_routes(app: Flask):
     
     @app.route('/api/llama-server/status', methods=['GET'])
     def llama_server_status():
-        """llama-serverの状態を取得するエンドポイント"""
-        is_running = check_llama_server()
+        """
+        llama-serverの状態を取得するエンドポイント
+        通常はキャッシュされた状態を返し、?refresh=true の場合のみ即時に確認する
+        """
+        if request.args.get('refresh', '').lower() in ('1', 'true', 'yes'):
+            refresh_llama_server_health()
+        health = get_health_prober().get_state()
+        
+        instances = get_llama_server_instances()
+        running = any(inst['health']['running'] for inst in instances)
         
         return jsonify({
-            'status': 'running' if is_running else 'stopped',
+            'status': 'running' if running else 'stopped',
             'model': os.path.basename(SELECTED_MODEL_PATH) if SELECTED_MODEL_PATH else None,
-            'url': LLAMA_SERVER_URL
+            'url': LLAMA_SERVER_URL,
+            'health': health,
+            'instances': instances,
+            'embedding_server': get_embedding_server_status(),
+            'http_client': get_llama_client_stats(),
+            'scheduler': get_scheduler_stats(),
+            'prefix_cache': get_prefix_cache_stats(),
+            'response_cache': get_response_cache_stats(),
+            'tokenizer': get_tokenizer_stats()
         })
 
 
@@ -61,3 +83,30 @@ def register_routes(app: Flask):
                 'status': 'error',
                 'message': 'Failed to stop llama-server'
             }), 500
+
+
+    @app.route('/api/llama-server/tokenize', methods=['POST'])
+    def tokenize_endpoint():
+        """
+        トークン数を数えるエンドポイント
+        {"text": "..."} または {"texts": ["...", ...]} を受け取り、トークン数を返す
+        """
+        try:
+            data = request.json or {}
+            texts = data.get('texts')
+            if texts is None:
+                if 'text' not in data:
+                    return jsonify({'error': 'textまたはtextsを指定してください'}), 400
+                texts = [data['text']]
+            if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                return jsonify({'error': 'textsは文字列の配列で指定してください'}), 400
+            
+            counts = count_tokens_batch(texts)
+            return jsonify({
+                'counts': counts,
+                'total': sum(counts)
+            })
+        
+        except Exception as e:
+            logger.exception(f"Error counting tokens: {str(e)}")
+            return jsonify({'error': f'トークン数の計算に失敗しました: {str(e)}'}), 500
@@ -6,11 +6,22 @@ Second Me Windows - メモリルート
 AIの記憶を管理するためのエンドポイント
 """
 
-import os
 import json
-from datetime import datetime
-from flask import jsonify, request, Flask
-from config import logger, PROFILES_DIR, ACTIVE_PROFILE
+import itertools
+from flask import jsonify, request, Flask, Response
+import config as app_config
+from config import logger, MEMORY_DEDUP_ON_CREATE
+from services.memory_store import get_memory_store, validate_memory_changes, SORT_EXPRESSIONS, DUPLICATE_MODES
+from services.memory_consolidation import start_dedup_pass, get_dedup_status
+from services.memory_vectors import get_vector_index
+from services.llama_server import LlamaServerBusyError, EmbeddingsNotConfiguredError
+
+# 全件を送信する場合に1回で送る文字数の目安
+STREAM_CHUNK_SIZE = 64 * 1024
+# 一括操作で1回に指定できる操作の数
+MAX_BATCH_OPERATIONS = 10000
+# タグでの絞り込み方（all: すべてを含む / any: いずれかを含む）
+TAG_MODES = ('all', 'any')
 
 
 def register_routes(app: Flask):
@@ -20,35 +31,78 @@ def register_routes(app: Flask):
     def get_memories():
         """
         現在のプロファイルのメモリを取得するエンドポイント
+        クエリパラメータ:
+          limit, cursor: ページ単位で取得する（レスポンスのnext_cursorを次のcursorに指定する）
+          sort: created_at / updated_at / strength、order: asc / desc
+          fields: 返す項目をカンマ区切りで指定（例: id,type,tags,created_at）
+          type, tags: タイプ・タグ（カンマ区切り）で絞り込む
+          tag_mode: all（すべてのタグを含む、既定）/ any（いずれかを含む）
+        limitもcursorも指定しない場合は全件を返すが、リストに読み込まずに1件ずつ送信する
         """
         try:
-            if not ACTIVE_PROFILE:
+            # プロファイルの切り替えを反映するため、実行時にconfigを参照する
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
                 return jsonify({
                     'error': 'アクティブなプロファイルが選択されていません'
                 }), 400
             
-            # メモリディレクトリのパス
-            memory_dir = os.path.join(PROFILES_DIR, ACTIVE_PROFILE, 'memory')
-            
-            # ディレクトリが存在しない場合は作成
-            if not os.path.exists(memory_dir):
-                os.makedirs(memory_dir, exist_ok=True)
+            args = request.args
+            sort = args.get('sort', 'created_at')
+            order = args.get('order', 'asc').lower()
+            if sort not in SORT_EXPRESSIONS or order not in ('asc', 'desc'):
+                return jsonify({
+                    'error': f"並び順の指定が正しくありません（sort: {', '.join(SORT_EXPRESSIONS)}、order: asc / desc）"
+                }), 400
+            tag_mode = args.get('tag_mode', 'all')
+            if tag_mode not in TAG_MODES:
+                return jsonify({
+                    'error': 'tag_modeにはallまたはanyを指定してください'
+                }), 400
             
-            # メモリファイルの読み込み
-            memories = []
-            memory_file = os.path.join(memory_dir, 'memories.json')
+            fields = [f.strip() for f in args.get('fields', '').split(',') if f.strip()] or None
+            tags = [t.strip() for t in args.get('tags', '').split(',') if t.strip()]
+            options = {
+                'memory_type': args.get('type') or None,
+                'tags': tags,
+                'tag_mode': tag_mode,
+                'sort': sort,
+                'descending': order == 'desc',
+                'fields': fields
+            }
+            store = get_memory_store(profile_id)
             
-            if os.path.exists(memory_file):
+            if 'limit' in args or 'cursor' in args:
+                limit = max(1, min(args.get('limit', 50, type=int), 1000))
                 try:
-                    with open(memory_file, 'r', encoding='utf-8') as f:
-                        memories = json.load(f)
-                except Exception as e:
-                    logger.error(f"Failed to load memories file: {str(e)}")
+                    memories, next_cursor = store.list_page(limit=limit, after=args.get('cursor') or None, **options)
+                except ValueError:
+                    return jsonify({
+                        'error': 'カーソルが正しくありません。最初のページから取得し直してください'
+                    }), 400
+                
+                return jsonify({
+                    'memories': memories,
+                    'count': len(memories),
+                    'next_cursor': next_cursor,
+                    'has_more': next_cursor is not None
+                })
             
-            return jsonify({
-                'memories': memories,
-                'count': len(memories)
-            })
+            def generate():
+                # 1件ずつ送ると遅いため、ある程度まとめて送信する
+                count, chunk, chunk_size = 0, ['{"memories":['], 0
+                for memory in store.iter_memories(**options):
+                    item = (',' if count else '') + json.dumps(memory, ensure_ascii=False)
+                    chunk.append(item)
+                    chunk_size += len(item)
+                    count += 1
+                    if chunk_size >= STREAM_CHUNK_SIZE:
+                        yield ''.join(chunk)
+                        chunk, chunk_size = [], 0
+                chunk.append(f'],"count":{count}}}')
+                yield ''.join(chunk)
+            
+            return Response(generate(), mimetype='application/json')
             
         except Exception as e:
             logger.exception(f"Error getting memories: {str(e)}")
@@ -61,9 +115,11 @@ def register_routes(app: Flask):
     def create_memory():
         """
         新しいメモリを作成するエンドポイント
+        既存のメモリとほぼ同じ内容の場合の扱いは on_duplicate（keep / flag / skip / merge）で指定する
         """
         try:
-            if not ACTIVE_PROFILE:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
                 return jsonify({
                     'error': 'アクティブなプロファイルが選択されていません'
                 }), 400
@@ -72,57 +128,126 @@ def register_routes(app: Flask):
             memory_content = data.get('content')
             memory_type = data.get('type', 'general')
             memory_tags = data.get('tags', [])
+            on_duplicate = data.get('on_duplicate', MEMORY_DEDUP_ON_CREATE)
             
             if not memory_content:
                 return jsonify({
                     'error': 'メモリの内容が指定されていません'
                 }), 400
+            if on_duplicate not in DUPLICATE_MODES:
+                return jsonify({
+                    'error': f"on_duplicateには{', '.join(DUPLICATE_MODES)}のいずれかを指定してください"
+                }), 400
             
-            # メモリディレクトリのパス
-            memory_dir = os.path.join(PROFILES_DIR, ACTIVE_PROFILE, 'memory')
+            # 新しいメモリを作成（初期強度は1.0）
+            store = get_memory_store(profile_id)
+            result = store.create_deduplicated([{
+                'content': memory_content, 'type': memory_type, 'tags': memory_tags, 'strength': 1.0
+            }], on_duplicate=on_duplicate)[0]
+            
+            response = {'status': 'success'}
+            if result['status'] == 'created':
+                response.update(message='メモリを作成しました', memory=store.get(result['id']))
+            elif result['status'] == 'merged':
+                response.update(message=f"メモリID {result['duplicate_of']} とほぼ同じ内容のため統合しました",
+                                memory=store.get(result['id']))
+            else:
+                response.update(message=f"メモリID {result['duplicate_of']} とほぼ同じ内容のため作成しませんでした",
+                                memory=None)
+            if result.get('duplicate_of') is not None:
+                response.update(duplicate_of=result['duplicate_of'], similarity=result['similarity'])
+            response['result'] = result['status']
+            return jsonify(response)
+            
+        except ValueError as e:
+            return jsonify({
+                'error': str(e)
+            }), 400
+        except Exception as e:
+            logger.exception(f"Error creating memory: {str(e)}")
+            return jsonify({
+                'error': f"メモリの作成中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/memory/batch', methods=['POST'])
+    def batch_memories():
+        """
+        メモリの作成・更新・削除をまとめて実行するエンドポイント
+        {"operations": [{"op": "create", "content": ...}, {"op": "update", "id": ..., "strength": ...},
+                        {"op": "delete", "id": ...}]}
+        すべての操作を1つのトランザクションで実行し、1件でも失敗した場合はすべて取り消す
+        """
+        try:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
+                return jsonify({
+                    'error': 'アクティブなプロファイルが選択されていません'
+                }), 400
             
-            # ディレクトリが存在しない場合は作成
-            if not os.path.exists(memory_dir):
-                os.makedirs(memory_dir, exist_ok=True)
+            operations = (request.json or {}).get('operations')
+            if not isinstance(operations, list) or not operations:
+                return jsonify({
+                    'error': '操作（operations）が指定されていません'
+                }), 400
+            if len(operations) > MAX_BATCH_OPERATIONS:
+                return jsonify({
+                    'error': f'一度に実行できる操作は{MAX_BATCH_OPERATIONS}件までです'
+                }), 400
             
-            # 既存のメモリを読み込む
-            memories = []
-            memory_file = os.path.join(memory_dir, 'memories.json')
+            applied, results = get_memory_store(profile_id).apply_batch(operations)
             
-            if os.path.exists(memory_file):
-                try:
-                    with open(memory_file, 'r', encoding='utf-8') as f:
-                        memories = json.load(f)
-                except Exception as e:
-                    logger.error(f"Failed to load memories file: {str(e)}")
-            
-            # 新しいメモリを作成
-            new_memory = {
-                'id': str(len(memories) + 1),
-                'content': memory_content,
-                'type': memory_type,
-                'tags': memory_tags,
-                'created_at': datetime.now().isoformat(),
-                'strength': 1.0  # 新しいメモリの初期強度
-            }
+            if not applied:
+                return jsonify({
+                    'status': 'failed',
+                    'error': '失敗した操作があるため、すべての操作を取り消しました',
+                    'results': results
+                }), 400
+            
+            return jsonify({
+                'status': 'success',
+                'message': f'{len(results)}件の操作を実行しました',
+                'results': results
+            })
             
-            # メモリリストに追加
-            memories.append(new_memory)
+        except Exception as e:
+            logger.exception(f"Error applying memory batch: {str(e)}")
+            return jsonify({
+                'error': f"メモリの一括操作中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/memory/tags', methods=['GET'])
+    def get_memory_tags():
+        """
+        タグごと・タイプごとのメモリ数を取得するエンドポイント
+        ?type=...でタイプを、?prefix=...でタグの先頭の文字列を指定して絞り込める
+        """
+        try:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
+                return jsonify({
+                    'error': 'アクティブなプロファイルが選択されていません'
+                }), 400
             
-            # メモリを保存
-            with open(memory_file, 'w', encoding='utf-8') as f:
-                json.dump(memories, f, ensure_ascii=False, indent=2)
+            store = get_memory_store(profile_id)
+            limit = request.args.get('limit', type=int)
+            tag_counts = store.tag_counts(
+                memory_type=request.args.get('type') or None,
+                prefix=request.args.get('prefix') or None,
+                limit=max(1, limit) if limit else None
+            )
             
             return jsonify({
-                'status': 'success',
-                'message': 'メモリを作成しました',
-                'memory': new_memory
+                'tags': [{'tag': tag, 'count': count} for tag, count in tag_counts],
+                'types': [{'type': memory_type, 'count': count} for memory_type, count in store.type_counts()],
+                'total': store.count()
             })
             
         except Exception as e:
-            logger.exception(f"Error creating memory: {str(e)}")
+            logger.exception(f"Error getting memory tags: {str(e)}")
             return jsonify({
-                'error': f"メモリの作成中にエラーが発生しました: {str(e)}"
+                'error': f"タグの取得中にエラーが発生しました: {str(e)}"
             }), 500
 
 
@@ -132,25 +257,14 @@ def register_routes(app: Flask):
         特定のメモリを取得するエンドポイント
         """
         try:
-            if not ACTIVE_PROFILE:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
                 return jsonify({
                     'error': 'アクティブなプロファイルが選択されていません'
                 }), 400
             
-            # メモリファイルのパス
-            memory_file = os.path.join(PROFILES_DIR, ACTIVE_PROFILE, 'memory', 'memories.json')
-            
-            if not os.path.exists(memory_file):
-                return jsonify({
-                    'error': 'メモリファイルが見つかりません'
-                }), 404
-            
-            # メモリを読み込む
-            with open(memory_file, 'r', encoding='utf-8') as f:
-                memories = json.load(f)
-            
             # 指定されたIDのメモリを検索
-            memory = next((m for m in memories if m['id'] == memory_id), None)
+            memory = get_memory_store(profile_id).get(memory_id)
             
             if not memory:
                 return jsonify({
@@ -172,55 +286,32 @@ def register_routes(app: Flask):
         メモリを更新するエンドポイント
         """
         try:
-            if not ACTIVE_PROFILE:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
                 return jsonify({
                     'error': 'アクティブなプロファイルが選択されていません'
                 }), 400
             
-            # メモリファイルのパス
-            memory_file = os.path.join(PROFILES_DIR, ACTIVE_PROFILE, 'memory', 'memories.json')
-            
-            if not os.path.exists(memory_file):
+            # 更新データを取得（一括操作の更新と同じ条件で確かめる）
+            data = request.json
+            error = validate_memory_changes(data)
+            if error:
                 return jsonify({
-                    'error': 'メモリファイルが見つかりません'
-                }), 404
-            
-            # メモリを読み込む
-            with open(memory_file, 'r', encoding='utf-8') as f:
-                memories = json.load(f)
+                    'error': error
+                }), 400
             
-            # 指定されたIDのメモリのインデックスを検索
-            memory_index = next((i for i, m in enumerate(memories) if m['id'] == memory_id), None)
+            # メモリを更新（content, type, tags, strengthのみ、更新日時も記録される）
+            memory = get_memory_store(profile_id).update(memory_id, data)
             
-            if memory_index is None:
+            if memory is None:
                 return jsonify({
                     'error': f'メモリID {memory_id} が見つかりません'
                 }), 404
             
-            # 更新データを取得
-            data = request.json
-            
-            # メモリを更新
-            if 'content' in data:
-                memories[memory_index]['content'] = data['content']
-            if 'type' in data:
-                memories[memory_index]['type'] = data['type']
-            if 'tags' in data:
-                memories[memory_index]['tags'] = data['tags']
-            if 'strength' in data:
-                memories[memory_index]['strength'] = data['strength']
-            
-            # 更新日時を記録
-            memories[memory_index]['updated_at'] = datetime.now().isoformat()
-            
-            # 更新したメモリを保存
-            with open(memory_file, 'w', encoding='utf-8') as f:
-                json.dump(memories, f, ensure_ascii=False, indent=2)
-            
             return jsonify({
                 'status': 'success',
                 'message': f'メモリID {memory_id} を更新しました',
-                'memory': memories[memory_index]
+                'memory': memory
             })
             
         except Exception as e:
@@ -236,35 +327,18 @@ def register_routes(app: Flask):
         メモリを削除するエンドポイント
         """
         try:
-            if not ACTIVE_PROFILE:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
                 return jsonify({
                     'error': 'アクティブなプロファイルが選択されていません'
                 }), 400
             
-            # メモリファイルのパス
-            memory_file = os.path.join(PROFILES_DIR, ACTIVE_PROFILE, 'memory', 'memories.json')
-            
-            if not os.path.exists(memory_file):
-                return jsonify({
-                    'error': 'メモリファイルが見つかりません'
-                }), 404
-            
-            # メモリを読み込む
-            with open(memory_file, 'r', encoding='utf-8') as f:
-                memories = json.load(f)
-            
             # 指定されたIDのメモリを削除
-            updated_memories = [m for m in memories if m['id'] != memory_id]
-            
-            if len(updated_memories) == len(memories):
+            if not get_memory_store(profile_id).delete(memory_id):
                 return jsonify({
                     'error': f'メモリID {memory_id} が見つかりません'
                 }), 404
             
-            # 更新したメモリリストを保存
-            with open(memory_file, 'w', encoding='utf-8') as f:
-                json.dump(updated_memories, f, ensure_ascii=False, indent=2)
-            
             return jsonify({
                 'status': 'success',
                 'message': f'メモリID {memory_id} を削除しました'
@@ -283,43 +357,39 @@ def register_routes(app: Flask):
         メモリを検索するエンドポイント
         """
         try:
-            if not ACTIVE_PROFILE:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
                 return jsonify({
                     'error': 'アクティブなプロファイルが選択されていません'
                 }), 400
             
             data = request.json
-            query = data.get('query', '').lower()
+            query = data.get('query', '')
             memory_type = data.get('type')
             tags = data.get('tags', [])
+            tag_mode = data.get('tag_mode', 'all')
+            try:
+                limit = max(1, min(int(data.get('limit', 50)), 1000))
+            except (TypeError, ValueError):
+                return jsonify({
+                    'error': 'limitには整数を指定してください'
+                }), 400
             
-            # メモリファイルのパス
-            memory_file = os.path.join(PROFILES_DIR, ACTIVE_PROFILE, 'memory', 'memories.json')
-            
-            if not os.path.exists(memory_file):
+            if tag_mode not in TAG_MODES:
                 return jsonify({
-                    'memories': [],
-                    'count': 0
-                })
+                    'error': 'tag_modeにはallまたはanyを指定してください'
+                }), 400
             
-            # メモリを読み込む
-            with open(memory_file, 'r', encoding='utf-8') as f:
-                memories = json.load(f)
+            store = get_memory_store(profile_id)
             
-            # 検索条件に基づいてフィルタリング
-            results = []
-            for memory in memories:
-                # クエリでフィルタリング
-                content_match = query in memory['content'].lower() if query else True
-                
-                # タイプでフィルタリング
-                type_match = memory['type'] == memory_type if memory_type else True
-                
-                # タグでフィルタリング
-                tag_match = all(tag in memory['tags'] for tag in tags) if tags else True
-                
-                if content_match and type_match and tag_match:
-                    results.append(memory)
+            if query.strip():
+                # 全文検索索引を使い、関連度（BM25）の高い順にスニペット付きで返す
+                results = store.search(query, memory_type=memory_type, tags=tags, limit=limit, tag_mode=tag_mode)
+                # 検索で思い出したメモリは強化する
+                store.reinforce(memory['id'] for memory in results)
+            else:
+                # クエリが無い場合はタイプ・タグのみでフィルタリング（どちらもインデックスで絞り込む）
+                results = list(itertools.islice(store.iter_memories(memory_type, tags=tags, tag_mode=tag_mode), limit))
             
             return jsonify({
                 'memories': results,
@@ -331,3 +401,246 @@ def register_routes(app: Flask):
             return jsonify({
                 'error': f"メモリの検索中にエラーが発生しました: {str(e)}"
             }), 500
+
+
+    @app.route('/api/memory/semantic-search', methods=['POST'])
+    def semantic_search_memories():
+        """
+        意味が近いメモリを埋め込みベクトルで検索するエンドポイント
+        """
+        try:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
+                return jsonify({
+                    'error': 'アクティブなプロファイルが選択されていません'
+                }), 400
+            
+            data = request.json
+            query = data.get('query', '')
+            memory_type = data.get('type')
+            tags = data.get('tags', [])
+            k = max(1, min(int(data.get('k', 10)), 100))
+            
+            if not query.strip():
+                return jsonify({
+                    'error': '検索クエリが指定されていません'
+                }), 400
+            
+            timings = {}
+            results = get_vector_index(profile_id).search(
+                query, k=k, memory_type=memory_type, tags=tags, timings=timings
+            )
+            get_memory_store(profile_id).reinforce(memory['id'] for memory in results)
+            
+            return jsonify({
+                'memories': results,
+                'count': len(results),
+                'timings': timings
+            })
+            
+        except EmbeddingsNotConfiguredError as e:
+            return jsonify({
+                'error': str(e)
+            }), 501
+        except LlamaServerBusyError as e:
+            response = jsonify({
+                'error': f"現在リクエストが混み合っています: {str(e)}",
+                'retry_after': e.retry_after
+            })
+            response.status_code = 503
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+        except Exception as e:
+            logger.exception(f"Error in semantic memory search: {str(e)}")
+            return jsonify({
+                'error': f"メモリの検索中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/memory/embeddings/status', methods=['GET'])
+    def get_embeddings_status():
+        """
+        メモリの埋め込みベクトルの計算状況を取得するエンドポイント
+        """
+        try:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
+                return jsonify({
+                    'error': 'アクティブなプロファイルが選択されていません'
+                }), 400
+            
+            return jsonify(get_vector_index(profile_id).get_status())
+            
+        except Exception as e:
+            logger.exception(f"Error getting embeddings status: {str(e)}")
+            return jsonify({
+                'error': f"埋め込みの状態の取得中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/memory/consolidate', methods=['POST'])
+    def consolidate_memories():
+        """
+        強度が閾値を下回ったメモリを整理するエンドポイント
+        {"threshold": 0.05, "dry_run": true} で、整理せずに対象の件数と強度の分布だけを返す
+        """
+        try:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
+                return jsonify({
+                    'error': 'アクティブなプロファイルが選択されていません'
+                }), 400
+            
+            data = request.json or {}
+            options = {'dry_run': bool(data.get('dry_run', False))}
+            if 'threshold' in data:
+                options['threshold'] = float(data['threshold'])
+            if 'mode' in data:
+                if data['mode'] not in ('archive', 'delete'):
+                    return jsonify({
+                        'error': 'modeにはarchiveまたはdeleteを指定してください'
+                    }), 400
+                options['mode'] = data['mode']
+            
+            return jsonify(get_memory_store(profile_id).consolidate(**options))
+            
+        except Exception as e:
+            logger.exception(f"Error consolidating memories: {str(e)}")
+            return jsonify({
+                'error': f"メモリの整理中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/memory/dedup', methods=['POST'])
+    def dedup_memories():
+        """
+        ほぼ同じ内容のメモリを探す重複整理をバックグラウンドで開始するエンドポイント
+        {"merge": true} で各グループを最も古いメモリにまとめる（省略時は一覧を作るだけ）
+        """
+        try:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
+                return jsonify({
+                    'error': 'アクティブなプロファイルが選択されていません'
+                }), 400
+            
+            data = request.json or {}
+            options = {'merge': bool(data.get('merge', False))}
+            if 'threshold' in data:
+                threshold = float(data['threshold'])
+                if not 0 < threshold <= 1:
+                    return jsonify({
+                        'error': 'thresholdには0より大きく1以下の値を指定してください'
+                    }), 400
+                options['threshold'] = threshold
+            
+            if not start_dedup_pass(profile_id, **options):
+                return jsonify({
+                    'error': '重複整理は既に実行中です',
+                    'dedup': get_dedup_status(profile_id)
+                }), 409
+            
+            return jsonify({
+                'status': 'success',
+                'message': '重複整理を開始しました',
+                'dedup': get_dedup_status(profile_id)
+            }), 202
+            
+        except (TypeError, ValueError) as e:
+            return jsonify({
+                'error': f"パラメータが正しくありません: {str(e)}"
+            }), 400
+        except Exception as e:
+            logger.exception(f"Error starting memory dedup: {str(e)}")
+            return jsonify({
+                'error': f"重複整理の開始中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/memory/dedup', methods=['GET'])
+    def get_memory_dedup_status():
+        """
+        重複整理の状態と結果を取得するエンドポイント
+        """
+        try:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
+                return jsonify({
+                    'error': 'アクティブなプロファイルが選択されていません'
+                }), 400
+            
+            return jsonify(get_dedup_status(profile_id))
+            
+        except Exception as e:
+            logger.exception(f"Error getting memory dedup status: {str(e)}")
+            return jsonify({
+                'error': f"重複整理の状態の取得中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/memory/archive', methods=['GET'])
+    def get_archived_memories():
+        """
+        アーカイブしたメモリを取得するエンドポイント（?limit=50&cursor=...）
+        """
+        try:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
+                return jsonify({
+                    'error': 'アクティブなプロファイルが選択されていません'
+                }), 400
+            
+            store = get_memory_store(profile_id)
+            limit = max(1, min(request.args.get('limit', 50, type=int), 1000))
+            cursor = request.args.get('cursor')
+            if cursor and not cursor.isdigit():
+                return jsonify({
+                    'error': 'カーソルが正しくありません。最初のページから取得し直してください'
+                }), 400
+            
+            memories, next_cursor = store.list_archived(limit=limit, after=cursor)
+            
+            return jsonify({
+                'memories': memories,
+                'count': len(memories),
+                'total': store.count_archived(),
+                'next_cursor': next_cursor,
+                'has_more': next_cursor is not None
+            })
+            
+        except Exception as e:
+            logger.exception(f"Error getting archived memories: {str(e)}")
+            return jsonify({
+                'error': f"アーカイブの取得中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/memory/archive/<memory_id>/restore', methods=['POST'])
+    def restore_memory(memory_id):
+        """
+        アーカイブしたメモリを元に戻すエンドポイント
+        """
+        try:
+            profile_id = app_config.ACTIVE_PROFILE
+            if not profile_id:
+                return jsonify({
+                    'error': 'アクティブなプロファイルが選択されていません'
+                }), 400
+            
+            memory = get_memory_store(profile_id).restore(memory_id)
+            if memory is None:
+                return jsonify({
+                    'error': f'アーカイブにメモリID {memory_id} が見つかりません'
+                }), 404
+            
+            return jsonify({
+                'status': 'success',
+                'message': f'メモリID {memory_id} を元に戻しました',
+                'memory': memory
+            })
+            
+        except Exception as e:
+            logger.exception(f"Error restoring memory: {str(e)}")
+            return jsonify({
+                'error': f"メモリの復元中にエラーが発生しました: {str(e)}"
+            }), 500
@@ -8,10 +8,39 @@ Second Me Windows - アップロードルート
 
 import os
 import json
-from datetime import datetime
-from flask import jsonify, request, Flask, send_from_directory
+import time
+import threading
+from flask import jsonify, request, Flask, Response, send_from_directory, send_file
 from werkzeug.utils import secure_filename
-from config import logger, UPLOAD_FOLDER, ALLOWED_EXTENSIONS, PROFILES_DIR, ACTIVE_PROFILE
+import config as app_config
+from config import (
+    logger, ALLOWED_EXTENSIONS, PROFILES_DIR, WORKSPACE_DIR, MODELS_DIR,
+    MEMORY_DEDUP_ON_IMPORT, UPLOAD_CHUNK_SIZE
+)
+from services.memory_store import DUPLICATE_MODES
+from services.import_jobs import IMPORT_JOBS, IMPORT_TYPES, MEMORY_EXTENSIONS, FINISHED_STATES
+from services.chunked_upload import (
+    CHUNKED_UPLOADS, UploadNotFoundError, UploadOffsetError, UploadChecksumError
+)
+from services.blob_store import BLOB_STORE, is_sha256
+from services.upload_manifest import (
+    get_upload_manifest, get_upload_dir, iter_upload_dirs, count_blob_references, rescan_upload_dirs,
+    UPLOAD_SORTS
+)
+import training_manager
+
+# 分割アップロードの保存先の種類
+UPLOAD_TARGETS = ('upload', 'workspace', 'training', 'model')
+# モデルとしてアップロードできる拡張子
+MODEL_EXTENSIONS = ('.gguf',)
+
+# インポートジョブの状態を確認する間隔と、状態が変わらない間にキープアライブを送る間隔（秒）
+IMPORT_JOB_EVENT_INTERVAL = 0.5
+IMPORT_JOB_KEEPALIVE = 15
+
+# ブロブの参照数を増減してからアップロード記録を書き換えるまでの間に、
+# 参照数をアップロード記録から数え直さないようにするためのロック
+_blob_lock = threading.RLock()
 
 
 def allowed_file(filename):
@@ -19,6 +48,56 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def record_upload(upload_dir, filename, blob, profile_id):
+    """
+    ブロブストアに登録したファイルのアップロード記録を追加する関数
+    blobは参照を1つ増やしたブロブの情報で、この参照は記録が持つ（記録に失敗した場合は戻す）
+    同じ名前・同じ内容のファイルが既にある場合は記録を増やさず、増やした参照を戻す
+    同じ名前で内容が違う場合は上書きせず、番号を付けた名前で記録する
+    戻り値は (アップロード記録, 既に同じファイルがあったか)
+    """
+    try:
+        upload_record, duplicate = get_upload_manifest(upload_dir).add(
+            filename, BLOB_STORE.path_of(blob['sha256']), blob['size'], sha256=blob['sha256'], profile_id=profile_id
+        )
+    except Exception:
+        # 記録できなかった場合は、増やした参照を戻す
+        BLOB_STORE.release(blob['sha256'])
+        raise
+    if duplicate:
+        BLOB_STORE.release(blob['sha256'])
+    else:
+        BLOB_STORE.set_origin(blob['sha256'], upload_dir, upload_record['filename'])
+    return upload_record, duplicate
+
+
+def resolve_upload_destination(target, profile_id, filename, path=''):
+    """
+    分割アップロードの保存先のディレクトリを返す関数
+    保存先として使えない場合は (None, エラーメッセージ, ステータスコード) の形で理由を返す
+    """
+    if target == 'upload':
+        if not allowed_file(filename):
+            return None, f'この拡張子のファイルはアップロードできません。許可されている拡張子: {", ".join(ALLOWED_EXTENSIONS)}', 400
+        return get_upload_dir(profile_id), None, None
+    if target == 'model':
+        if not filename.lower().endswith(MODEL_EXTENSIONS):
+            return None, f'モデルとしてアップロードできるのは {", ".join(MODEL_EXTENSIONS)} ファイルのみです', 400
+        return MODELS_DIR, None, None
+
+    if not profile_id:
+        return None, 'アクティブなプロファイルが選択されていません', 400
+    if target == 'workspace':
+        base_path = os.path.join(WORKSPACE_DIR, profile_id)
+        target_dir = os.path.normpath(os.path.join(base_path, path or ''))
+        if target_dir != base_path and not target_dir.startswith(base_path + os.sep):
+            return None, '無効なパスです。ワークスペース外にファイルをアップロードできません。', 403
+        return target_dir, None, None
+    if target == 'training':
+        return os.path.join(training_manager.get_current_training_path(PROFILES_DIR, profile_id), 'data'), None, None
+    return None, f"targetには{', '.join(UPLOAD_TARGETS)}のいずれかを指定してください", 400
+
+
 def register_routes(app: Flask):
     """アップロード関連のルートを登録"""
     
@@ -49,55 +128,33 @@ def register_routes(app: Flask):
                 }), 400
             
             # プロファイル指定がある場合はプロファイル専用のアップロードディレクトリを使用
-            profile_id = request.form.get('profile_id', ACTIVE_PROFILE)
-            
-            if profile_id:
-                upload_dir = os.path.join(PROFILES_DIR, profile_id, 'uploads')
-            else:
-                upload_dir = UPLOAD_FOLDER
+            profile_id = request.form.get('profile_id', app_config.ACTIVE_PROFILE)
             
-            # アップロードディレクトリが存在しない場合は作成
-            if not os.path.exists(upload_dir):
-                os.makedirs(upload_dir, exist_ok=True)
+            upload_dir = get_upload_dir(profile_id)
             
-            # ファイル名を安全にして保存
+            # ファイル名を安全にして、内容のハッシュを計算しながら一時ファイルに書き込み、ブロブストアに登録
+            # （同じ内容のファイルが既にある場合は一時ファイルを捨て、新しく保存しない）
             filename = secure_filename(file.filename)
-            file_path = os.path.join(upload_dir, filename)
-            
-            # ファイルを保存
-            file.save(file_path)
-            
-            # アップロード記録の作成
-            upload_record = {
-                'filename': filename,
-                'path': file_path,
-                'size': os.path.getsize(file_path),
-                'upload_time': datetime.now().isoformat(),
-                'profile_id': profile_id
-            }
-            
-            # アップロード記録をJSON形式で保存
-            uploads_json = os.path.join(upload_dir, 'uploads.json')
-            uploads = []
-            
-            if os.path.exists(uploads_json):
-                try:
-                    with open(uploads_json, 'r', encoding='utf-8') as f:
-                        uploads = json.load(f)
-                except Exception as e:
-                    logger.error(f"Failed to load uploads.json: {str(e)}")
-            
-            uploads.append(upload_record)
-            
-            with open(uploads_json, 'w', encoding='utf-8') as f:
-                json.dump(uploads, f, ensure_ascii=False, indent=2)
+            temp_path, sha256 = BLOB_STORE.spool(file.stream)
+            try:
+                with _blob_lock:
+                    blob, existed = BLOB_STORE.add_file(temp_path, sha256)
+                    
+                    # アップロード記録の作成
+                    upload_record, duplicate = record_upload(upload_dir, filename, blob, profile_id)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
             
-            logger.info(f"File uploaded: {filename} to {upload_dir}")
+            logger.info(f"File uploaded: {upload_record['filename']} to {upload_dir} "
+                        f"(sha256 {blob['sha256'][:12]}, {'deduplicated' if existed else 'stored'})")
             
             return jsonify({
                 'status': 'success',
-                'message': f'ファイル "{filename}" をアップロードしました',
-                'file': upload_record
+                'message': f'ファイル "{upload_record["filename"]}" をアップロードしました',
+                'file': upload_record,
+                'deduplicated': existed,
+                'duplicate': duplicate
             })
             
         except Exception as e:
@@ -111,34 +168,51 @@ def register_routes(app: Flask):
     def get_uploads():
         """
         アップロードされたファイルの一覧を取得するエンドポイント
+        ?limit=50&cursor=...&sort=upload_time|filename|size&order=asc|desc でページごとに取得する
+        （limitを省略した場合はすべて）。?filename= や ?sha256= で1件ずつ探すこともできる
         """
         try:
             # プロファイルが指定されている場合はプロファイル専用のアップロードディレクトリを使用
-            profile_id = request.args.get('profile_id', ACTIVE_PROFILE)
-            
-            if profile_id:
-                upload_dir = os.path.join(PROFILES_DIR, profile_id, 'uploads')
-            else:
-                upload_dir = UPLOAD_FOLDER
+            profile_id = request.args.get('profile_id', app_config.ACTIVE_PROFILE)
+            upload_dir = get_upload_dir(profile_id)
             
             # アップロードディレクトリが存在しない場合
             if not os.path.exists(upload_dir):
                 return jsonify({
                     'uploads': [],
                     'count': 0,
+                    'total': 0,
+                    'next_cursor': None,
+                    'has_more': False,
                     'upload_dir': upload_dir
                 })
             
-            # アップロード記録がある場合は読み込む
-            uploads_json = os.path.join(upload_dir, 'uploads.json')
-            uploads = []
+            manifest = get_upload_manifest(upload_dir)
+            sort = request.args.get('sort', 'upload_time')
+            order = request.args.get('order', 'asc')
+            if sort not in UPLOAD_SORTS or order not in ('asc', 'desc'):
+                return jsonify({
+                    'error': f"sortには{', '.join(UPLOAD_SORTS)}、orderにはascまたはdescを指定してください"
+                }), 400
             
-            if os.path.exists(uploads_json):
+            next_cursor = None
+            if request.args.get('filename'):
+                upload = manifest.get(request.args['filename'])
+                uploads = [upload] if upload else []
+            elif request.args.get('sha256'):
+                uploads = manifest.find_by_sha256(request.args['sha256'].lower())
+            else:
+                limit = request.args.get('limit', type=int)
+                if limit is not None:
+                    limit = max(1, min(limit, 1000))
                 try:
-                    with open(uploads_json, 'r', encoding='utf-8') as f:
-                        uploads = json.load(f)
-                except Exception as e:
-                    logger.error(f"Failed to load uploads.json: {str(e)}")
+                    uploads, next_cursor = manifest.list_page(
+                        limit=limit, after=request.args.get('cursor'), sort=sort, descending=order == 'desc'
+                    )
+                except ValueError:
+                    return jsonify({
+                        'error': 'カーソルが正しくありません。最初のページから取得し直してください'
+                    }), 400
             
             # ファイルの存在確認を行う
             valid_uploads = []
@@ -150,6 +224,9 @@ def register_routes(app: Flask):
             return jsonify({
                 'uploads': valid_uploads,
                 'count': len(valid_uploads),
+                'total': manifest.count(),
+                'next_cursor': next_cursor,
+                'has_more': next_cursor is not None,
                 'upload_dir': upload_dir
             })
             
@@ -167,12 +244,19 @@ def register_routes(app: Flask):
         """
         try:
             # プロファイルが指定されている場合はプロファイル専用のアップロードディレクトリを使用
-            profile_id = request.args.get('profile_id', ACTIVE_PROFILE)
+            profile_id = request.args.get('profile_id', app_config.ACTIVE_PROFILE)
             
-            if profile_id:
-                upload_dir = os.path.join(PROFILES_DIR, profile_id, 'uploads')
-            else:
-                upload_dir = UPLOAD_FOLDER
+            upload_dir = get_upload_dir(profile_id)
+            
+            # ブロブストアに保存したファイルは、記録の名前でダウンロードさせる
+            upload = get_upload_manifest(upload_dir).get(filename) if os.path.isdir(upload_dir) else None
+            if upload and is_sha256(upload.get('sha256')):
+                blob_path = BLOB_STORE.path_of(upload['sha256'])
+                if not os.path.exists(blob_path):
+                    return jsonify({
+                        'error': f'ファイル "{filename}" が見つかりません'
+                    }), 404
+                return send_file(blob_path, as_attachment=True, download_name=filename)
             
             # ファイルの存在確認
             file_path = os.path.join(upload_dir, filename)
@@ -202,37 +286,27 @@ def register_routes(app: Flask):
         """
         try:
             # プロファイルが指定されている場合はプロファイル専用のアップロードディレクトリを使用
-            profile_id = request.args.get('profile_id', ACTIVE_PROFILE)
+            profile_id = request.args.get('profile_id', app_config.ACTIVE_PROFILE)
             
-            if profile_id:
-                upload_dir = os.path.join(PROFILES_DIR, profile_id, 'uploads')
-            else:
-                upload_dir = UPLOAD_FOLDER
-            
-            # ファイルの存在確認
+            upload_dir = get_upload_dir(profile_id)
             file_path = os.path.join(upload_dir, filename)
-            if not os.path.exists(file_path):
-                return jsonify({
-                    'error': f'ファイル "{filename}" が見つかりません'
-                }), 404
-            
-            # ファイルを削除
-            os.remove(file_path)
             
-            # アップロード記録から削除
-            uploads_json = os.path.join(upload_dir, 'uploads.json')
-            if os.path.exists(uploads_json):
-                try:
-                    with open(uploads_json, 'r', encoding='utf-8') as f:
-                        uploads = json.load(f)
-                    
-                    # 対象ファイルを除外
-                    uploads = [u for u in uploads if u.get('filename') != filename]
-                    
-                    with open(uploads_json, 'w', encoding='utf-8') as f:
-                        json.dump(uploads, f, ensure_ascii=False, indent=2)
-                except Exception as e:
-                    logger.error(f"Failed to update uploads.json: {str(e)}")
+            with _blob_lock:
+                # アップロード記録から削除
+                removed = get_upload_manifest(upload_dir).remove(filename) if os.path.isdir(upload_dir) else None
+                
+                # ファイルの存在確認
+                if removed is None and not os.path.exists(file_path):
+                    return jsonify({
+                        'error': f'ファイル "{filename}" が見つかりません'
+                    }), 404
+                
+                # ブロブストアのファイルは参照を戻し（他に参照が無ければ削除される）、
+                # 以前の形式で保存したファイルはそのまま削除する
+                if removed is not None and is_sha256(removed.get('sha256')):
+                    BLOB_STORE.release(removed['sha256'])
+                if os.path.exists(file_path):
+                    os.remove(file_path)
             
             logger.info(f"File deleted: {filename} from {upload_dir}")
             
@@ -252,9 +326,11 @@ def register_routes(app: Flask):
     def import_data():
         """
         アップロードされたファイルからデータをインポートするエンドポイント
+        インポートはジョブとして待ち行列に入れ、結果を待たずにジョブのIDを返す（202）
+        既存のメモリとほぼ同じ内容のメモリは、on_duplicate（省略時は設定のMEMORY_DEDUP_ON_IMPORT）に従って扱う
         """
         try:
-            if not ACTIVE_PROFILE:
+            if not app_config.ACTIVE_PROFILE:
                 return jsonify({
                     'error': 'アクティブなプロファイルが選択されていません'
                 }), 400
@@ -262,11 +338,20 @@ def register_routes(app: Flask):
             data = request.json
             file_path = data.get('file_path')
             import_type = data.get('type', 'memory')
+            on_duplicate = data.get('on_duplicate', MEMORY_DEDUP_ON_IMPORT)
             
             if not file_path:
                 return jsonify({
                     'error': 'ファイルパスが指定されていません'
                 }), 400
+            if on_duplicate not in DUPLICATE_MODES:
+                return jsonify({
+                    'error': f"on_duplicateには{', '.join(DUPLICATE_MODES)}のいずれかを指定してください"
+                }), 400
+            if import_type not in IMPORT_TYPES:
+                return jsonify({
+                    'error': f'サポートされていないインポートタイプです: {import_type}'
+                }), 400
             
             # ファイルの存在確認
             if not os.path.exists(file_path):
@@ -274,159 +359,398 @@ def register_routes(app: Flask):
                     'error': f'ファイル "{file_path}" が見つかりません'
                 }), 404
             
-            # ファイルの種類ごとの処理
-            file_ext = os.path.splitext(file_path)[1].lower()
+            # ファイルの種類の確認
+            # （ブロブストアのファイルには拡張子が無いため、アップロード記録の名前から判定する）
+            upload_dir = get_upload_dir(app_config.ACTIVE_PROFILE)
+            upload = get_upload_manifest(upload_dir).find_by_path(file_path) if os.path.isdir(upload_dir) else None
+            source_name = data.get('filename') or (upload or {}).get('filename') or os.path.basename(file_path)
+            file_ext = os.path.splitext(source_name)[1].lower()
             
-            if import_type == 'memory':
-                # メモリにインポート
-                memory_dir = os.path.join(PROFILES_DIR, ACTIVE_PROFILE, 'memory')
-                if not os.path.exists(memory_dir):
-                    os.makedirs(memory_dir, exist_ok=True)
-                
-                # テキストファイルの場合
-                if file_ext in ['.txt', '.md']:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    # メモリファイルの読み込み
-                    memories = []
-                    memory_file = os.path.join(memory_dir, 'memories.json')
-                    
-                    if os.path.exists(memory_file):
-                        try:
-                            with open(memory_file, 'r', encoding='utf-8') as f:
-                                memories = json.load(f)
-                        except Exception as e:
-                            logger.error(f"Failed to load memories file: {str(e)}")
-                    
-                    # 新しいメモリを作成
-                    new_memory = {
-                        'id': str(len(memories) + 1),
-                        'content': content,
-                        'type': 'imported',
-                        'tags': ['imported', os.path.basename(file_path)],
-                        'created_at': datetime.now().isoformat(),
-                        'strength': 1.0
-                    }
-                    
-                    # メモリリストに追加
-                    memories.append(new_memory)
-                    
-                    # メモリを保存
-                    with open(memory_file, 'w', encoding='utf-8') as f:
-                        json.dump(memories, f, ensure_ascii=False, indent=2)
-                    
-                    return jsonify({
-                        'status': 'success',
-                        'message': f'ファイル "{os.path.basename(file_path)}" をメモリにインポートしました',
-                        'memory': new_memory
-                    })
-                
-                # JSONファイルの場合
-                elif file_ext == '.json':
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        imported_data = json.load(f)
-                    
-                    # メモリファイルの読み込み
-                    memories = []
-                    memory_file = os.path.join(memory_dir, 'memories.json')
-                    
-                    if os.path.exists(memory_file):
-                        try:
-                            with open(memory_file, 'r', encoding='utf-8') as f:
-                                memories = json.load(f)
-                        except Exception as e:
-                            logger.error(f"Failed to load memories file: {str(e)}")
-                    
-                    # インポートした項目のカウント
-                    imported_count = 0
-                    
-                    # インポートしたデータの処理
-                    if isinstance(imported_data, list):
-                        # リスト形式の場合はそのまま追加
-                        for item in imported_data:
-                            if 'content' in item:
-                                next_id = len(memories) + 1
-                                new_memory = {
-                                    'id': str(next_id),
-                                    'content': item['content'],
-                                    'type': item.get('type', 'imported'),
-                                    'tags': item.get('tags', ['imported']),
-                                    'created_at': item.get('created_at', datetime.now().isoformat()),
-                                    'strength': item.get('strength', 1.0)
-                                }
-                                memories.append(new_memory)
-                                imported_count += 1
-                    else:
-                        # 単一オブジェクトの場合
-                        if 'content' in imported_data:
-                            new_memory = {
-                                'id': str(len(memories) + 1),
-                                'content': imported_data['content'],
-                                'type': imported_data.get('type', 'imported'),
-                                'tags': imported_data.get('tags', ['imported']),
-                                'created_at': imported_data.get('created_at', datetime.now().isoformat()),
-                                'strength': imported_data.get('strength', 1.0)
-                            }
-                            memories.append(new_memory)
-                            imported_count = 1
-                    
-                    # メモリを保存
-                    with open(memory_file, 'w', encoding='utf-8') as f:
-                        json.dump(memories, f, ensure_ascii=False, indent=2)
-                    
-                    return jsonify({
-                        'status': 'success',
-                        'message': f'ファイル "{os.path.basename(file_path)}" をメモリにインポートしました',
-                        'count': imported_count
-                    })
-                
-                else:
-                    return jsonify({
-                        'error': f'サポートされていないファイル形式です: {file_ext}'
-                    }), 400
-            
-            elif import_type == 'config':
-                # プロファイル設定にインポート
-                config_path = os.path.join(PROFILES_DIR, ACTIVE_PROFILE, 'config.json')
-                
-                # JSONファイルの場合のみサポート
-                if file_ext != '.json':
-                    return jsonify({
-                        'error': f'設定インポートはJSONファイルのみサポートしています: {file_ext}'
-                    }), 400
-                
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    imported_config = json.load(f)
-                
-                # 既存の設定を読み込む
-                if os.path.exists(config_path):
-                    with open(config_path, 'r', encoding='utf-8') as f:
-                        current_config = json.load(f)
-                    
-                    # インポートしたデータでマージ
-                    current_config.update(imported_config)
-                    
-                    # 設定を保存
-                    with open(config_path, 'w', encoding='utf-8') as f:
-                        json.dump(current_config, f, ensure_ascii=False, indent=2)
-                else:
-                    # 設定ファイルがない場合は新規作成
-                    with open(config_path, 'w', encoding='utf-8') as f:
-                        json.dump(imported_config, f, ensure_ascii=False, indent=2)
-                
+            if import_type == 'memory' and file_ext == '.doc':
                 return jsonify({
-                    'status': 'success',
-                    'message': f'ファイル "{os.path.basename(file_path)}" をプロファイル設定にインポートしました'
-                })
-            
-            else:
+                    'error': '旧形式のWord文書（.doc）は読み込めません。DOCX形式で保存し直してからインポートしてください'
+                }), 400
+            if import_type == 'memory' and file_ext not in MEMORY_EXTENSIONS:
                 return jsonify({
-                    'error': f'サポートされていないインポートタイプです: {import_type}'
+                    'error': f'サポートされていないファイル形式です: {file_ext}'
                 }), 400
+            if import_type == 'config' and file_ext != '.json':
+                return jsonify({
+                    'error': f'設定インポートはJSONファイルのみサポートしています: {file_ext}'
+                }), 400
+            
+            job = IMPORT_JOBS.submit(
+                app_config.ACTIVE_PROFILE, import_type, file_path, source_name,
+                on_duplicate=on_duplicate, sha256=(upload or {}).get('sha256')
+            )
+            return jsonify({
+                'status': 'accepted',
+                'message': f'ファイル "{source_name}" のインポートを開始しました',
+                'job_id': job['id'],
+                'job': job,
+                'status_url': f"/api/upload/import/jobs/{job['id']}",
+                'events_url': f"/api/upload/import/jobs/{job['id']}/events"
+            }), 202
             
         except Exception as e:
             logger.exception(f"Error importing data: {str(e)}")
             return jsonify({
                 'error': f"データのインポート中にエラーが発生しました: {str(e)}"
             }), 500
+
+
+    @app.route('/api/upload/import/jobs', methods=['GET'])
+    def get_import_jobs():
+        """インポートジョブの一覧を取得するエンドポイント（?profile_id=...&state=...&limit=50 で絞り込み）"""
+        try:
+            limit = max(1, min(int(request.args.get('limit', 50)), 500))
+            return jsonify({'jobs': IMPORT_JOBS.list_jobs(
+                profile_id=request.args.get('profile_id'), state=request.args.get('state'), limit=limit
+            )})
+            
+        except ValueError:
+            return jsonify({
+                'error': 'limitには整数を指定してください'
+            }), 400
+        except Exception as e:
+            logger.exception(f"Error listing import jobs: {str(e)}")
+            return jsonify({
+                'error': f"インポートジョブの一覧の取得中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/upload/import/jobs/<job_id>', methods=['GET'])
+    def get_import_job(job_id):
+        """
+        インポートジョブの状態を取得するエンドポイント
+        stateはqueued・running・completed・failed・cancelledのいずれかで、
+        bytes_read・items_processed・progressで進捗を、resultでインポートの結果を確認できる
+        """
+        try:
+            job = IMPORT_JOBS.get(job_id)
+            if job is None:
+                return jsonify({
+                    'error': f'インポートジョブ "{job_id}" が見つかりません'
+                }), 404
+            return jsonify(job)
+            
+        except Exception as e:
+            logger.exception(f"Error getting import job: {str(e)}")
+            return jsonify({
+                'error': f"インポートジョブの状態の取得中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/upload/import/jobs/<job_id>/cancel', methods=['POST'])
+    def cancel_import_job(job_id):
+        """インポートジョブをキャンセルするエンドポイント（キャンセルまでに保存したメモリは残る）"""
+        try:
+            job = IMPORT_JOBS.cancel(job_id)
+            if job is None:
+                return jsonify({
+                    'error': f'インポートジョブ "{job_id}" が見つかりません'
+                }), 404
+            return jsonify(job)
+            
+        except Exception as e:
+            logger.exception(f"Error cancelling import job: {str(e)}")
+            return jsonify({
+                'error': f"インポートジョブのキャンセル中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/upload/import/jobs/<job_id>/events', methods=['GET'])
+    def import_job_events(job_id):
+        """
+        インポートジョブの状態をServer-Sent Eventsで送信するエンドポイント
+        状態が変わるたびにジョブの状態を送り、ジョブが終了したら接続を閉じる
+        """
+        if IMPORT_JOBS.get(job_id) is None:
+            return jsonify({
+                'error': f'インポートジョブ "{job_id}" が見つかりません'
+            }), 404
+        
+        def generate():
+            last, idle = None, 0.0
+            while True:
+                job = IMPORT_JOBS.get(job_id)
+                if job is None:
+                    return
+                if job != last:
+                    yield f"data: {json.dumps(job, ensure_ascii=False)}\n\n"
+                    last, idle = job, 0.0
+                    if job['state'] in FINISHED_STATES:
+                        return
+                elif idle >= IMPORT_JOB_KEEPALIVE:
+                    # 接続が切れていないことをプロキシやブラウザに伝える
+                    yield ": keepalive\n\n"
+                    idle = 0.0
+                time.sleep(IMPORT_JOB_EVENT_INTERVAL)
+                idle += IMPORT_JOB_EVENT_INTERVAL
+        
+        response = Response(generate(), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+
+    def _session_response(state, **extra):
+        """分割アップロードの状態のうち、クライアントに返す項目"""
+        response = {
+            'upload_id': state['upload_id'],
+            'filename': state['filename'],
+            'size': state['size'],
+            'received': state['received'],
+            'target': state['metadata'].get('target'),
+            'chunk_size': UPLOAD_CHUNK_SIZE
+        }
+        response.update(extra)
+        return response
+
+
+    @app.route('/api/upload/sessions', methods=['POST'])
+    def create_upload_session():
+        """
+        分割アップロードを開始するエンドポイント
+        {"filename", "size", "sha256"（任意）, "target": "upload" | "workspace" | "training" | "model", "path"}
+        返されたupload_idに、PUT /api/upload/sessions/<upload_id>?offset=<受信済みのサイズ> でデータを順に送る
+        """
+        try:
+            data = request.json or {}
+            filename = secure_filename(data.get('filename') or '')
+            target = data.get('target', 'upload')
+            profile_id = data.get('profile_id', app_config.ACTIVE_PROFILE)
+            
+            if not filename:
+                return jsonify({
+                    'error': 'ファイル名が空です'
+                }), 400
+            try:
+                size = int(data.get('size'))
+            except (TypeError, ValueError):
+                size = -1
+            if size < 0:
+                return jsonify({
+                    'error': 'ファイルのサイズ（size）を0以上の整数で指定してください'
+                }), 400
+            
+            destination, error, status = resolve_upload_destination(target, profile_id, filename, data.get('path', ''))
+            if destination is None:
+                return jsonify({'error': error}), status
+            
+            # sha256は完了時のチェックサムの確認にだけ使い、重複の判定はデータを受け取った後に行う
+            # （ハッシュを知っているだけで他のプロファイルのファイルを参照できないようにする）
+            sha256 = (data.get('sha256') or '').lower() or None
+            
+            try:
+                state = CHUNKED_UPLOADS.create(
+                    filename, size, destination, sha256=sha256,
+                    metadata={'target': target, 'profile_id': profile_id, 'path': data.get('path', '')}
+                )
+            except OSError as e:
+                logger.warning(f"Cannot start chunked upload: {str(e)}")
+                return jsonify({
+                    'error': f'ディスクの空き容量が不足しています: {str(e)}'
+                }), 507
+            
+            return jsonify(_session_response(state, status='success', completed=False)), 201
+            
+        except Exception as e:
+            logger.exception(f"Error creating upload session: {str(e)}")
+            return jsonify({
+                'error': f"アップロードの開始中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/upload/sessions/<upload_id>', methods=['GET'])
+    def get_upload_session(upload_id):
+        """
+        分割アップロードの受信済みのサイズを取得するエンドポイント（中断後の再開位置の確認）
+        """
+        try:
+            return jsonify(_session_response(CHUNKED_UPLOADS.get(upload_id)))
+            
+        except UploadNotFoundError:
+            return jsonify({
+                'error': f'アップロード {upload_id} が見つかりません'
+            }), 404
+        except Exception as e:
+            logger.exception(f"Error getting upload session: {str(e)}")
+            return jsonify({
+                'error': f"アップロードの状態の取得中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/upload/sessions/<upload_id>', methods=['PUT'])
+    def put_upload_chunk(upload_id):
+        """
+        分割アップロードのデータを送るエンドポイント
+        本文はファイルのデータそのもの（multipartではない）で、?offset= には受信済みのサイズを指定する
+        X-Chunk-SHA256 ヘッダーを付けた場合は、この送信分のチェックサムを確かめる
+        """
+        try:
+            offset = request.args.get('offset', request.headers.get('Upload-Offset'), type=int)
+            if offset is None or offset < 0:
+                return jsonify({
+                    'error': '送信する位置（offset）を0以上の整数で指定してください'
+                }), 400
+            
+            # 本文はリクエストのストリームから直接一時ファイルに書き込む
+            state = CHUNKED_UPLOADS.write_chunk(
+                upload_id, offset, request.stream,
+                length=request.content_length, sha256=request.headers.get('X-Chunk-SHA256')
+            )
+            return jsonify(_session_response(state, status='success'))
+            
+        except UploadNotFoundError:
+            return jsonify({
+                'error': f'アップロード {upload_id} が見つかりません'
+            }), 404
+        except UploadOffsetError as e:
+            return jsonify({
+                'error': f'送信する位置が受信済みのサイズ（{e.received}バイト）と一致しません',
+                'received': e.received
+            }), 409
+        except UploadChecksumError as e:
+            return jsonify({
+                'error': f'受信したデータが正しくありません。同じ位置から送り直してください: {str(e)}'
+            }), 422
+        except Exception as e:
+            logger.exception(f"Error receiving upload chunk: {str(e)}")
+            return jsonify({
+                'error': f"データの受信中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/upload/sessions/<upload_id>/complete', methods=['POST'])
+    def complete_upload_session(upload_id):
+        """
+        分割アップロードを完了するエンドポイント
+        サイズとファイル全体のチェックサムを確かめてから保存先に移動する
+        """
+        try:
+            stored = {}
+            
+            def store_blob(part_path, state):
+                # 受信したファイルはブロブストアに移す（同じ内容が既にあれば捨てる）
+                stored['blob'], stored['existed'] = BLOB_STORE.add_file(part_path, state['sha256'])
+                return BLOB_STORE.path_of(state['sha256'])
+            
+            session = CHUNKED_UPLOADS.get(upload_id)
+            if session['metadata'].get('target') == 'upload':
+                with _blob_lock:
+                    final_path, state = CHUNKED_UPLOADS.complete(upload_id, finalize=store_blob)
+                    stored['file'], stored['duplicate'] = record_upload(
+                        state['destination'], state['filename'], stored['blob'], state['metadata'].get('profile_id')
+                    )
+            else:
+                final_path, state = CHUNKED_UPLOADS.complete(upload_id)
+            metadata = state['metadata']
+            response = {
+                'status': 'success',
+                'message': f'ファイル "{state["filename"]}" をアップロードしました',
+                'filename': state['filename'],
+                'path': final_path,
+                'size': state['size'],
+                'sha256': state['sha256'],
+                'target': metadata.get('target')
+            }
+            if metadata.get('target') == 'upload':
+                response['file'], response['duplicate'] = stored['file'], stored['duplicate']
+                response['filename'] = response['file']['filename']
+                response['deduplicated'] = stored['existed']
+            elif metadata.get('target') == 'workspace':
+                path = metadata.get('path')
+                response['path'] = os.path.join(path, state['filename']) if path else state['filename']
+            return jsonify(response)
+            
+        except UploadNotFoundError:
+            return jsonify({
+                'error': f'アップロード {upload_id} が見つかりません'
+            }), 404
+        except UploadChecksumError as e:
+            return jsonify({
+                'error': f'アップロードを完了できません: {str(e)}'
+            }), 422
+        except Exception as e:
+            logger.exception(f"Error completing upload session: {str(e)}")
+            return jsonify({
+                'error': f"アップロードの完了中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/upload/sessions/<upload_id>', methods=['DELETE'])
+    def abort_upload_session(upload_id):
+        """
+        分割アップロードを中止し、受信済みのデータを破棄するエンドポイント
+        """
+        try:
+            if not CHUNKED_UPLOADS.abort(upload_id):
+                return jsonify({
+                    'error': f'アップロード {upload_id} が見つかりません'
+                }), 404
+            
+            return jsonify({
+                'status': 'success',
+                'message': 'アップロードを中止しました'
+            })
+            
+        except UploadNotFoundError:
+            return jsonify({
+                'error': f'アップロード {upload_id} が見つかりません'
+            }), 404
+        except Exception as e:
+            logger.exception(f"Error aborting upload session: {str(e)}")
+            return jsonify({
+                'error': f"アップロードの中止中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/uploads/gc', methods=['POST'])
+    def collect_upload_garbage():
+        """
+        参照数が0になったブロブを削除するエンドポイント
+        参照数はすべてのプロファイルのアップロード記録から数え直すが、記録が1つも見つからないブロブの参照数は下げない
+        """
+        try:
+            with _blob_lock:
+                stats = BLOB_STORE.collect_garbage(count_blob_references())
+            stats.update(BLOB_STORE.get_stats())
+            
+            return jsonify(dict(stats, status='success'))
+            
+        except Exception as e:
+            logger.exception(f"Error collecting upload garbage: {str(e)}")
+            return jsonify({
+                'error': f"不要なファイルの削除中にエラーが発生しました: {str(e)}"
+            }), 500
+
+
+    @app.route('/api/uploads/rescan', methods=['POST'])
+    def rescan_uploads():
+        """
+        アップロード記録をディレクトリの内容から作り直すエンドポイント
+        {"profile_id": "..."} で対象のプロファイルを指定する（省略時はアクティブなプロファイル）
+        {"all": true} ですべてのプロファイルと共通のディレクトリを対象にする
+        """
+        try:
+            data = request.json or {}
+            if data.get('all'):
+                upload_dirs = list(iter_upload_dirs())
+            else:
+                upload_dirs = [get_upload_dir(data.get('profile_id', app_config.ACTIVE_PROFILE))]
+            
+            with _blob_lock:
+                results = rescan_upload_dirs(upload_dirs)
+            
+            return jsonify({
+                'status': 'success',
+                'message': f'{len(results)}件のアップロードディレクトリを確認しました',
+                'results': results
+            })
+            
+        except Exception as e:
+            logger.exception(f"Error rescanning uploads: {str(e)}")
+            return jsonify({
+                'error': f"アップロード記録の修復中にエラーが発生しました: {str(e)}"
+            }), 500
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - ブロブストア
+アップロードされたファイルを内容のハッシュ（SHA-256）をキーにして1つだけ保存するモジュール
+同じ内容のファイルは何度アップロードされても1つのファイルを参照し、参照数が0になったら削除する
+"""
+
+import os
+import re
+import time
+import uuid
+import sqlite3
+import shutil
+import hashlib
+import threading
+from config import logger, BLOB_STORE_DIR
+
+# ストリームを読み込んでハッシュを計算する単位
+COPY_BUFFER_SIZE = 1024 * 1024
+_SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    origin_dir TEXT,
+    origin_name TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_blobs_refcount ON blobs (refcount);
+"""
+
+
+def is_sha256(value):
+    return bool(value) and bool(_SHA256.match(str(value)))
+
+
+class BlobStore:
+    """
+    内容のハッシュをキーにしたファイルの保存先（<ハッシュの先頭2文字>/<ハッシュ>）と、
+    ブロブごとの参照数を記録するSQLiteの索引を管理するクラス
+    """
+
+    def __init__(self, root=BLOB_STORE_DIR):
+        self.root = root
+        self.db_path = os.path.join(root, 'blobs.db')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._initialized = False
+        self._removal_listeners = []
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(self.root, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            if not self._initialized:
+                conn.executescript(_SCHEMA)
+                # 以前の形式の索引には、最初のアップロード記録の場所が無い
+                columns = {row['name'] for row in conn.execute("PRAGMA table_info(blobs)")}
+                for column in ('origin_dir', 'origin_name'):
+                    if column not in columns:
+                        conn.execute(f"ALTER TABLE blobs ADD COLUMN {column} TEXT")
+                self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    def path_of(self, sha256):
+        """ブロブのファイルのパス"""
+        if not is_sha256(sha256):
+            raise ValueError(f"Invalid sha256: {sha256}")
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def get(self, sha256):
+        """ブロブの情報（{'sha256', 'size', 'refcount', 'created_at'}）。無い場合はNone"""
+        if not is_sha256(sha256):
+            return None
+        row = self._connect().execute("SELECT * FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is None or not os.path.exists(self.path_of(sha256)):
+            return None
+        return dict(row)
+
+    def add_file(self, path, sha256=None):
+        """
+        ファイルをブロブとして登録し、参照を1つ増やす（pathのファイルは移動または削除される）
+        同じ内容のブロブが既にある場合はファイルを捨て、既存のブロブを参照する
+        戻り値は (ブロブの情報, 既存のブロブだったか)
+        """
+        if sha256 is None:
+            sha256 = hash_file(path)
+        size = os.path.getsize(path)
+        blob_path = self.path_of(sha256)
+        with self._lock:
+            conn = self._connect()
+            existed = self.get(sha256) is not None
+            if existed:
+                os.remove(path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                # 同じファイルシステム内なら名前の変更だけで済み、データを書き直さない
+                shutil.move(path, blob_path)
+            conn.execute(
+                "INSERT INTO blobs (sha256, size, refcount, created_at) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT (sha256) DO UPDATE SET refcount = refcount + 1",
+                (sha256, size, time.time())
+            )
+            blob = dict(conn.execute("SELECT * FROM blobs WHERE sha256 = ?", (sha256,)).fetchone())
+        return blob, existed
+
+    def set_origin(self, sha256, upload_dir, filename):
+        """
+        ブロブを最初に参照したアップロード記録の場所を記録する（既に記録がある場合は何もしない）
+        アップロード記録が失われたときに、記録を作り直す場所として使う
+        """
+        with self._lock:
+            self._connect().execute(
+                "UPDATE blobs SET origin_dir = ?, origin_name = ? WHERE sha256 = ? AND origin_name IS NULL",
+                (upload_dir, filename, sha256)
+            )
+
+    def ensure_referenced(self, sha256):
+        """作り直したアップロード記録の分として、参照数を1以上にする"""
+        with self._lock:
+            self._connect().execute(
+                "UPDATE blobs SET refcount = MAX(refcount, 1) WHERE sha256 = ?", (sha256,))
+
+    def list_blobs(self):
+        """
+        すべてのブロブの情報を返す
+        索引に無いブロブのファイル（索引が失われた場合など）は、参照数1のブロブとして索引に登録してから返す
+        """
+        with self._lock:
+            conn = self._connect()
+            known = {row['sha256'] for row in conn.execute("SELECT sha256 FROM blobs")}
+            for sha256, path in self._iter_blob_files():
+                if sha256 not in known:
+                    conn.execute(
+                        "INSERT INTO blobs (sha256, size, refcount, created_at) VALUES (?, ?, 1, ?)",
+                        (sha256, os.path.getsize(path), os.path.getmtime(path))
+                    )
+                    logger.warning(f"Registered untracked blob file: {sha256}")
+            return [dict(row) for row in conn.execute("SELECT * FROM blobs ORDER BY created_at")]
+
+    def _iter_blob_files(self):
+        if not os.path.isdir(self.root):
+            return
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if is_sha256(name):
+                    yield name, os.path.join(prefix_dir, name)
+
+    def spool(self, stream):
+        """
+        ストリームをブロブストア内の一時ファイルに書き込みながらハッシュを計算する
+        戻り値は (一時ファイルのパス, ハッシュ)。add_fileで登録するか、呼び出し側で削除する
+        """
+        temp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(temp_dir, exist_ok=True)
+        temp_path = os.path.join(temp_dir, uuid.uuid4().hex)
+        hasher = hashlib.sha256()
+        try:
+            with open(temp_path, 'wb') as f:
+                while True:
+                    data = stream.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    hasher.update(data)
+                    f.write(data)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path, hasher.hexdigest()
+
+    def add_removal_listener(self, callback):
+        """
+        ブロブを削除したときに呼ばれるフックを登録する
+        callback(sha256) の形式で呼び出される
+        """
+        with self._lock:
+            self._removal_listeners.append(callback)
+
+    def _notify_removed(self, removed):
+        with self._lock:
+            listeners = list(self._removal_listeners)
+        for sha256 in removed:
+            for callback in listeners:
+                try:
+                    callback(sha256)
+                except Exception as e:
+                    logger.exception(f"Error in blob removal listener: {str(e)}")
+
+    def release(self, sha256):
+        """
+        ブロブへの参照を1つ減らし、参照が無くなったらファイルを削除する
+        削除した場合はTrue
+        """
+        if not is_sha256(sha256):
+            return False
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE blobs SET refcount = MAX(refcount - 1, 0) WHERE sha256 = ?", (sha256,))
+            row = conn.execute("SELECT refcount FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+            if row is None or row['refcount'] > 0:
+                return False
+            self._remove(conn, sha256)
+        self._notify_removed([sha256])
+        return True
+
+    def _remove(self, conn, sha256):
+        conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        blob_path = self.path_of(sha256)
+        if os.path.exists(blob_path):
+            os.remove(blob_path)
+
+    def collect_garbage(self, references=None):
+        """
+        参照数が0のブロブを削除する
+        referencesに {ハッシュ: 参照数} を渡した場合は、アップロード記録から数えた参照数で索引の参照数を直す
+        ただし記録から1つも参照が見つからないブロブは、記録が失われただけかもしれないため参照数を下げない
+        （rescanで記録を作り直してから数え直す）
+        索引に無いブロブのファイルも削除せず、数だけを返す。戻り値は削除の結果の辞書
+        """
+        stats = {'removed': 0, 'freed_bytes': 0, 'orphan_files': 0, 'corrected': 0, 'unaccounted': 0}
+        removed = []
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if references is not None:
+                    for row in conn.execute("SELECT sha256, refcount FROM blobs").fetchall():
+                        count = references.get(row['sha256'], 0)
+                        if count == 0 and row['refcount'] > 0:
+                            stats['unaccounted'] += 1
+                        elif count != row['refcount']:
+                            conn.execute("UPDATE blobs SET refcount = ? WHERE sha256 = ?", (count, row['sha256']))
+                            stats['corrected'] += 1
+                for row in conn.execute("SELECT sha256, size FROM blobs WHERE refcount <= 0").fetchall():
+                    self._remove(conn, row['sha256'])
+                    removed.append(row['sha256'])
+                    stats['removed'] += 1
+                    stats['freed_bytes'] += row['size']
+                known = {row['sha256'] for row in conn.execute("SELECT sha256 FROM blobs")}
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            stats['orphan_files'] = sum(1 for sha256, _ in self._iter_blob_files() if sha256 not in known)
+        self._notify_removed(removed)
+        if stats['unaccounted'] or stats['orphan_files']:
+            logger.warning(f"Blob garbage collection kept {stats['unaccounted']} blobs without upload records and "
+                           f"{stats['orphan_files']} untracked blob files; run an upload rescan to recover them")
+        if stats['removed']:
+            logger.info(f"Blob garbage collection removed {stats['removed']} blobs ({stats['freed_bytes']} bytes)")
+        return stats
+
+    def get_stats(self):
+        row = self._connect().execute(
+            "SELECT COUNT(*) AS blobs, COALESCE(SUM(size), 0) AS bytes, "
+            "COALESCE(SUM(refcount), 0) AS refcount FROM blobs"
+        ).fetchone()
+        return dict(row)
+
+
+def hash_file(path):
+    """ファイルのSHA-256"""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(COPY_BUFFER_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+BLOB_STORE = BlobStore()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - チャットコンテキスト組み立て
+会話履歴からモデルのコンテキストに収まるプロンプトを組み立て、古い会話を要約するモジュール
+"""
+
+import threading
+from config import (
+    logger, LLAMA_CONTEXT_SIZE, LLAMA_SERVER_PARALLEL, CHAT_MAX_TOKENS, CHAT_SUMMARY_MAX_TOKENS,
+    MEMORY_RAG_ENABLED, MEMORY_RAG_MAX_TOKENS
+)
+from services.conversation_store import CONVERSATION_STORE
+from services.prompt_cache import get_profile_prefix
+from services.llama_server import (
+    generate_llm_response, is_llama_server_available, PRIORITY_BATCH, LlamaServerBusyError
+)
+from services.tokenizer import count_tokens, count_tokens_batch
+from services.memory_retrieval import retrieve_memories
+
+# [INST] などのテンプレート部分のトークン数（メッセージ本文の外側）
+USER_TURN_OVERHEAD = 8
+ASSISTANT_TURN_OVERHEAD = 2
+# 要約用の指示文のために空けておくトークン数
+SUMMARY_INSTRUCTION_TOKENS = 128
+
+
+class MessageTooLongError(ValueError):
+    """今回のメッセージだけでスロットのコンテキストに収まらない"""
+
+    def __init__(self, message_tokens, available_tokens):
+        super().__init__(
+            f"メッセージが長すぎます（{message_tokens}トークン、入力できるのは{available_tokens}トークンまでです）"
+        )
+        self.message_tokens = message_tokens
+        self.available_tokens = available_tokens
+
+
+def get_slot_context_size():
+    """1スロットあたりのコンテキストサイズ（llama-serverは--ctx-sizeを--parallelで分割する）"""
+    return LLAMA_CONTEXT_SIZE // max(1, LLAMA_SERVER_PARALLEL)
+
+
+def format_user_turn(content):
+    return f"[INST] {content} [/INST]"
+
+
+def format_assistant_turn(content):
+    return f" {content}</s>\n"
+
+
+def format_summary(summary):
+    return f"[INST] （これまでの会話の要約）{summary} [/INST]</s>\n"
+
+
+def _message_cost(record):
+    """履歴の1メッセージがプロンプト内で占めるトークン数"""
+    tokens = record.get('tokens')
+    if tokens is None:
+        tokens = count_tokens(record.get('content', ''))
+    overhead = USER_TURN_OVERHEAD if record.get('role') == 'user' else ASSISTANT_TURN_OVERHEAD
+    return tokens + overhead
+
+
+def assemble_chat_prompt(profile_id, conversation_id, message, max_tokens=CHAT_MAX_TOKENS,
+                         use_memories=MEMORY_RAG_ENABLED):
+    """
+    会話履歴と関連するメモリを含めたプロンプトを組み立てる関数
+    プロファイルの固定プレフィックス、要約、直近の会話、関連するメモリ付きの今回のメッセージの順に並べ、
+    応答用のトークンを残してコンテキストに収まるだけ新しい会話を含める
+    メモリはメッセージごとに変わるため、KVキャッシュを再利用できるよう会話履歴の後ろに置く
+    戻り値はプロンプトと組み立て結果の情報を含む辞書
+    メッセージが応答用のトークンを残してコンテキストに収まらない場合はMessageTooLongErrorを送出する
+    """
+    prefix = get_profile_prefix(profile_id)
+    prefix_tokens, message_tokens = count_tokens_batch([prefix, message])
+
+    slot_context = get_slot_context_size()
+    reserve = min(max_tokens, slot_context // 2)
+    available_tokens = slot_context - reserve - prefix_tokens - USER_TURN_OVERHEAD
+    budget = available_tokens - message_tokens
+    if budget < 0:
+        raise MessageTooLongError(message_tokens, max(0, available_tokens))
+
+    # 関連するメモリには残りの半分までを使い、残りを会話履歴に使う
+    retrieval = {'block': '', 'tokens': 0, 'memories': [], 'retrieval_ms': 0.0}
+    if use_memories:
+        try:
+            retrieval = retrieve_memories(profile_id, message, max_tokens=min(MEMORY_RAG_MAX_TOKENS, max(0, budget // 2)))
+        except Exception as e:
+            logger.exception(f"Memory retrieval failed: {str(e)}")
+    budget -= retrieval['tokens']
+    current = format_user_turn(retrieval['block'] + message)
+
+    summary_state = CONVERSATION_STORE.get_summary(profile_id, conversation_id)
+    summary = summary_state.get('summary', '')
+    summarized_until = summary_state.get('summarized_until', 0)
+    if summary:
+        budget -= summary_state.get('tokens') or count_tokens(summary)
+
+    # 新しいメッセージから順に、予算に収まるだけ含める（要約済みのものは含めない）
+    included = []
+    oldest_unsummarized = None
+    for record in CONVERSATION_STORE.iter_reverse(profile_id, conversation_id):
+        if record['index'] < summarized_until:
+            break
+        cost = _message_cost(record)
+        if cost > budget:
+            oldest_unsummarized = record['index']
+            break
+        budget -= cost
+        included.append(record)
+    included.reverse()
+
+    # 質問が欠けたアシスタントの応答から始まらないようにする
+    if included and included[0].get('role') != 'user':
+        dropped = included.pop(0)
+        oldest_unsummarized = dropped['index']
+
+    # 含められなかったメッセージは要約に回す
+    pending = 0
+    if oldest_unsummarized is not None:
+        first_included = included[0]['index'] if included else oldest_unsummarized + 1
+        pending = first_included - summarized_until
+        schedule_summary(profile_id, conversation_id, first_included)
+
+    parts = [prefix]
+    if summary:
+        parts.append(format_summary(summary))
+    for record in included:
+        if record.get('role') == 'user':
+            parts.append(format_user_turn(record['content']))
+        else:
+            parts.append(format_assistant_turn(record['content']))
+    parts.append(current)
+
+    return {
+        'prompt': ''.join(parts),
+        'message_tokens': message_tokens,
+        'history_messages': len(included),
+        'summary_used': bool(summary),
+        'summarized_messages': summarized_until,
+        'pending_summary_messages': pending,
+        'memories_used': retrieval['memories'],
+        'memory_tokens': retrieval['tokens'],
+        'retrieval_ms': retrieval['retrieval_ms'],
+        'max_tokens': reserve
+    }
+
+
+def record_exchange(profile_id, conversation_id, message, response, message_tokens=None, response_tokens=None):
+    """ユーザーのメッセージとアシスタントの応答を会話履歴に追記する関数"""
+    if message_tokens is None or response_tokens is None:
+        counted = count_tokens_batch([message, response])
+        message_tokens = counted[0] if message_tokens is None else message_tokens
+        response_tokens = counted[1] if response_tokens is None else response_tokens
+
+    with CONVERSATION_STORE.lock(profile_id, conversation_id):
+        CONVERSATION_STORE.append(profile_id, conversation_id, 'user', message, tokens=message_tokens)
+        CONVERSATION_STORE.append(profile_id, conversation_id, 'assistant', response, tokens=response_tokens)
+
+
+_SUMMARIZING = set()
+_SUMMARIZING_LOCK = threading.Lock()
+
+
+def schedule_summary(profile_id, conversation_id, upto_index):
+    """
+    upto_index未満のメッセージの要約をバックグラウンドで更新する関数
+    同じ会話の要約が実行中の場合は何もしない
+    """
+    if not is_llama_server_available():
+        return False
+
+    key = (profile_id, conversation_id)
+    with _SUMMARIZING_LOCK:
+        if key in _SUMMARIZING:
+            return False
+        _SUMMARIZING.add(key)
+
+    def run():
+        try:
+            summarize_conversation(profile_id, conversation_id, upto_index)
+        except Exception as e:
+            logger.exception(f"Error summarizing conversation {profile_id}/{conversation_id}: {str(e)}")
+        finally:
+            with _SUMMARIZING_LOCK:
+                _SUMMARIZING.discard(key)
+
+    threading.Thread(target=run, name='conversation-summarizer', daemon=True).start()
+    return True
+
+
+def _build_summary_prompt(summary, records):
+    lines = []
+    for record in records:
+        speaker = 'ユーザー' if record.get('role') == 'user' else 'アシスタント'
+        lines.append(f"{speaker}: {record['content']}")
+    return (
+        "[INST] 以下はこれまでの会話の要約と、その続きの会話です。"
+        "重要な事実、ユーザーの好み、決定事項を残して、全体を一つの簡潔な要約にまとめてください。"
+        "要約だけを出力してください。\n\n"
+        f"要約:\n{summary or 'なし'}\n\n"
+        "続きの会話:\n" + '\n'.join(lines) + " [/INST]"
+    )
+
+
+def summarize_conversation(profile_id, conversation_id, upto_index):
+    """
+    要約済みの位置からupto_index未満のメッセージまでを要約に取り込む関数
+    前回の要約に新しいメッセージだけを加えて更新するため、会話全体を毎回読み直さない
+    コンテキストに収まらない場合は複数回に分けて取り込む
+    """
+    state = CONVERSATION_STORE.get_summary(profile_id, conversation_id)
+    if state.get('summarized_until', 0) >= upto_index:
+        return state
+
+    chunk_budget = get_slot_context_size() - CHAT_SUMMARY_MAX_TOKENS - SUMMARY_INSTRUCTION_TOKENS
+    batch, batch_tokens, offset = [], 0, state.get('offset', 0)
+
+    def fold(batch, next_offset):
+        prompt = _build_summary_prompt(state.get('summary', ''), batch)
+        text, error = generate_llm_response(
+            prompt, temperature=0.2, max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+            priority=PRIORITY_BATCH, use_cache=False
+        )
+        if error or not text:
+            logger.warning(f"Conversation summary was not updated: {error}")
+            return None
+        logger.info(f"Summarized {len(batch)} messages of conversation {profile_id}/{conversation_id}")
+        new_state = {
+            'summary': text.strip(),
+            'tokens': count_tokens(text.strip()),
+            'summarized_until': batch[-1]['index'] + 1,
+            'offset': next_offset
+        }
+        with CONVERSATION_STORE.lock(profile_id, conversation_id):
+            # 要約中に履歴が削除された場合は保存しない
+            if CONVERSATION_STORE.count(profile_id, conversation_id) < new_state['summarized_until']:
+                return None
+            CONVERSATION_STORE.save_summary(profile_id, conversation_id, new_state)
+        return new_state
+
+    try:
+        for next_offset, record in CONVERSATION_STORE.iter_from(profile_id, conversation_id, offset):
+            if record['index'] >= upto_index:
+                break
+            if record['index'] < state.get('summarized_until', 0):
+                offset = next_offset
+                continue
+
+            cost = _message_cost(record)
+            available = chunk_budget - (state.get('tokens') or 0)
+            if batch and batch_tokens + cost > available:
+                state = fold(batch, offset)
+                if state is None:
+                    return None
+                batch, batch_tokens = [], 0
+                available = chunk_budget - (state.get('tokens') or 0)
+
+            if cost > available:
+                # 1件だけでも収まらない長いメッセージは先頭部分だけを要約に使う
+                record = dict(record, content=record['content'][:max(available, 0)])
+                cost = available
+            batch.append(record)
+            batch_tokens += cost
+            offset = next_offset
+
+        if batch:
+            state = fold(batch, offset)
+        return state
+    except LlamaServerBusyError as e:
+        # 混雑している場合は次のリクエストで再試行する
+        logger.info(f"Conversation summary postponed: {str(e)}")
+        return None
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - 分割アップロード
+大きなファイルを複数のリクエストに分けて送り、途中で切れても続きから再開できるアップロードを管理するモジュール
+受信したデータはリクエストごとに一時ファイルへ直接書き込み、メモリにためない
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+from config import logger, UPLOAD_PARTIAL_DIR, UPLOAD_SESSION_TTL
+
+# リクエストの本文を読み込んで書き込む単位
+COPY_BUFFER_SIZE = 1024 * 1024
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadNotFoundError(KeyError):
+    """アップロードが存在しない（完了・破棄・期限切れ）"""
+
+
+class UploadOffsetError(Exception):
+    """送信された位置が、受信済みのサイズと一致しない"""
+
+    def __init__(self, message, received):
+        super().__init__(message)
+        self.received = received
+
+
+class UploadChecksumError(ValueError):
+    """チェックサムやサイズが一致しない"""
+
+
+class ChunkedUploads:
+    """
+    分割アップロードの状態を、一時ファイル（.part）と状態ファイル（.json）で管理するクラス
+    状態はディスクに保存するため、サーバーを再起動しても続きから受信できる
+    """
+
+    def __init__(self, partial_dir=UPLOAD_PARTIAL_DIR):
+        self.partial_dir = partial_dir
+        self._lock = threading.Lock()
+        self._session_locks = {}
+        # 先頭から順に受信したデータのハッシュ（完了時にファイルを読み直さないため）
+        self._hashers = {}
+
+    def _paths(self, upload_id):
+        if not _UPLOAD_ID.match(str(upload_id)):
+            raise UploadNotFoundError(upload_id)
+        base = os.path.join(self.partial_dir, upload_id)
+        return base + '.part', base + '.json'
+
+    def _session_lock(self, upload_id):
+        with self._lock:
+            return self._session_locks.setdefault(upload_id, threading.Lock())
+
+    def _save_state(self, state):
+        _, state_path = self._paths(state['upload_id'])
+        temp_path = state_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(temp_path, state_path)
+
+    def get(self, upload_id):
+        """アップロードの状態を返す"""
+        _, state_path = self._paths(upload_id)
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadNotFoundError(upload_id)
+
+    def create(self, filename, size, destination, sha256=None, metadata=None):
+        """
+        アップロードを開始する
+        destinationは完了時にファイルを置くディレクトリ、sha256はファイル全体のチェックサム（任意）
+        """
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self.purge_expired()
+        free = shutil.disk_usage(self.partial_dir).free
+        if size > free:
+            raise OSError(f"Not enough disk space for upload: {size} bytes requested, {free} bytes free")
+
+        upload_id = uuid.uuid4().hex
+        part_path, _ = self._paths(upload_id)
+        open(part_path, 'wb').close()
+        now = time.time()
+        state = {
+            'upload_id': upload_id,
+            'filename': filename,
+            'size': int(size),
+            'received': 0,
+            'destination': destination,
+            'sha256': sha256.lower() if sha256 else None,
+            'metadata': metadata or {},
+            'created_at': now,
+            'updated_at': now
+        }
+        self._save_state(state)
+        with self._lock:
+            self._hashers[upload_id] = (0, hashlib.sha256())
+        logger.info(f"Chunked upload started: {upload_id} ({filename}, {size} bytes)")
+        return state
+
+    def write_chunk(self, upload_id, offset, stream, length=None, sha256=None):
+        """
+        offsetの位置からstreamのデータを一時ファイルに書き込む
+        offsetは受信済みのサイズと一致する必要がある（一致しない場合はUploadOffsetError）
+        sha256を指定した場合はこの送信分のチェックサムを確かめ、一致しなければ書き込みを取り消す
+        """
+        part_path, _ = self._paths(upload_id)
+        with self._session_lock(upload_id):
+            state = self.get(upload_id)
+            if offset != state['received']:
+                raise UploadOffsetError(
+                    f"Chunk offset {offset} does not match received size {state['received']}", state['received']
+                )
+
+            digest = hashlib.sha256()
+            with self._lock:
+                hashed_offset, hasher = self._hashers.get(upload_id, (None, None))
+            # ファイル全体のハッシュは写しを進め、書き込みが確定したときだけ置き換える
+            running = hasher.copy() if hasher is not None and hashed_offset == offset else None
+            written = 0
+            try:
+                with open(part_path, 'r+b') as f:
+                    f.seek(offset)
+                    while True:
+                        limit = COPY_BUFFER_SIZE if length is None else min(COPY_BUFFER_SIZE, length - written)
+                        if limit <= 0:
+                            break
+                        data = stream.read(limit)
+                        if not data:
+                            break
+                        written += len(data)
+                        if offset + written > state['size']:
+                            raise UploadChecksumError(
+                                f"Chunk exceeds declared file size {state['size']}")
+                        f.write(data)
+                        digest.update(data)
+                        if running is not None:
+                            running.update(data)
+                    if length is not None and written != length:
+                        raise UploadChecksumError(f"Received {written} bytes, expected {length}")
+                    if sha256 and digest.hexdigest() != sha256.lower():
+                        raise UploadChecksumError("Chunk checksum mismatch")
+            except BaseException:
+                # 途中までの書き込みを取り消し、同じ位置から送り直せるようにする
+                with open(part_path, 'r+b') as f:
+                    f.truncate(offset)
+                raise
+
+            if running is not None:
+                with self._lock:
+                    self._hashers[upload_id] = (offset + written, running)
+
+            state['received'] = offset + written
+            state['updated_at'] = time.time()
+            self._save_state(state)
+            return state
+
+    def complete(self, upload_id, filename=None, finalize=None):
+        """
+        すべて受信したアップロードのサイズとチェックサムを確かめ、保存先に移動する
+        finalizeを指定した場合は保存先に移動する代わりに finalize(一時ファイルのパス, 状態) を呼び、
+        その戻り値を保存先のパスとする。移動したファイルのパスと状態を返す
+        """
+        part_path, state_path = self._paths(upload_id)
+        with self._session_lock(upload_id):
+            state = self.get(upload_id)
+            if state['received'] != state['size']:
+                raise UploadChecksumError(f"Upload is incomplete: {state['received']} of {state['size']} bytes")
+
+            with self._lock:
+                hashed_offset, hasher = self._hashers.pop(upload_id, (None, None))
+            if hasher is None or hashed_offset != state['size']:
+                # 再起動などで途中のハッシュが無い場合はファイルから計算する
+                hasher = hashlib.sha256()
+                with open(part_path, 'rb') as f:
+                    _copy_into_hash(f, hasher, state['size'])
+            checksum = hasher.hexdigest()
+            if state.get('sha256') and checksum != state['sha256']:
+                raise UploadChecksumError("File checksum mismatch")
+
+            state['sha256'] = checksum
+            if finalize is not None:
+                final_path = finalize(part_path, state)
+            else:
+                os.makedirs(state['destination'], exist_ok=True)
+                final_path = os.path.join(state['destination'], filename or state['filename'])
+                shutil.move(part_path, final_path)
+            os.remove(state_path)
+        with self._lock:
+            self._session_locks.pop(upload_id, None)
+        logger.info(f"Chunked upload completed: {upload_id} -> {final_path}")
+        return final_path, state
+
+    def abort(self, upload_id):
+        """アップロードを破棄する（破棄できた場合はTrue）"""
+        part_path, state_path = self._paths(upload_id)
+        with self._session_lock(upload_id):
+            existed = os.path.exists(state_path)
+            for path in (part_path, state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+            self._session_locks.pop(upload_id, None)
+        return existed
+
+    def purge_expired(self, ttl=UPLOAD_SESSION_TTL):
+        """更新が無いままttl秒が過ぎたアップロードを破棄する"""
+        if not os.path.isdir(self.partial_dir):
+            return 0
+        purged = 0
+        cutoff = time.time() - ttl
+        for name in os.listdir(self.partial_dir):
+            upload_id, ext = os.path.splitext(name)
+            if ext != '.json':
+                continue
+            try:
+                if self.get(upload_id)['updated_at'] < cutoff:
+                    purged += self.abort(upload_id)
+            except (UploadNotFoundError, ValueError, OSError):
+                continue
+        if purged:
+            logger.info(f"Purged {purged} expired chunked uploads")
+        return purged
+
+
+def _copy_into_hash(f, hasher, length):
+    remaining = length
+    while remaining > 0:
+        data = f.read(min(COPY_BUFFER_SIZE, remaining))
+        if not data:
+            break
+        hasher.update(data)
+        remaining -= len(data)
+
+
+CHUNKED_UPLOADS = ChunkedUploads()
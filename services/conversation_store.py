@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - 会話履歴ストア
+プロファイルごとの会話履歴を追記専用のJSON Linesファイルで管理するモジュール
+"""
+
+import os
+import re
+import json
+import threading
+from datetime import datetime
+from config import logger, PROFILES_DIR
+
+DEFAULT_CONVERSATION_ID = 'default'
+
+# 末尾から読み込む際のブロックサイズ
+_TAIL_BLOCK_SIZE = 64 * 1024
+
+_CONVERSATION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_\-]{1,64}$')
+
+
+def normalize_conversation_id(conversation_id):
+    """会話IDを検証する関数（不正な値の場合はデフォルトの会話を使う）"""
+    if conversation_id and _CONVERSATION_ID_PATTERN.match(conversation_id):
+        return conversation_id
+    return DEFAULT_CONVERSATION_ID
+
+
+class ConversationStore:
+    """
+    会話履歴ストア
+    メッセージは profiles/<id>/conversations/<会話ID>.jsonl に1行ずつ追記し、
+    最新のメッセージはファイル末尾から逆順に読むため、履歴が長くても読み込み量は一定になる
+    """
+
+    def __init__(self, profiles_dir=PROFILES_DIR):
+        self.profiles_dir = profiles_dir
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._counts = {}  # パス -> メッセージ数
+
+    def _dir(self, profile_id):
+        return os.path.join(self.profiles_dir, profile_id, 'conversations')
+
+    def _path(self, profile_id, conversation_id):
+        return os.path.join(self._dir(profile_id), f"{conversation_id}.jsonl")
+
+    def _summary_path(self, profile_id, conversation_id):
+        return os.path.join(self._dir(profile_id), f"{conversation_id}.summary.json")
+
+    def lock(self, profile_id, conversation_id):
+        """会話ごとのロックを取得する"""
+        key = (profile_id, conversation_id)
+        with self._locks_guard:
+            if key not in self._locks:
+                self._locks[key] = threading.RLock()
+            return self._locks[key]
+
+    def _count(self, path):
+        """メッセージ数を取得する（初回のみファイルの改行を数える）"""
+        if path not in self._counts:
+            count = 0
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(_TAIL_BLOCK_SIZE), b''):
+                        count += block.count(b'\n')
+            self._counts[path] = count
+        return self._counts[path]
+
+    def append(self, profile_id, conversation_id, role, content, tokens=None, **extra):
+        """メッセージを1件追記する"""
+        path = self._path(profile_id, conversation_id)
+        with self.lock(profile_id, conversation_id):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            record = {
+                'index': self._count(path),
+                'role': role,
+                'content': content,
+                'tokens': tokens,
+                'created_at': datetime.now().isoformat()
+            }
+            record.update(extra)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._counts[path] += 1
+            return record
+
+    def count(self, profile_id, conversation_id):
+        path = self._path(profile_id, conversation_id)
+        with self.lock(profile_id, conversation_id):
+            return self._count(path)
+
+    def iter_reverse(self, profile_id, conversation_id):
+        """新しいメッセージから順に返すジェネレータ（ファイル末尾からブロック単位で読む）"""
+        path = self._path(profile_id, conversation_id)
+        if not os.path.exists(path):
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b''
+            while position > 0:
+                size = min(_TAIL_BLOCK_SIZE, position)
+                position -= size
+                f.seek(position)
+                lines = (f.read(size) + remainder).split(b'\n')
+                # 先頭の要素はブロック境界で途切れている可能性があるので次に回す
+                remainder = lines.pop(0) if position > 0 else b''
+                for line in reversed(lines):
+                    if line.strip():
+                        yield json.loads(line.decode('utf-8'))
+            if remainder.strip():
+                yield json.loads(remainder.decode('utf-8'))
+
+    def tail(self, profile_id, conversation_id, limit=50):
+        """最新のlimit件を古い順に返す"""
+        messages = []
+        for record in self.iter_reverse(profile_id, conversation_id):
+            messages.append(record)
+            if len(messages) >= limit:
+                break
+        messages.reverse()
+        return messages
+
+    def iter_from(self, profile_id, conversation_id, offset=0):
+        """
+        指定したバイト位置から古い順にメッセージを返すジェネレータ
+        (次のメッセージのバイト位置, メッセージ) の組を返す
+        """
+        path = self._path(profile_id, conversation_id)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line or not line.endswith(b'\n'):
+                    break
+                if line.strip():
+                    yield f.tell(), json.loads(line.decode('utf-8'))
+
+    def get_summary(self, profile_id, conversation_id):
+        """
+        古いメッセージの要約を取得する
+        summarized_untilまでのメッセージが要約に含まれ、offsetはその次のメッセージのバイト位置
+        """
+        path = self._summary_path(profile_id, conversation_id)
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception as e:
+                logger.error(f"Failed to load conversation summary: {str(e)}")
+        return {'summary': '', 'tokens': 0, 'summarized_until': 0, 'offset': 0}
+
+    def save_summary(self, profile_id, conversation_id, summary):
+        path = self._summary_path(profile_id, conversation_id)
+        with self.lock(profile_id, conversation_id):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            summary = dict(summary, updated_at=datetime.now().isoformat())
+            # 書き込み途中の状態を読まれないよう一時ファイル経由で置き換える
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+
+    def clear(self, profile_id, conversation_id):
+        """会話履歴と要約を削除する"""
+        path = self._path(profile_id, conversation_id)
+        with self.lock(profile_id, conversation_id):
+            for target in (path, self._summary_path(profile_id, conversation_id)):
+                if os.path.exists(target):
+                    os.remove(target)
+            self._counts.pop(path, None)
+
+    def list_conversations(self, profile_id):
+        directory = self._dir(profile_id)
+        if not os.path.exists(directory):
+            return []
+        return sorted(
+            name[:-len('.jsonl')] for name in os.listdir(directory) if name.endswith('.jsonl')
+        )
+
+
+# アプリケーション全体で共有するストア
+CONVERSATION_STORE = ConversationStore()
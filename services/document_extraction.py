@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - 文書のテキスト抽出の実行
+PDF・DOCX・HTML・CSVのテキスト抽出をワーカープロセスで実行するモジュール
+取り出したテキストは元のファイルのハッシュごとにキャッシュし、抽出中のテキストを書き込まれた分から読めるようにする
+キャッシュは元のブロブが削除されたときと、合計サイズが上限を超えたときに削除する
+"""
+
+import io
+import os
+import time
+import json
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from config import logger, DOCUMENT_EXTRACT_WORKERS, DOCUMENT_TEXT_CACHE_DIR, DOCUMENT_TEXT_CACHE_MAX_BYTES
+from services.document_text import EXTRACTORS, EXTRACTOR_VERSION, extract_to_file
+from services.blob_store import BLOB_STORE, hash_file, is_sha256
+
+# テキストを取り出せる拡張子
+DOCUMENT_EXTENSIONS = tuple(sorted(EXTRACTORS))
+# 抽出中のテキストの続きを待つ間隔（秒）
+FOLLOW_INTERVAL = 0.05
+
+
+def _read_status(status_path):
+    try:
+        with open(status_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class _FollowingReader(io.RawIOBase):
+    """
+    ワーカープロセスが書き込んでいるファイルを、抽出が終わるまで読み進めるストリーム
+    書き込まれたデータが無い場合は、抽出が終わるか続きが書き込まれるまで待つ
+    """
+
+    def __init__(self, path, future):
+        self._file = open(path, 'rb')
+        self._future = future
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            n = self._file.readinto(buffer)
+            if n:
+                return n
+            if self._future.done():
+                # 終わる直前に書き込まれた分を読み残さない
+                n = self._file.readinto(buffer)
+                if n:
+                    return n
+                self._future.result()
+                return 0
+            time.sleep(FOLLOW_INTERVAL)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class DocumentExtractor:
+    """
+    文書のテキスト抽出をプロセスプールで実行し、結果を <ハッシュ>-v<抽出のバージョン>.txt にキャッシュするクラス
+    同じ内容のファイルの抽出が実行中の場合は、新しく抽出せずにその結果を読む
+    ワーカープロセスが異常終了してプロセスプールが使えなくなった場合は、プールを作り直す
+    """
+
+    def __init__(self, cache_dir=DOCUMENT_TEXT_CACHE_DIR, workers=DOCUMENT_EXTRACT_WORKERS,
+                 max_cache_bytes=DOCUMENT_TEXT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.max_cache_bytes = max_cache_bytes
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = {}
+
+    def _paths(self, sha256):
+        base = os.path.join(self.cache_dir, sha256[:2], f"{sha256}-v{EXTRACTOR_VERSION}")
+        return base + '.txt', base + '.json'
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _discard_pool(self, executor):
+        """
+        使えなくなったプロセスプールを捨てる（次の抽出で作り直す）
+        呼び出し側でself._lockを取得しておく
+        """
+        if self._executor is executor:
+            self._executor = None
+            logger.warning("Document extraction worker pool is broken, recreating it")
+        executor.shutdown(wait=False)
+
+    def get_status(self, sha256):
+        """
+        抽出の状態（{'state': 'extracting' | 'done', 'progress', 'chars'}）
+        抽出が始まっていない場合は {'state': 'queued'}、記録が無い場合はNone
+        """
+        _, status_path = self._paths(sha256)
+        status = _read_status(status_path)
+        if status is None:
+            with self._lock:
+                if sha256 in self._pending:
+                    return {'state': 'queued', 'progress': 0.0, 'chars': 0}
+        return status
+
+    def open_text(self, path, ext, sha256=None):
+        """
+        文書のテキストを読むストリームと、元のファイルのハッシュを返す
+        キャッシュがある場合はキャッシュのファイルを、無い場合は抽出を始めて抽出中のテキストを読むストリームを返す
+        抽出に失敗した場合は、ストリームの読み込みで例外が発生する
+        """
+        ext = ext.lower()
+        if ext not in EXTRACTORS:
+            raise ValueError(f"Unsupported document type: {ext}")
+        if not is_sha256(sha256):
+            sha256 = hash_file(path)
+        text_path, status_path = self._paths(sha256)
+
+        with self._lock:
+            future = self._pending.get(sha256)
+            if future is None:
+                status = _read_status(status_path)
+                if status and status.get('state') == 'done' and os.path.exists(text_path):
+                    # 最近使ったキャッシュとして残るよう、更新日時を新しくする
+                    os.utime(text_path)
+                    return open(text_path, 'r', encoding='utf-8', newline=''), sha256
+
+                os.makedirs(os.path.dirname(text_path), exist_ok=True)
+                if os.path.exists(status_path):
+                    os.remove(status_path)
+                # 抽出が始まる前からストリームを開けるよう、空のファイルを作っておく
+                open(text_path, 'wb').close()
+                executor = self._pool()
+                try:
+                    future = executor.submit(extract_to_file, path, ext, text_path, status_path)
+                except BrokenProcessPool:
+                    self._discard_pool(executor)
+                    executor = self._pool()
+                    future = executor.submit(extract_to_file, path, ext, text_path, status_path)
+                self._pending[sha256] = future
+                future.add_done_callback(lambda done: self._finished(sha256, path, done, executor))
+                logger.info(f"Document extraction queued: {path} ({sha256[:12]})")
+
+        stream = io.BufferedReader(_FollowingReader(text_path, future))
+        return io.TextIOWrapper(stream, encoding='utf-8', newline=''), sha256
+
+    def _finished(self, sha256, path, future, executor):
+        error = future.exception()
+        with self._lock:
+            self._pending.pop(sha256, None)
+            if isinstance(error, BrokenProcessPool):
+                self._discard_pool(executor)
+        if error is None:
+            logger.info(f"Document extraction completed: {path} ({future.result()} chars)")
+            self.trim_cache()
+            return
+        logger.error(f"Document extraction failed for {path}: {str(error)}")
+        _, status_path = self._paths(sha256)
+        if os.path.exists(status_path):
+            os.remove(status_path)
+
+    def _iter_cache_files(self):
+        """キャッシュのファイルを (ハッシュ, パス, os.stat_result) の形で列挙する"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        for prefix in os.scandir(self.cache_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.is_file():
+                    yield entry.name.split('-', 1)[0], entry.path, entry.stat()
+
+    def discard(self, sha256):
+        """ハッシュの文書のキャッシュをすべての抽出のバージョンについて削除する（抽出中の場合は何もしない）"""
+        if not is_sha256(sha256):
+            return
+        with self._lock:
+            if sha256 in self._pending:
+                return
+            prefix_dir = os.path.join(self.cache_dir, sha256[:2])
+            if not os.path.isdir(prefix_dir):
+                return
+            for name in os.listdir(prefix_dir):
+                if name.startswith(sha256 + '-'):
+                    try:
+                        os.remove(os.path.join(prefix_dir, name))
+                    except OSError:
+                        # Windowsで読み込み中のファイルは次の機会に削除する
+                        pass
+
+    def trim_cache(self):
+        """
+        キャッシュの合計サイズが上限を超えている場合に、古く使われたものから削除する
+        戻り値は削除した文書の数
+        """
+        if self.max_cache_bytes <= 0:
+            return 0
+        entries = {}
+        for sha256, _, stat in self._iter_cache_files():
+            size, used = entries.get(sha256, (0, 0))
+            entries[sha256] = (size + stat.st_size, max(used, stat.st_mtime))
+        total = sum(size for size, _ in entries.values())
+        if total <= self.max_cache_bytes:
+            return 0
+
+        removed = 0
+        for sha256, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_cache_bytes:
+                break
+            with self._lock:
+                pending = sha256 in self._pending
+            if pending:
+                continue
+            self.discard(sha256)
+            total -= size
+            removed += 1
+        logger.info(f"Trimmed document text cache: removed {removed} documents, {total} bytes remain")
+        return removed
+
+
+DOCUMENT_EXTRACTOR = DocumentExtractor()
+# アップロードしたファイルが削除されたら、そのテキストのキャッシュも削除する
+BLOB_STORE.add_removal_listener(DOCUMENT_EXTRACTOR.discard)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - 文書のテキスト抽出
+PDF・DOCX・HTML・CSVのファイルからテキストを取り出すモジュール
+抽出用のワーカープロセスで実行するため、configなどアプリケーションのモジュールは読み込まない
+"""
+
+import io
+import os
+import re
+import csv
+import json
+import time
+import codecs
+import zipfile
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+
+# 抽出の処理を変えたときに上げる（キャッシュ済みのテキストを使わないようにするため）
+EXTRACTOR_VERSION = 1
+# 進捗を状態ファイルに書き込む間隔（秒）
+PROGRESS_INTERVAL = 0.5
+READ_SIZE = 64 * 1024
+
+_WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_CHARSET = re.compile(rb'charset\s*=\s*["\']?\s*([A-Za-z0-9_\-]+)', re.IGNORECASE)
+
+
+def _detect_encoding(path, default='utf-8'):
+    """ファイルの先頭からテキストの文字コードを推定する（UTF-8として読めない場合はcp932）"""
+    with open(path, 'rb') as f:
+        head = f.read(READ_SIZE)
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # 末尾で途切れた文字は無視する
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return default
+    except UnicodeDecodeError:
+        return 'cp932'
+
+
+def iter_pdf_text(path):
+    """PDFのページごとのテキストを (テキスト, 進捗) で返す（pypdfが必要）"""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise RuntimeError("PDF extraction requires pypdf (pip install pypdf)")
+    reader = PdfReader(path)
+    total = len(reader.pages)
+    for number, page in enumerate(reader.pages, 1):
+        text = (page.extract_text() or '').strip()
+        yield (text + '\n\n' if text else ''), number / total
+
+
+def iter_docx_text(path):
+    """DOCXの段落ごとのテキストを (テキスト, 進捗) で返す"""
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo('word/document.xml')
+        with archive.open(info) as f:
+            parts = []
+            for _, element in ElementTree.iterparse(f, events=('end',)):
+                tag = element.tag
+                if tag == _WORD_NS + 't':
+                    parts.append(element.text or '')
+                elif tag == _WORD_NS + 'tab':
+                    parts.append('\t')
+                elif tag in (_WORD_NS + 'br', _WORD_NS + 'cr'):
+                    parts.append('\n')
+                elif tag == _WORD_NS + 'p':
+                    text = ''.join(parts).strip()
+                    parts = []
+                    # 段落の要素を捨てて、文書全体の木をメモリに残さない
+                    element.clear()
+                    yield (text + '\n' if text else ''), f.tell() / max(info.file_size, 1)
+
+
+class _HTMLTextParser(HTMLParser):
+    """HTMLから表示されるテキストを取り出すパーサー（ブロック要素の区切りを改行にする）"""
+
+    SKIP_TAGS = {'script', 'style', 'noscript', 'template'}
+    BLOCK_TAGS = {
+        'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'figcaption', 'footer',
+        'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav', 'ol', 'p', 'pre',
+        'section', 'table', 'td', 'th', 'title', 'tr', 'ul'
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+        self._pre = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif tag == 'pre':
+            self._pre += 1
+        if tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip = max(self._skip - 1, 0)
+        elif tag == 'pre':
+            self._pre = max(self._pre - 1, 0)
+        if tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        self.parts.append(data if self._pre else re.sub(r'\s+', ' ', data))
+
+    def take_text(self):
+        """これまでに取り出したテキストを、空行を詰めて返す"""
+        text = ''.join(self.parts)
+        self.parts = []
+        return re.sub(r'[ \t]*\n[ \t\n]*', '\n', text)
+
+
+def iter_html_text(path):
+    """HTMLのテキストを読み込んだ分ずつ (テキスト, 進捗) で返す"""
+    size = max(os.path.getsize(path), 1)
+    with open(path, 'rb') as raw:
+        match = _CHARSET.search(raw.read(4096))
+        raw.seek(0)
+        encoding = _detect_encoding(path)
+        if match:
+            try:
+                encoding = codecs.lookup(match.group(1).decode('ascii')).name
+            except LookupError:
+                pass
+        parser = _HTMLTextParser()
+        f = io.TextIOWrapper(raw, encoding=encoding, errors='replace')
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            parser.feed(data)
+            yield parser.take_text(), raw.tell() / size
+        parser.close()
+        yield parser.take_text().rstrip() + '\n', 1.0
+
+
+def iter_csv_text(path):
+    """CSVの行を「列名: 値」の形のテキストにして (テキスト, 進捗) で返す"""
+    size = max(os.path.getsize(path), 1)
+    with open(path, 'rb') as raw:
+        f = io.TextIOWrapper(raw, encoding=_detect_encoding(path), errors='replace', newline='')
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        header = [name.strip() for name in header]
+        for row in reader:
+            # セル内の改行は空白にして、1行を1件として読めるようにする
+            fields = [
+                f"{header[i] if i < len(header) and header[i] else f'列{i + 1}'}: {' '.join(value.split())}"
+                for i, value in enumerate(row) if value.strip()
+            ]
+            yield (' | '.join(fields) + '\n' if fields else ''), raw.tell() / size
+
+
+# 拡張子ごとの抽出関数
+EXTRACTORS = {
+    '.pdf': iter_pdf_text,
+    '.docx': iter_docx_text,
+    '.html': iter_html_text,
+    '.htm': iter_html_text,
+    '.csv': iter_csv_text,
+}
+
+
+def write_status(status_path, **status):
+    temp_path = status_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(status, f)
+    os.replace(temp_path, status_path)
+
+
+def extract_to_file(source_path, ext, text_path, status_path):
+    """
+    ファイルのテキストを取り出してtext_pathに少しずつ書き込む（ワーカープロセスで実行する）
+    書き込みは一定間隔でフラッシュするため、抽出中のテキストを別のプロセスから読み進められる
+    進捗と完了はstatus_pathの状態ファイルに書き込む。戻り値は取り出した文字数
+    """
+    extractor = EXTRACTORS.get(ext)
+    if extractor is None:
+        raise ValueError(f"Unsupported document type: {ext}")
+    chars, last_report = 0, time.monotonic()
+    with open(text_path, 'w', encoding='utf-8', newline='') as out:
+        for text, progress in extractor(source_path):
+            if text:
+                out.write(text)
+                chars += len(text)
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_INTERVAL:
+                out.flush()
+                write_status(status_path, state='extracting', progress=round(progress, 4), chars=chars)
+                last_report = now
+    write_status(status_path, state='done', progress=1.0, chars=chars, version=EXTRACTOR_VERSION)
+    return chars
@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - インポートジョブ
+ファイルのインポートをジョブとして待ち行列に入れ、ワーカースレッドで順に実行するモジュール
+待ち行列はSQLite（IMPORT_JOBS_DB）に保存するため、サーバーを再起動しても未完了のジョブを続けて実行する
+実行中に中断したジョブは、保存済みの位置（再開位置）から続ける
+"""
+
+import io
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from config import (
+    logger, PROFILES_DIR, IMPORT_JOBS_DB, IMPORT_JOB_WORKERS, IMPORT_JOB_RETENTION,
+    MEMORY_CHUNK_READ_SIZE, MEMORY_IMPORT_BATCH_SIZE
+)
+from services.memory_store import get_memory_store, validate_memory_changes
+from services.memory_chunking import import_passages
+from services.document_extraction import DOCUMENT_EXTRACTOR, DOCUMENT_EXTENSIONS
+
+# インポートの種類と、種類ごとに読み込めるファイルの拡張子
+IMPORT_TYPES = ('memory', 'config')
+TEXT_EXTENSIONS = ('.txt', '.md')
+MEMORY_EXTENSIONS = TEXT_EXTENSIONS + ('.json',) + DOCUMENT_EXTENSIONS
+FINISHED_STATES = ('completed', 'failed', 'cancelled')
+# 進捗をデータベースに書き込む間隔（秒）
+PROGRESS_INTERVAL = 0.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS import_jobs (
+    id TEXT PRIMARY KEY,
+    profile_id TEXT NOT NULL,
+    import_type TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    options TEXT NOT NULL,
+    state TEXT NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    bytes_total INTEGER NOT NULL DEFAULT 0,
+    bytes_read INTEGER NOT NULL DEFAULT 0,
+    items_processed INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_import_jobs_state ON import_jobs (state, created_at);
+CREATE INDEX IF NOT EXISTS idx_import_jobs_profile ON import_jobs (profile_id, created_at);
+"""
+
+
+class ImportCancelled(Exception):
+    """ジョブのキャンセルが要求された"""
+
+
+def _row_to_job(row):
+    job = dict(row)
+    job['options'] = json.loads(job['options'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    job['cancel_requested'] = bool(job['cancel_requested'])
+    if job['bytes_total']:
+        job['progress'] = round(min(job['bytes_read'] / job['bytes_total'], 1.0), 4)
+    else:
+        job['progress'] = 1.0 if job['state'] == 'completed' else 0.0
+    return job
+
+
+class _JobContext:
+    """実行中のジョブの進捗の報告とキャンセルの確認を行うクラス"""
+
+    def __init__(self, queue, row, cancelled):
+        self.queue = queue
+        self.job_id = row['id']
+        self.profile_id = row['profile_id']
+        self.file_path = row['file_path']
+        self.filename = row['filename']
+        self.options = json.loads(row['options'])
+        self.bytes_total = row['bytes_total']
+        self.bytes_read = 0
+        self.items_processed = row['items_processed']
+        # 前回の実行が中断した場合の再開位置（保存済みの分までの結果）
+        self.resume = json.loads(row['result']) if row['result'] else None
+        # キャンセルされた場合に、それまでの結果として保存する
+        self.partial_result = self.resume
+        self._cancelled = cancelled
+        self._last_report = 0.0
+
+    def check_cancelled(self):
+        if self._cancelled.is_set():
+            raise ImportCancelled(self.job_id)
+
+    def report(self, bytes_read=None, items_processed=None):
+        """進捗を記録する（データベースへの書き込みはPROGRESS_INTERVALごと）"""
+        if bytes_read is not None:
+            self.bytes_read = bytes_read
+        if items_processed is not None:
+            self.items_processed = items_processed
+        now = time.monotonic()
+        if now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.queue._update(self.job_id, bytes_read=self.bytes_read, items_processed=self.items_processed)
+
+
+    def checkpoint(self, partial_result):
+        """
+        保存が終わった分までの結果を再開位置としてすぐに記録する
+        サーバーが途中で停止した場合、次の起動時にこの位置から続ける
+        """
+        self.partial_result = partial_result
+        self.queue._update(self.job_id, options=self.options, result=partial_result,
+                           bytes_read=self.bytes_read, items_processed=self.items_processed)
+
+
+class _ProgressReader(io.RawIOBase):
+    """読み込んだバイト数をジョブの進捗として報告し、読み込むたびにキャンセルを確認するストリーム"""
+
+    def __init__(self, raw, context):
+        self._raw = raw
+        self._context = context
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        self._context.check_cancelled()
+        n = self._raw.readinto(buffer)
+        if n:
+            self._context.report(bytes_read=self._context.bytes_read + n)
+        return n
+
+
+def _open_text(context, encoding='utf-8'):
+    """進捗を報告しながらファイルを読むテキストストリーム（改行は変換しない）"""
+    raw = open(context.file_path, 'rb')
+    return io.TextIOWrapper(io.BufferedReader(_ProgressReader(raw, context)), encoding=encoding, newline='')
+
+
+class _ExtractedText:
+    """
+    抽出中の文書のテキストを読むストリーム
+    元のファイルは抽出用のプロセスが読むため、抽出の進捗から読み込んだバイト数を計算する
+    """
+
+    def __init__(self, stream, sha256, context):
+        self._stream = stream
+        self._sha256 = sha256
+        self._context = context
+
+    def read(self, size=-1):
+        self._context.check_cancelled()
+        data = self._stream.read(size)
+        status = DOCUMENT_EXTRACTOR.get_status(self._sha256) or {}
+        self._context.report(bytes_read=int(status.get('progress', 0) * self._context.bytes_total))
+        return data
+
+
+def iter_json_items(stream, read_size=MEMORY_CHUNK_READ_SIZE):
+    """
+    JSONの配列の要素を、ファイル全体を読み込まずに1つずつ返す
+    配列でない場合は全体を1つの要素として返す
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof, started = '', 0, False, False
+    while True:
+        # 空白と要素の区切りを読み飛ばす（足りなくなったら続きを読み込む）
+        while True:
+            while position < len(buffer) and (buffer[position].isspace() or (started and buffer[position] == ',')):
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            buffer, position = stream.read(read_size), 0
+            eof = not buffer
+        if position >= len(buffer):
+            if started:
+                raise ValueError("Unterminated JSON array")
+            return
+
+        if not started:
+            if buffer[position] != '[':
+                yield json.loads(buffer[position:] + stream.read())
+                return
+            started = True
+            position += 1
+            continue
+        if buffer[position] == ']':
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+            # 数値などはバッファの末尾で途切れていても読めてしまうため、続きを確かめる
+            complete = end < len(buffer) or eof
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            complete = False
+        if not complete:
+            more = stream.read(read_size)
+            buffer, position, eof = buffer[position:] + more, 0, not more
+            continue
+        yield item
+        position = end
+
+
+def _import_text(context, store):
+    source = context.filename
+    with _open_text(context) as stream:
+        stats = import_passages(
+            store, stream, source, tags=['imported', source], on_duplicate=context.options['on_duplicate'],
+            on_batch=lambda progress: _report_passages(context, progress),
+            document_id=context.options.get('document_id'), resume=context.resume
+        )
+    return _passage_result(source, stats)
+
+
+def _import_document(context, store):
+    source = context.filename
+    ext = os.path.splitext(source)[1].lower()
+    stream, sha256 = DOCUMENT_EXTRACTOR.open_text(context.file_path, ext, context.options.get('sha256'))
+    with stream:
+        stats = import_passages(
+            store, _ExtractedText(stream, sha256, context), source, tags=['imported', source],
+            on_duplicate=context.options['on_duplicate'],
+            on_batch=lambda progress: _report_passages(context, progress),
+            document_id=context.options.get('document_id'), resume=context.resume
+        )
+    result = _passage_result(source, stats)
+    result['extraction'] = DOCUMENT_EXTRACTOR.get_status(sha256)
+    return result
+
+
+def _report_passages(context, stats):
+    # 続きから取り込むときに同じ文書として扱えるよう、document_idをジョブのオプションに残す
+    context.options['document_id'] = stats['document_id']
+    context.items_processed = stats['passages']
+    context.checkpoint({key: value for key, value in stats.items() if key != 'first_id'})
+
+
+def _passage_result(source, stats):
+    result = {key: value for key, value in stats.items() if key != 'first_id'}
+    result['count'] = stats['created']
+    result['message'] = f'ファイル "{source}" をメモリにインポートしました（{stats["passages"]}パッセージ）'
+    return result
+
+
+def _import_json(context, store):
+    """
+    JSONのメモリ（配列または1件のオブジェクト）をMEMORY_IMPORT_BATCH_SIZE件ずつ保存する
+    再開位置（保存済みの要素数 items）がある場合は、その分を読み飛ばして続きから保存する
+    内容が不正な要素はジョブを止めずに読み飛ばし、invalidとして数える
+    """
+    resume = context.resume or {}
+    stats = {key: resume.get(key, 0) for key in ('count', 'merged', 'skipped', 'duplicates', 'invalid')}
+    saved = resume.get('items', 0)
+    processed = 0
+
+    def flush(batch):
+        # 同じトランザクションの中の重複も検出される
+        for result in store.create_deduplicated(batch, on_duplicate=context.options['on_duplicate']):
+            stats['count' if result['status'] == 'created' else result['status']] += 1
+            stats['duplicates'] += result.get('duplicate_of') is not None
+        context.items_processed = processed
+        context.checkpoint(dict(stats, items=processed))
+
+    batch = []
+    with _open_text(context, encoding='utf-8-sig') as stream:
+        for item in iter_json_items(stream):
+            processed += 1
+            if processed <= saved:
+                continue
+            if isinstance(item, dict) and 'content' in item:
+                memory = {
+                    'content': item['content'],
+                    'type': item.get('type', 'imported'),
+                    'tags': item.get('tags', ['imported']),
+                    'created_at': item.get('created_at', datetime.now().isoformat()),
+                    'strength': item.get('strength', 1.0)
+                }
+                # 1つのタグを文字列で指定した場合は、1文字ずつのタグにならないようリストにする
+                if isinstance(memory['tags'], str):
+                    memory['tags'] = [memory['tags']]
+                if validate_memory_changes(memory, require_content=True):
+                    stats['invalid'] += 1
+                else:
+                    batch.append(memory)
+            if len(batch) >= MEMORY_IMPORT_BATCH_SIZE:
+                flush(batch)
+                batch = []
+            context.report(items_processed=processed)
+    if batch:
+        flush(batch)
+    context.report(items_processed=processed)
+    stats['message'] = f'ファイル "{context.filename}" をメモリにインポートしました'
+    return stats
+
+
+def _import_memory(context):
+    store = get_memory_store(context.profile_id)
+    ext = os.path.splitext(context.filename)[1].lower()
+    if ext in TEXT_EXTENSIONS:
+        return _import_text(context, store)
+    if ext == '.json':
+        return _import_json(context, store)
+    return _import_document(context, store)
+
+
+def _import_config(context):
+    """JSONの設定をプロファイルの設定（config.json）に統合する"""
+    with _open_text(context, encoding='utf-8-sig') as f:
+        imported_config = json.load(f)
+    if not isinstance(imported_config, dict):
+        raise ValueError("Profile config must be a JSON object")
+    context.check_cancelled()
+
+    config_path = os.path.join(PROFILES_DIR, context.profile_id, 'config.json')
+    current_config = {}
+    if os.path.exists(config_path):
+        with open(config_path, 'r', encoding='utf-8') as f:
+            current_config = json.load(f)
+    current_config.update(imported_config)
+    temp_path = config_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(current_config, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, config_path)
+    context.report(items_processed=len(imported_config))
+    return {
+        'keys': sorted(imported_config),
+        'message': f'ファイル "{context.filename}" をプロファイル設定にインポートしました'
+    }
+
+
+_HANDLERS = {
+    'memory': _import_memory,
+    'config': _import_config,
+}
+
+
+class ImportJobQueue:
+    """
+    インポートジョブの待ち行列
+    ジョブは登録された順にワーカースレッドが取り出して実行し、状態と進捗をデータベースに記録する
+    """
+
+    def __init__(self, db_path=IMPORT_JOBS_DB, workers=IMPORT_JOB_WORKERS):
+        self.db_path = db_path
+        self.workers = workers
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._threads = []
+        # 実行中のジョブのキャンセル要求
+        self._cancel_events = {}
+        self._initialized = False
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._initialized:
+                conn.executescript(_SCHEMA)
+                self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._connect()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _update(self, job_id, **fields):
+        for key in ('options', 'result'):
+            if key in fields and fields[key] is not None:
+                fields[key] = json.dumps(fields[key], ensure_ascii=False)
+        assignments = ', '.join(f"{key} = ?" for key in fields)
+        with self.transaction() as conn:
+            conn.execute(f"UPDATE import_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def submit(self, profile_id, import_type, file_path, filename, **options):
+        """ジョブを待ち行列に追加し、ジョブの状態を返す"""
+        if import_type not in _HANDLERS:
+            raise ValueError(f"Unknown import type: {import_type}")
+        job_id = uuid.uuid4().hex
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO import_jobs (id, profile_id, import_type, file_path, filename, options, state, "
+                "bytes_total, created_at) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, profile_id, import_type, file_path, filename, json.dumps(options, ensure_ascii=False),
+                 os.path.getsize(file_path), time.time())
+            )
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+        logger.info(f"Import job queued: {job_id} ({import_type}, {filename})")
+        return self.get(job_id)
+
+    def get(self, job_id):
+        row = self._connect().execute("SELECT * FROM import_jobs WHERE id = ?", (job_id,)).fetchone()
+        return _row_to_job(row) if row else None
+
+    def list_jobs(self, profile_id=None, state=None, limit=50):
+        """ジョブの一覧（新しいものから）"""
+        sql, params = "SELECT * FROM import_jobs", []
+        conditions = []
+        if profile_id:
+            conditions.append("profile_id = ?")
+            params.append(profile_id)
+        if state:
+            conditions.append("state = ?")
+            params.append(state)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY created_at DESC LIMIT ?"
+        params.append(int(limit))
+        return [_row_to_job(row) for row in self._connect().execute(sql, params)]
+
+    def cancel(self, job_id):
+        """
+        ジョブをキャンセルする（待機中のジョブはすぐに、実行中のジョブは次にファイルを読むときに止まる）
+        ジョブの状態を返す。ジョブが無い場合はNone
+        """
+        with self.transaction() as conn:
+            row = conn.execute("SELECT state FROM import_jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            if row['state'] == 'queued':
+                conn.execute("UPDATE import_jobs SET state = 'cancelled', cancel_requested = 1, finished_at = ? "
+                             "WHERE id = ?", (time.time(), job_id))
+            elif row['state'] == 'running':
+                conn.execute("UPDATE import_jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+        event = self._cancel_events.get(job_id)
+        if event is not None:
+            event.set()
+        return self.get(job_id)
+
+    def start(self):
+        """
+        ワーカースレッドを開始する（開始済みの場合は何もしない）
+        前回の終了時に実行中だったジョブは再開位置（result）を残したまま待ち行列に戻し、
+        保存期間を過ぎた終了済みのジョブは削除する
+        """
+        with self._start_lock:
+            if self._threads:
+                return False
+            with self.transaction() as conn:
+                recovered = conn.execute(
+                    "UPDATE import_jobs SET state = 'queued', started_at = NULL, bytes_read = 0 "
+                    "WHERE state = 'running' AND cancel_requested = 0").rowcount
+                conn.execute("UPDATE import_jobs SET state = 'cancelled', finished_at = ? "
+                             "WHERE state = 'running'", (time.time(),))
+                conn.execute(
+                    f"DELETE FROM import_jobs WHERE state IN ({', '.join('?' * len(FINISHED_STATES))}) "
+                    "AND finished_at < ?", (*FINISHED_STATES, time.time() - IMPORT_JOB_RETENTION))
+            if recovered:
+                logger.info(f"Requeued {recovered} interrupted import jobs to resume from their last checkpoint")
+            for number in range(max(self.workers, 1)):
+                thread = threading.Thread(target=self._work, name=f'import-worker-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            return True
+
+    def _claim(self):
+        """待機中のジョブを1つ取り出して実行中にする"""
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT * FROM import_jobs WHERE state = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE import_jobs SET state = 'running', started_at = ? WHERE id = ?",
+                         (time.time(), row['id']))
+            self._cancel_events[row['id']] = threading.Event()
+            return row
+
+    def _work(self):
+        while True:
+            try:
+                row = self._claim()
+            except Exception as e:
+                logger.exception(f"Failed to claim import job: {str(e)}")
+                row = None
+            if row is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=5)
+                continue
+            self._run(row)
+
+    def _run(self, row):
+        job_id = row['id']
+        context = _JobContext(self, row, self._cancel_events[job_id])
+        started = time.perf_counter()
+        try:
+            result = _HANDLERS[row['import_type']](context)
+            state, error = 'completed', None
+            context.bytes_read = context.bytes_total
+        except ImportCancelled:
+            result, state, error = context.partial_result, 'cancelled', None
+        except Exception as e:
+            logger.exception(f"Import job {job_id} failed: {str(e)}")
+            result, state, error = context.partial_result, 'failed', str(e)
+        finally:
+            self._cancel_events.pop(job_id, None)
+        self._update(job_id, state=state, result=result, error=error, bytes_read=context.bytes_read,
+                     items_processed=context.items_processed, finished_at=time.time())
+        logger.info(f"Import job {job_id} {state} in {time.perf_counter() - started:.2f}s "
+                    f"({context.items_processed} items)")
+
+
+IMPORT_JOBS = ImportJobQueue()
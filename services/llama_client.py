@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - llama-server HTTPクライアント
+llama-serverへの通信を接続プール付きの共有セッションで行うモジュール
+"""
+
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from config import (
+    logger, LLAMA_SERVER_POOL_SIZE, LLAMA_SERVER_CONNECT_TIMEOUT,
+    LLAMA_SERVER_READ_TIMEOUT, LLAMA_SERVER_MAX_RETRIES, LLAMA_SERVER_RETRY_BACKOFF,
+    LLAMA_SERVER_INSTANCES
+)
+
+# llama-serverがモデルのロード中などで一時的に返すステータス
+RETRYABLE_STATUS_CODES = {503}
+# 接続プールを保持するホスト数（各インスタンスと埋め込み用のサーバー）
+POOL_HOSTS = max(1, LLAMA_SERVER_INSTANCES) + 1
+
+
+class LlamaHttpClient:
+    """
+    llama-serverとの通信に使う共有HTTPクライアント
+    Keep-Aliveの接続をホストごとにプールして再利用し、接続失敗時はバックオフ付きでリトライする
+    """
+
+    def __init__(self, pool_size=LLAMA_SERVER_POOL_SIZE, pool_hosts=POOL_HOSTS,
+                 connect_timeout=LLAMA_SERVER_CONNECT_TIMEOUT,
+                 read_timeout=LLAMA_SERVER_READ_TIMEOUT,
+                 max_retries=LLAMA_SERVER_MAX_RETRIES,
+                 retry_backoff=LLAMA_SERVER_RETRY_BACKOFF):
+        self.pool_size = pool_size
+        self.pool_hosts = pool_hosts
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        # リトライは自前で行うため、アダプター側のリトライは無効にする
+        # pool_connectionsはホスト数分確保する（足りないとホストを切り替えるたびにプールが破棄される）
+        self._adapter = HTTPAdapter(
+            pool_connections=pool_hosts,
+            pool_maxsize=pool_size,
+            max_retries=0,
+            pool_block=False
+        )
+        self._session = requests.Session()
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'failures': 0,
+            'retries': 0
+        }
+        # 破棄されたプールの接続数・リクエスト数（ホストごと）
+        self._disposed = {}
+        self._evicted_pools = 0
+        pools = self._adapter.poolmanager.pools
+        dispose = pools.dispose_func
+
+        def on_dispose(pool):
+            with self._stats_lock:
+                self._evicted_pools += 1
+                counts = self._disposed.setdefault(_pool_host(pool), [0, 0])
+                counts[0] += pool.num_connections
+                counts[1] += pool.num_requests
+            if dispose is not None:
+                dispose(pool)
+
+        pools.dispose_func = on_dispose
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def request(self, method, url, read_timeout=None, connect_timeout=None, retries=None, **kwargs):
+        """
+        llama-serverにリクエストを送信する
+        接続エラーと一時的なエラーステータスのみリトライし、読み取り途中の失敗はリトライしない
+        """
+        timeout = (
+            connect_timeout if connect_timeout is not None else self.connect_timeout,
+            read_timeout if read_timeout is not None else self.read_timeout
+        )
+        retries = self.max_retries if retries is None else retries
+
+        attempt = 0
+        while True:
+            self._count('requests')
+            try:
+                response = self._session.request(method, url, timeout=timeout, **kwargs)
+                if response.status_code in RETRYABLE_STATUS_CODES and attempt < retries:
+                    response.close()
+                    raise _RetryableStatus(response.status_code)
+                return response
+            except (requests.ConnectionError, requests.ConnectTimeout, _RetryableStatus) as e:
+                if attempt >= retries:
+                    self._count('failures')
+                    raise
+                delay = self.retry_backoff * (2 ** attempt)
+                attempt += 1
+                self._count('retries')
+                logger.debug(f"Retrying llama-server request {method} {url} in {delay:.2f}s ({str(e)})")
+                time.sleep(delay)
+            except Exception:
+                self._count('failures')
+                raise
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get_stats(self):
+        """
+        接続プールの利用状況を取得する
+        urllib3の接続プールが数えている新規接続数とリクエスト数から、ホストごとと全体の再利用率を求める
+        破棄されたプールの分も含めて数える
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats['evicted_pools'] = self._evicted_pools
+            counts = {host: list(values) for host, values in self._disposed.items()}
+
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            values = counts.setdefault(_pool_host(pool), [0, 0])
+            values[0] += pool.num_connections
+            values[1] += pool.num_requests
+
+        hosts = {host: _reuse_stats(opened, requests_sent) for host, (opened, requests_sent) in counts.items()}
+        stats.update(_reuse_stats(
+            sum(values[0] for values in counts.values()),
+            sum(values[1] for values in counts.values())
+        ))
+        stats.update({
+            'hosts': hosts,
+            'pool_hosts': self.pool_hosts,
+            'pool_maxsize': self.pool_size,
+            'connect_timeout': self.connect_timeout,
+            'read_timeout': self.read_timeout
+        })
+        return stats
+
+    def close(self):
+        self._session.close()
+
+
+def _pool_host(pool):
+    return f"{pool.host}:{pool.port}"
+
+
+def _reuse_stats(connections_opened, pool_requests):
+    return {
+        'connections_opened': connections_opened,
+        'connections_reused': max(pool_requests - connections_opened, 0),
+        'reuse_ratio': round(1 - connections_opened / pool_requests, 4) if pool_requests else 0.0
+    }
+
+
+class _RetryableStatus(Exception):
+    """リトライ対象のステータスを受け取ったことを表す内部例外"""
+
+    def __init__(self, status_code):
+        super().__init__(f"llama-server returned {status_code}")
+        self.status_code = status_code
+
+
+# アプリケーション全体で共有するクライアント
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_llama_client():
+    """共有のllama-server HTTPクライアントを取得する関数"""
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = LlamaHttpClient()
+    return _CLIENT
+
+
+def get_llama_client_stats():
+    """共有クライアントの接続再利用統計を取得する関数"""
+    return get_llama_client().get_stats()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - llama-serverヘルス監視サービス
+バックグラウンドでllama-serverの状態を確認し、結果をキャッシュするモジュール
+"""
+
+import time
+import threading
+from datetime import datetime
+from config import logger, LLAMA_SERVER_HEALTH_URL, LLAMA_HEALTH_INTERVAL
+from services.llama_client import get_llama_client
+
+
+class LlamaHealthProber:
+    """
+    llama-serverの状態を定期的に確認してキャッシュするクラス
+    ハンドラはget_state()でキャッシュを読むだけなので、サーバー停止中でもブロックしない
+    """
+
+    def __init__(self, health_url=LLAMA_SERVER_HEALTH_URL, interval=LLAMA_HEALTH_INTERVAL):
+        self.health_url = health_url
+        self.base_url = health_url.rsplit('/', 1)[0]
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._listeners = []
+        self._slots_endpoint_supported = True
+        self._state = {
+            'status': 'unknown',
+            'running': False,
+            'last_checked': None,
+            'latency_ms': None,
+            'model': None,
+            'slots': None,
+            'error': None,
+            'changed_at': None
+        }
+
+    def start(self):
+        """監視スレッドを開始する"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='llama-health-prober', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """監視スレッドを停止する"""
+        self._stop.set()
+        self._wakeup.set()
+
+    def add_listener(self, callback):
+        """
+        状態が変化したときに呼ばれるフックを登録する
+        callback(previous_state, current_state) の形式で呼び出される
+        """
+        with self._lock:
+            self._listeners.append(callback)
+
+    def get_state(self):
+        """キャッシュされた状態を取得する（定数時間）"""
+        # 一度も確認していなければ最初の1回だけ同期的に確認する
+        if self._state['last_checked'] is None:
+            self.refresh()
+        if self._thread is None:
+            self.start()
+        with self._lock:
+            return dict(self._state)
+
+    def is_running(self):
+        return self.get_state()['running']
+
+    def request_refresh(self):
+        """監視スレッドに次の確認をすぐ行うよう要求する（ブロックしない）"""
+        self._wakeup.set()
+
+    def refresh(self):
+        """llama-serverの状態を今すぐ確認してキャッシュを更新する"""
+        with self._probe_lock:
+            new_state = self._probe()
+
+            with self._lock:
+                previous = dict(self._state)
+                changed = (previous['status'] != new_state['status']
+                           or previous['model'] != new_state['model'])
+                new_state['changed_at'] = new_state['last_checked'] if changed else previous['changed_at']
+                self._state = new_state
+                listeners = list(self._listeners)
+
+        if changed:
+            logger.info(f"llama-server state changed: {previous['status']} -> {new_state['status']}")
+            for callback in listeners:
+                try:
+                    callback(previous, dict(new_state))
+                except Exception as e:
+                    logger.exception(f"Error in llama-server state listener: {str(e)}")
+
+        return dict(new_state)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.exception(f"Error probing llama-server: {str(e)}")
+
+    def _probe(self):
+        """llama-serverにヘルスチェックを送信して状態を作成する"""
+        client = get_llama_client()
+        state = {
+            'status': 'down',
+            'running': False,
+            'last_checked': datetime.now().isoformat(),
+            'latency_ms': None,
+            'model': None,
+            'slots': None,
+            'error': None
+        }
+
+        started = time.perf_counter()
+        try:
+            response = client.get(self.health_url, connect_timeout=1, read_timeout=1, retries=0)
+            state['latency_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        except Exception as e:
+            state['error'] = str(e)
+            return state
+
+        if response.status_code != 200:
+            # モデルのロード中は503が返る
+            state['status'] = 'loading' if response.status_code == 503 else 'down'
+            state['error'] = f"health returned {response.status_code}"
+            return state
+
+        state['status'] = 'up'
+        state['running'] = True
+
+        try:
+            health = response.json()
+        except ValueError:
+            health = {}
+
+        # 古いllama-serverは/healthにスロット情報を含める
+        if 'slots_idle' in health or 'slots_processing' in health:
+            idle = health.get('slots_idle', 0)
+            processing = health.get('slots_processing', 0)
+            state['slots'] = {'total': idle + processing, 'idle': idle, 'processing': processing}
+        else:
+            state['slots'] = self._probe_slots(client)
+
+        state['model'] = self._probe_model(client)
+        return state
+
+    def _probe_slots(self, client):
+        """/slotsからスロットの使用状況を取得する（無効化されている場合はNone）"""
+        if not self._slots_endpoint_supported:
+            return None
+        try:
+            response = client.get(f"{self.base_url}/slots", connect_timeout=1, read_timeout=1, retries=0)
+            if response.status_code != 200:
+                # --no-slotsなどで無効化されている場合は以後問い合わせない
+                if response.status_code in (404, 501):
+                    self._slots_endpoint_supported = False
+                return None
+            slots = response.json()
+            processing = sum(1 for slot in slots if slot.get('is_processing') or slot.get('state') == 1)
+            return {'total': len(slots), 'idle': len(slots) - processing, 'processing': processing}
+        except Exception:
+            return None
+
+    def _probe_model(self, client):
+        """/propsからロード済みのモデルを取得する"""
+        try:
+            response = client.get(f"{self.base_url}/props", connect_timeout=1, read_timeout=1, retries=0)
+            if response.status_code != 200:
+                return None
+            props = response.json()
+            return (props.get('model_path')
+                    or props.get('default_generation_settings', {}).get('model'))
+        except Exception:
+            return None
+
+
+# アプリケーション全体で共有するプローバー
+_PROBER = None
+_PROBER_LOCK = threading.Lock()
+
+
+def get_health_prober():
+    """共有のヘルスプローバーを取得する関数"""
+    global _PROBER
+    if _PROBER is None:
+        with _PROBER_LOCK:
+            if _PROBER is None:
+                _PROBER = LlamaHealthProber()
+    return _PROBER
+
+
+def get_llama_server_state():
+    """キャッシュされたllama-serverの状態を取得する関数"""
+    return get_health_prober().get_state()
@@ -7,159 +7,909 @@ llama-serverの起動、停止、通信を管理するモジュール
 """
 
 import os
+import json
+import math
 import time
+import heapq
+import atexit
+import itertools
+import threading
+from contextlib import contextmanager
 import subprocess
-import requests
+import config as app_config
 from config import (
-    logger, IS_WINDOWS, LLAMA_SERVER_PROCESS, LLAMACPP_MAIN,
-    SELECTED_MODEL_PATH, LLAMA_SERVER_HOST, LLAMA_SERVER_PORT,
-    LLAMA_SERVER_URL, LLAMA_SERVER_HEALTH_URL
+    logger, IS_WINDOWS, LLAMACPP_SERVER, LLAMA_SERVER_HOST, LLAMA_SERVER_PORT,
+    LLAMA_CONTEXT_SIZE, LLAMA_GPU_LAYERS, LLAMA_SERVER_STARTUP_TIMEOUT,
+    LLAMA_SERVER_PARALLEL, LLAMA_QUEUE_MAX, LLAMA_QUEUE_TIMEOUT,
+    LLAMA_SERVER_INSTANCES, LLAMA_SERVER_THREADS, LLAMA_SERVER_CPU_AFFINITY,
+    LLAMA_HEALTH_INTERVAL, EMBEDDING_SERVER_URL, EMBEDDING_MODEL_PATH, EMBEDDING_SERVER_PORT,
+    LLAMA_SERVER_EMBEDDINGS
 )
+from services.llama_client import get_llama_client
+from services.llama_health import get_health_prober, LlamaHealthProber
+from services.prompt_cache import PROMPT_PREFIX_CACHE
+from services.response_cache import RESPONSE_CACHE, should_cache, build_cache_key, get_model_identity
 
+# llama-serverの出力先（PIPEのままだとバッファが溢れてサーバーが停止する）
+LLAMA_SERVER_LOG = os.path.join(os.getcwd(), 'logs', 'llama-server.log')
 
-def start_llama_server():
+# 異常終了したインスタンスを再起動するまでの最大待ち時間（秒）
+MAX_RESTART_BACKOFF = 60
+
+
+class LlamaServerInstance:
     """
-    llama-server.exeを起動する関数
+    1つのllama-serverプロセスを表すクラス
+    ポート・スレッド数・CPUアフィニティをインスタンスごとに持つ
+    embeddingsがTrueの場合は/embeddingを使えるよう--embeddings付きで起動する
     """
-    global LLAMA_SERVER_PROCESS
-    
-    # すでに実行中なら何もしない
-    if LLAMA_SERVER_PROCESS is not None and LLAMA_SERVER_PROCESS.poll() is None:
-        logger.info("llama-server is already running")
-        return True
-    
-    # llama-server.exeが存在するか確認
-    if not os.path.exists(LLAMACPP_MAIN):
-        logger.error(f"llama-server executable not found at {LLAMACPP_MAIN}")
-        return False
-    
-    # モデルが選択されているか確認
-    if not SELECTED_MODEL_PATH or not os.path.exists(SELECTED_MODEL_PATH):
-        logger.error("No model selected or model file not found")
+
+    def __init__(self, index, port, threads=None, cpus=None, embeddings=False):
+        self.index = index
+        self.port = port
+        self.threads = threads
+        self.cpus = cpus
+        self.embeddings = embeddings
+        self.base_url = f"http://{LLAMA_SERVER_HOST}:{port}"
+        self.completion_url = f"{self.base_url}/completion"
+        self.health_url = f"{self.base_url}/health"
+        self.log_path = LLAMA_SERVER_LOG if index == 0 else os.path.join(
+            os.path.dirname(LLAMA_SERVER_LOG), f'llama-server-{index}.log'
+        )
+        # 既定ポートのインスタンスは共有のヘルスプローバーを使う
+        self.prober = get_health_prober() if port == LLAMA_SERVER_PORT else LlamaHealthProber(self.health_url)
+
+        self.process = None
+        self.model = None
+        self.external = False
+        self.desired_running = False
+        self.outstanding = 0
+        self.total_requests = 0
+        self.restarts = 0
+        self.last_exit_code = None
+        self.next_restart_at = 0
+
+    def is_process_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def is_routable(self):
+        """リクエストを振り分けてよい状態か（キャッシュされた状態で判定）"""
+        # 管理下のプロセスが終了している場合は、キャッシュが古くても振り分けない
+        if self.desired_running and not self.is_process_alive():
+            return False
+        return self.prober.get_state()['running']
+
+    def check(self):
+        """このインスタンスのヘルスチェックを同期的に行う"""
+        try:
+            response = get_llama_client().get(self.health_url, connect_timeout=1, read_timeout=1, retries=0)
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    def _build_command(self, model_path):
+        cmd = [
+            LLAMACPP_SERVER,
+            '-m', model_path,
+            '--host', LLAMA_SERVER_HOST,
+            '--port', str(self.port),
+            '--ctx-size', str(LLAMA_CONTEXT_SIZE),
+            '-ngl', str(LLAMA_GPU_LAYERS),  # GPUレイヤー数
+            '--parallel', str(LLAMA_SERVER_PARALLEL)  # スケジューラーのスロット数と合わせる
+        ]
+        if self.threads:
+            cmd += ['--threads', str(self.threads)]
+        if self.embeddings:
+            cmd.append('--embeddings')
+        # sched_setaffinityが使えない環境（Windowsなど）ではllama-server側で固定する
+        if self.cpus and not hasattr(os, 'sched_setaffinity'):
+            mask = sum(1 << cpu for cpu in self.cpus)
+            cmd += ['--cpu-mask', format(mask, 'x'), '--cpu-strict', '1']
+        return cmd
+
+    def spawn(self, model_path):
+        """プロセスを起動する（ロード完了は待たない）"""
+        cmd = self._build_command(model_path)
+        logger.info(f"Starting llama-server #{self.index} with command: {' '.join(cmd)}")
+
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+        log_file = open(self.log_path, 'a', encoding='utf-8')
+
+        preexec_fn = None
+        if self.cpus and hasattr(os, 'sched_setaffinity'):
+            cpus = set(self.cpus)
+            # exec前に設定すると、llama-serverが作るすべてのスレッドに引き継がれる
+            preexec_fn = lambda: os.sched_setaffinity(0, cpus)
+
+        try:
+            # サブプロセスとして実行（非ブロッキング）
+            self.process = subprocess.Popen(
+                cmd,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                text=True,
+                encoding='utf-8',
+                preexec_fn=preexec_fn
+            )
+        finally:
+            # 子プロセスがファイルを保持しているので親側は閉じてよい
+            log_file.close()
+
+        self.model = model_path
+        self.external = False
+        self.desired_running = True
+
+    def wait_until_ready(self, timeout=LLAMA_SERVER_STARTUP_TIMEOUT):
+        """モデルのロード完了を待つ（ロード中の/healthは503を返す）"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process is None or self.process.poll() is not None:
+                code = self.process.returncode if self.process is not None else None
+                logger.error(f"llama-server #{self.index} exited with code {code}, see {self.log_path}")
+                return False
+            if self.check():
+                logger.info(f"llama-server #{self.index} started successfully on port {self.port}")
+                self.prober.refresh()
+                return True
+            time.sleep(1)
+
+        logger.error(f"Timed out waiting for llama-server #{self.index} to start")
         return False
-    
-    # llama-server.exeの起動コマンド作成
-    cmd = [
-        LLAMACPP_MAIN,
-        '-m', SELECTED_MODEL_PATH,
-        '--host', LLAMA_SERVER_HOST,
-        '--port', str(LLAMA_SERVER_PORT),
-        '--ctx-size', '2048',
-        '-ngl', '1'  # GPUレイヤー数
+
+    def terminate(self):
+        """プロセスを停止する"""
+        self.desired_running = False
+        self.external = False
+        process = self.process
+        if process is None:
+            return
+
+        logger.info(f"Stopping llama-server #{self.index}")
+        # WindowsとLinuxで異なる終了方法
+        if IS_WINDOWS:
+            # Windowsの場合はtaskkillを使用
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)])
+        else:
+            # Linuxの場合はterminate/killを使用
+            process.terminate()
+            try:
+                process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+        self.process = None
+        self.model = None
+        self.prober.request_refresh()
+
+    def get_status(self):
+        state = self.prober.get_state()
+        return {
+            'index': self.index,
+            'port': self.port,
+            'url': self.completion_url,
+            'pid': self.process.pid if self.is_process_alive() else None,
+            'external': self.external,
+            'threads': self.threads,
+            'cpus': self.cpus,
+            'model': self.model,
+            'outstanding': self.outstanding,
+            'total_requests': self.total_requests,
+            'restarts': self.restarts,
+            'last_exit_code': self.last_exit_code,
+            'health': state
+        }
+
+
+class LlamaServerPool:
+    """
+    複数のllama-serverインスタンスを管理するクラス
+    未処理リクエストが最も少ないインスタンスに振り分け、異常終了したインスタンスは自動で再起動する
+    """
+
+    def __init__(self, instances):
+        self.instances = instances
+        # 同時に複数のリクエストが起動・停止を試みないためのロック
+        self._lifecycle_lock = threading.RLock()
+        self._route_lock = threading.Lock()
+        self._supervisor = None
+
+    @property
+    def primary(self):
+        return self.instances[0]
+
+    def is_serving(self, model_path):
+        """指定したモデルで動いている管理下のインスタンスがあるか"""
+        return any(inst.is_process_alive() and inst.model == model_path for inst in self.instances)
+
+    def has_managed_process(self):
+        return any(inst.is_process_alive() for inst in self.instances)
+
+    def start(self):
+        """
+        すべてのインスタンスを起動する
+        選択中のモデルを一度だけロードし、以降のリクエストで使い回す
+        """
+        with self._lifecycle_lock:
+            model_path = app_config.SELECTED_MODEL_PATH
+
+            # モデルが変わった場合は一度すべて停止する
+            if any(inst.is_process_alive() and inst.model != model_path for inst in self.instances):
+                logger.info(f"Selected model changed, restarting llama-server instances: {model_path}")
+                self.stop()
+
+            pending = [inst for inst in self.instances if not inst.is_process_alive()]
+            if not pending:
+                logger.info("llama-server is already running")
+                return True
+
+            # 外部で起動済みのサーバーが応答する場合はそれを使う
+            if not self.has_managed_process() and self.primary.check():
+                logger.info("Using externally started llama-server")
+                self.primary.external = True
+                self.primary.prober.request_refresh()
+                return True
+
+            # llama-serverの実行ファイルが存在するか確認
+            if not os.path.exists(LLAMACPP_SERVER):
+                logger.error(f"llama-server executable not found at {LLAMACPP_SERVER}")
+                return False
+
+            # モデルが選択されているか確認
+            if not model_path or not os.path.exists(model_path):
+                logger.error("No model selected or model file not found")
+                return False
+
+            # 先にすべて起動してからまとめて待つ（モデルのロードを並行させる）
+            spawned = []
+            for inst in pending:
+                try:
+                    inst.spawn(model_path)
+                    spawned.append(inst)
+                except Exception as e:
+                    logger.exception(f"Error starting llama-server #{inst.index}: {str(e)}")
+
+            ready = [inst.wait_until_ready() for inst in spawned]
+            self._start_supervisor()
+            return any(ready) or any(inst.is_routable() for inst in self.instances)
+
+    def stop(self):
+        """すべてのインスタンスを停止する"""
+        with self._lifecycle_lock:
+            success = True
+            for inst in self.instances:
+                try:
+                    inst.terminate()
+                except Exception as e:
+                    logger.exception(f"Error stopping llama-server #{inst.index}: {str(e)}")
+                    success = False
+            if success:
+                logger.info("llama-server stopped")
+            return success
+
+    @contextmanager
+    def checkout(self, preferred=None):
+        """
+        未処理リクエストが最も少ないインスタンスを選んで確保する
+        preferredのインスタンスに空きスロットがあればそちらを優先する（KVキャッシュの再利用のため）
+        利用できるインスタンスが無い場合はNoneを返す
+        """
+        candidates = [inst for inst in self.instances if inst.is_routable()]
+        instance = None
+        with self._route_lock:
+            favoured = [inst for inst in candidates
+                        if inst.index == preferred and inst.outstanding < LLAMA_SERVER_PARALLEL]
+            if favoured:
+                instance = favoured[0]
+            elif candidates:
+                instance = min(candidates, key=lambda inst: (inst.outstanding, inst.index))
+            if instance is not None:
+                instance.outstanding += 1
+                instance.total_requests += 1
+        try:
+            yield instance
+        finally:
+            if instance is not None:
+                with self._route_lock:
+                    instance.outstanding -= 1
+
+    def _start_supervisor(self):
+        if self._supervisor is not None and self._supervisor.is_alive():
+            return
+        self._supervisor = threading.Thread(target=self._supervise, name='llama-server-supervisor', daemon=True)
+        self._supervisor.start()
+
+    def _supervise(self):
+        """異常終了したインスタンスをバックオフ付きで再起動する"""
+        while True:
+            time.sleep(min(LLAMA_HEALTH_INTERVAL, 2))
+            for inst in self.instances:
+                try:
+                    self._restart_if_crashed(inst)
+                except Exception as e:
+                    logger.exception(f"Error supervising llama-server #{inst.index}: {str(e)}")
+
+    def _restart_if_crashed(self, inst):
+        with self._lifecycle_lock:
+            if not inst.desired_running or inst.process is None or inst.process.poll() is None:
+                return
+            now = time.time()
+            if inst.next_restart_at == 0:
+                inst.last_exit_code = inst.process.returncode
+                backoff = min(MAX_RESTART_BACKOFF, 2 ** min(inst.restarts, 6))
+                inst.next_restart_at = now + backoff
+                logger.warning(f"llama-server #{inst.index} exited unexpectedly with code "
+                               f"{inst.last_exit_code}, restarting in {backoff}s")
+                inst.prober.request_refresh()
+                return
+            if now < inst.next_restart_at:
+                return
+
+            inst.next_restart_at = 0
+            inst.restarts += 1
+            inst.spawn(inst.model or app_config.SELECTED_MODEL_PATH)
+
+        # ロード完了はロックの外で待つ
+        inst.wait_until_ready()
+
+    def get_status(self):
+        return [inst.get_status() for inst in self.instances]
+
+
+def _parse_cpu_list(value):
+    """ "0-3,8" のようなCPUリストを数値のリストに変換する関数"""
+    cpus = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus or None
+
+
+def _build_server_pool():
+    """設定からllama-serverインスタンスのプールを作成する関数"""
+    count = max(1, LLAMA_SERVER_INSTANCES)
+    cpu_count = os.cpu_count() or 1
+
+    # スレッド数の指定が無い場合、複数インスタンス時はCPU数を均等に分割する
+    threads = LLAMA_SERVER_THREADS or (max(1, cpu_count // count) if count > 1 else None)
+
+    affinities = [None] * count
+    if LLAMA_SERVER_CPU_AFFINITY.lower() == 'auto':
+        per_instance = max(1, cpu_count // count)
+        for i in range(count):
+            # インスタンス数がCPU数より多い場合は先頭から順に割り当て直す
+            affinities[i] = [(i * per_instance + k) % cpu_count for k in range(per_instance)]
+    elif LLAMA_SERVER_CPU_AFFINITY:
+        for i, spec in enumerate(LLAMA_SERVER_CPU_AFFINITY.split(';')[:count]):
+            affinities[i] = _parse_cpu_list(spec)
+
+    instances = [
+        LlamaServerInstance(i, LLAMA_SERVER_PORT + i, threads, affinities[i], embeddings=LLAMA_SERVER_EMBEDDINGS)
+        for i in range(count)
     ]
-    
+    return LlamaServerPool(instances)
+
+
+# アプリケーション全体で共有するllama-serverプール
+LLAMA_SERVER_POOL = _build_server_pool()
+
+# 埋め込み専用のllama-server（EMBEDDING_MODEL_PATHを指定した場合のみ）
+EMBEDDING_SERVER = LlamaServerInstance('embedding', EMBEDDING_SERVER_PORT, embeddings=True) if EMBEDDING_MODEL_PATH else None
+_embedding_server_lock = threading.Lock()
+
+
+def is_llama_server_available():
+    """
+    常駐型のllama-serverを利用できるかチェックする関数
+    実行ファイルが存在するか、外部で起動済みのサーバーが応答すればTrue
+    """
+    return os.path.exists(LLAMACPP_SERVER) or is_llama_server_running()
+
+
+def start_llama_server():
+    """
+    llama-serverを起動する関数
+    LLAMA_SERVER_INSTANCES個のインスタンスを起動し、選択中のモデルをロードする
+    """
     try:
-        logger.info(f"Starting llama-server with command: {' '.join(cmd)}")
-        
-        # サブプロセスとして実行（非ブロッキング）
-        LLAMA_SERVER_PROCESS = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding='utf-8'
-        )
-        
-        # サーバーの起動を待つ（最大30秒）
-        for _ in range(30):
-            try:
-                response = requests.get(LLAMA_SERVER_HEALTH_URL, timeout=1)
-                if response.status_code == 200:
-                    logger.info("llama-server started successfully")
-                    return True
-            except:
-                time.sleep(1)
-        
-        # タイムアウト
-        logger.error("Timed out waiting for llama-server to start")
-        return False
-    
+        return LLAMA_SERVER_POOL.start()
     except Exception as e:
         logger.exception(f"Error starting llama-server: {str(e)}")
         return False
 
 
+def start_llama_server_async():
+    """
+    llama-serverをバックグラウンドで起動し、モデルを事前にロードしておく関数
+    """
+    thread = threading.Thread(target=start_llama_server, name='llama-server-warmup', daemon=True)
+    thread.start()
+    return thread
+
+
 def stop_llama_server():
     """
-    llama-server.exeを停止する関数
+    llama-serverを停止する関数
+    """
+    if EMBEDDING_SERVER is not None:
+        with _embedding_server_lock:
+            EMBEDDING_SERVER.terminate()
+    return LLAMA_SERVER_POOL.stop()
+
+
+# バックエンド終了時に常駐させたllama-serverも停止する
+atexit.register(stop_llama_server)
+
+
+def get_llama_server_instances():
+    """インスタンスごとの状態を取得する関数"""
+    return LLAMA_SERVER_POOL.get_status()
+
+
+def refresh_llama_server_health():
+    """すべてのインスタンスの状態を今すぐ確認する関数"""
+    for inst in LLAMA_SERVER_POOL.instances:
+        inst.prober.refresh()
+
+
+def check_llama_server():
+    """
+    llama-serverが実行中かチェックする関数（同期的に問い合わせる）
+    ハンドラからはキャッシュを読むis_llama_server_running()を使う
+    """
+    return any(inst.check() for inst in LLAMA_SERVER_POOL.instances)
+
+
+def is_llama_server_running():
     """
-    global LLAMA_SERVER_PROCESS
+    キャッシュされた状態からllama-serverが実行中か判定する関数
+    """
+    return any(inst.prober.get_state()['running'] for inst in LLAMA_SERVER_POOL.instances)
+
+
+def _ensure_llama_server():
+    """
+    llama-serverが実行中でなければ起動する関数
+    """
+    # 管理下のプロセスが同じモデルで動いていればヘルスチェックの往復を省く
+    if LLAMA_SERVER_POOL.has_managed_process():
+        if LLAMA_SERVER_POOL.is_serving(app_config.SELECTED_MODEL_PATH):
+            return True
+        return start_llama_server()
+    if is_llama_server_running():
+        return True
+    return start_llama_server()
+
+
+# リクエストの優先度（値が小さいほど先に処理される）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+PRIORITY_NAMES = {
+    'interactive': PRIORITY_INTERACTIVE,
+    'batch': PRIORITY_BATCH
+}
+
+
+class LlamaServerBusyError(Exception):
+    """
+    キューが満杯、または待ち時間が上限を超えたことを表す例外
+    retry_afterは再試行までの目安の秒数
+    """
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LlamaRequestScheduler:
+    """
+    llama-serverへのリクエストを制御するスケジューラー
+    同時実行数をllama-serverのスロット数に制限し、待機中のリクエストは優先度順に処理する
+    """
+
+    def __init__(self, slots=LLAMA_SERVER_PARALLEL, max_queue=LLAMA_QUEUE_MAX, queue_timeout=LLAMA_QUEUE_TIMEOUT):
+        self.slots = max(1, slots)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self._waiting = []  # (priority, seq) のヒープ
+        self._seq = itertools.count()
+        self._active = 0
+        self._stats = {
+            'completed': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0
+        }
+        # 1リクエストあたりの処理時間の移動平均（Retry-Afterの見積もりに使う）
+        self._avg_service_sec = 5.0
+
+    def _estimate_retry_after(self):
+        waves = (len(self._waiting) + self._active) / self.slots
+        return max(1, math.ceil(waves * self._avg_service_sec))
+
+    @contextmanager
+    def slot(self, priority=PRIORITY_INTERACTIVE, timings=None):
+        """
+        処理スロットを確保するコンテキストマネージャー
+        キューが満杯の場合はすぐにLlamaServerBusyErrorを送出する
+        """
+        enqueued_at = time.perf_counter()
+        with self._cond:
+            if self._active >= self.slots and len(self._waiting) >= self.max_queue:
+                self._stats['rejected'] += 1
+                raise LlamaServerBusyError(
+                    "llama-serverのリクエストキューが満杯です",
+                    retry_after=self._estimate_retry_after()
+                )
+
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            deadline = enqueued_at + self.queue_timeout
+            try:
+                # 空きスロットがあり、自分が先頭になるまで待つ
+                while self._active >= self.slots or self._waiting[0] != ticket:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise LlamaServerBusyError(
+                            "llama-serverの処理待ちがタイムアウトしました",
+                            retry_after=self._estimate_retry_after()
+                        )
+                    self._cond.wait(remaining)
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+
+            heapq.heappop(self._waiting)
+            self._active += 1
+            wait_ms = (time.perf_counter() - enqueued_at) * 1000
+            self._stats['total_wait_ms'] += wait_ms
+            self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], wait_ms)
+            # 後続の待機者にも空きスロットを確認させる
+            self._cond.notify_all()
+
+        if timings is not None:
+            timings['queue_wait_ms'] = round(wait_ms, 2)
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            service_sec = time.perf_counter() - started
+            with self._cond:
+                self._active -= 1
+                self._stats['completed'] += 1
+                self._avg_service_sec = 0.8 * self._avg_service_sec + 0.2 * service_sec
+                self._cond.notify_all()
+
+    def get_stats(self):
+        """キューの状態と待ち時間の統計を取得する"""
+        with self._cond:
+            queued_by_priority = {}
+            for priority, _ in self._waiting:
+                queued_by_priority[priority] = queued_by_priority.get(priority, 0) + 1
+            completed = self._stats['completed']
+            return {
+                'slots': self.slots,
+                'active': self._active,
+                'queue_depth': len(self._waiting),
+                'queued_by_priority': queued_by_priority,
+                'max_queue': self.max_queue,
+                'completed': completed,
+                'rejected': self._stats['rejected'],
+                'timeouts': self._stats['timeouts'],
+                'avg_wait_ms': round(self._stats['total_wait_ms'] / completed, 2) if completed else 0.0,
+                'max_wait_ms': round(self._stats['max_wait_ms'], 2),
+                'avg_service_ms': round(self._avg_service_sec * 1000, 2)
+            }
+
+
+# アプリケーション全体で共有するスケジューラー
+LLAMA_SCHEDULER = LlamaRequestScheduler(slots=LLAMA_SERVER_PARALLEL * len(LLAMA_SERVER_POOL.instances))
+
+
+def get_scheduler_stats():
+    """スケジューラーの統計を取得する関数"""
+    return LLAMA_SCHEDULER.get_stats()
+
+
+def parse_priority(value):
+    """リクエストで指定された優先度（名前または数値）を解釈する関数"""
+    if value is None:
+        return PRIORITY_INTERACTIVE
+    if isinstance(value, str) and value.lower() in PRIORITY_NAMES:
+        return PRIORITY_NAMES[value.lower()]
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return PRIORITY_INTERACTIVE
+
+
+def _build_completion_payload(prompt, temperature, max_tokens, stream):
+    """
+    llama-serverの/completionに送信するリクエストデータを作成する関数
+    """
+    return {
+        "prompt": prompt,
+        "temperature": temperature,
+        "n_predict": max_tokens,
+        "stop": ["</s>", "[/INST]"],  # 停止トークン
+        "stream": stream,
+        "repeat_penalty": 1.1,
+        "top_p": 0.9,
+        # 前回のリクエストと共通するプレフィックスのKVキャッシュを再利用する
+        "cache_prompt": True
+    }
+
+
+def generate_llm_response(prompt, temperature=0.7, max_tokens=1024,
+                          priority=PRIORITY_INTERACTIVE, timings=None, cache_key=None, use_cache=None):
+    """
+    llama-serverにリクエストを送信してLLMの応答を生成する関数
+    キューが満杯の場合はLlamaServerBusyErrorを送出する
+    timingsに辞書を渡すとキュー待ち時間と生成時間が記録される
+    cache_key（プロファイルID）を指定すると同じスロットに送り、プレフィックスのKVキャッシュを再利用させる
+    応答キャッシュが有効な場合、同じ条件のプロンプトには保存済みの応答を返す（use_cache=Falseで無効）
+    """
+    response_key = None
+    if should_cache(temperature, use_cache):
+        params = _build_completion_payload('', temperature, max_tokens, stream=False)
+        for name in ('prompt', 'stream', 'cache_prompt'):
+            params.pop(name)
+        response_key = build_cache_key(
+            get_model_identity(app_config.SELECTED_MODEL_PATH), cache_key, prompt, params
+        )
+        cached_text = RESPONSE_CACHE.get(response_key)
+        if cached_text is not None:
+            logger.info(f"Response cache hit: {prompt[:100]}...")
+            if timings is not None:
+                timings['response_cache_hit'] = True
+            return cached_text, None
+    
+    # llama-serverが実行中か確認し、実行していなければ起動
+    if not _ensure_llama_server():
+        return None, "llama-serverの起動に失敗しました"
     
-    if LLAMA_SERVER_PROCESS is not None:
-        logger.info("Stopping llama-server")
+    with LLAMA_SCHEDULER.slot(priority, timings), \
+            PROMPT_PREFIX_CACHE.pin(cache_key) as (pinned_instance, pinned_slot), \
+            LLAMA_SERVER_POOL.checkout(pinned_instance) as instance:
+        if instance is None:
+            return None, "利用可能なllama-serverがありません"
         
+        started = time.perf_counter()
         try:
-            # WindowsとLinuxで異なる終了方法
-            if IS_WINDOWS:
-                # Windowsの場合はtaskkillを使用
-                subprocess.run(['taskkill', '/F', '/T', '/PID', str(LLAMA_SERVER_PROCESS.pid)])
-            else:
-                # Linuxの場合はterminate/killを使用
-                LLAMA_SERVER_PROCESS.terminate()
-                time.sleep(2)
-                if LLAMA_SERVER_PROCESS.poll() is None:
-                    LLAMA_SERVER_PROCESS.kill()
+            # リクエストデータ（ストリーミングなし）
+            payload = _build_completion_payload(prompt, temperature, max_tokens, stream=False)
+            if pinned_slot is not None and instance.index == pinned_instance:
+                payload['id_slot'] = pinned_slot
             
-            LLAMA_SERVER_PROCESS = None
-            logger.info("llama-server stopped")
-            return True
+            # APIリクエスト送信
+            logger.info(f"Sending request to llama-server #{instance.index}: {prompt[:100]}...")
+            response = get_llama_client().post(instance.completion_url, json=payload)
+            
+            # レスポンスチェック
+            if response.status_code == 200:
+                data = response.json()
+                PROMPT_PREFIX_CACHE.record(cache_key, data)
+                if timings is not None:
+                    timings['prompt_cached_tokens'] = data.get('tokens_cached', 0)
+                    timings['completion_tokens'] = data.get('tokens_predicted')
+                generated_text = data.get('content', '')
+                logger.info(f"Received response from llama-server: {generated_text[:100]}...")
+                if response_key is not None and generated_text:
+                    RESPONSE_CACHE.put(response_key, generated_text)
+                return generated_text, None
+            else:
+                error_msg = f"llama-server returned error: {response.status_code} - {response.text}"
+                logger.error(error_msg)
+                return None, error_msg
         
         except Exception as e:
-            logger.exception(f"Error stopping llama-server: {str(e)}")
-            return False
+            error_msg = f"Error communicating with llama-server: {str(e)}"
+            logger.exception(error_msg)
+            # キャッシュされた状態が古い可能性があるので再確認を要求
+            instance.prober.request_refresh()
+            return None, error_msg
+        
+        finally:
+            if timings is not None:
+                timings['generation_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def stream_llm_response(prompt, temperature=0.7, max_tokens=1024,
+                        priority=PRIORITY_INTERACTIVE, timings=None, cache_key=None):
+    """
+    llama-serverからトークンを生成され次第受け取るジェネレータ関数
+    (text, error) のタプルを順に返し、エラー時はerrorにメッセージを入れて終了する
+    キューが満杯の場合はLlamaServerBusyErrorを送出する
+    """
+    if not _ensure_llama_server():
+        yield None, "llama-serverの起動に失敗しました"
+        return
     
-    return True
+    payload = _build_completion_payload(prompt, temperature, max_tokens, stream=True)
+    
+    # ストリームを読み終えるまでスロットを確保しておく
+    with LLAMA_SCHEDULER.slot(priority, timings), \
+            PROMPT_PREFIX_CACHE.pin(cache_key) as (pinned_instance, pinned_slot), \
+            LLAMA_SERVER_POOL.checkout(pinned_instance) as instance:
+        if instance is None:
+            yield None, "利用可能なllama-serverがありません"
+            return
+        
+        if pinned_slot is not None and instance.index == pinned_instance:
+            payload['id_slot'] = pinned_slot
+        
+        try:
+            logger.info(f"Sending streaming request to llama-server #{instance.index}: {prompt[:100]}...")
+            # 読み取りタイムアウトはトークン間の待ち時間に対して適用される
+            with get_llama_client().post(instance.completion_url, json=payload, stream=True) as response:
+                if response.status_code != 200:
+                    error_msg = f"llama-server returned error: {response.status_code} - {response.text}"
+                    logger.error(error_msg)
+                    yield None, error_msg
+                    return
+                
+                # llama-serverは "data: {...}" 形式のSSEでトークンを送ってくる
+                for line in response.iter_lines():
+                    if not line or not line.startswith(b'data:'):
+                        continue
+                    
+                    data = json.loads(line[len(b'data:'):].strip().decode('utf-8'))
+                    content = data.get('content', '')
+                    if content:
+                        yield content, None
+                    
+                    if data.get('stop'):
+                        # 最後のイベントにtimingsとtokens_cachedが含まれる
+                        PROMPT_PREFIX_CACHE.record(cache_key, data)
+                        if timings is not None:
+                            timings['prompt_cached_tokens'] = data.get('tokens_cached', 0)
+                            timings['completion_tokens'] = data.get('tokens_predicted')
+                        break
+        
+        except Exception as e:
+            error_msg = f"Error communicating with llama-server: {str(e)}"
+            logger.exception(error_msg)
+            instance.prober.request_refresh()
+            yield None, error_msg
 
 
-def check_llama_server():
+def _parse_embedding_response(data):
+    """/embeddingの応答からベクトルのリストを取り出す（llama-serverのバージョンによって形式が異なる）"""
+    if isinstance(data, dict) and 'data' in data:
+        # OpenAI互換形式
+        items = data['data']
+    elif isinstance(data, dict):
+        items = [data]
+    else:
+        items = data
+    items = sorted(items, key=lambda item: item.get('index', 0))
+
+    vectors = []
+    for item in items:
+        vector = item.get('embedding') or []
+        # --pooling none の場合はトークンごとのベクトルが返るので平均する
+        if vector and isinstance(vector[0], list):
+            vector = [sum(column) / len(vector) for column in zip(*vector)]
+        vectors.append(vector)
+    return vectors
+
+
+def _request_embeddings(url, texts):
+    """/embeddingにまとめて送信する（まとめて受け付けない古いllama-serverには1件ずつ送る）"""
+    client = get_llama_client()
+    response = client.post(url, json={'content': texts})
+    if response.status_code == 200:
+        vectors = _parse_embedding_response(response.json())
+        if len(vectors) == len(texts):
+            return vectors, None
+    elif len(texts) == 1:
+        return None, f"llama-server returned error: {response.status_code} - {response.text}"
+
+    vectors = []
+    for text in texts:
+        response = client.post(url, json={'content': text})
+        if response.status_code != 200:
+            return None, f"llama-server returned error: {response.status_code} - {response.text}"
+        vectors.extend(_parse_embedding_response(response.json())[:1])
+    return vectors, None
+
+
+class EmbeddingsNotConfiguredError(RuntimeError):
     """
-    llama-serverが実行中かチェックする関数
+    埋め込みを計算できるサーバーが設定されていない場合の例外
+    設定を変えない限り成功しないため、再試行せずに利用者へ設定方法を伝える
     """
-    try:
-        response = requests.get(LLAMA_SERVER_HEALTH_URL, timeout=1)
-        return response.status_code == 200
-    except:
-        return False
+
+    def __init__(self):
+        super().__init__(
+            "埋め込みを計算できるllama-serverが設定されていません。"
+            "EMBEDDING_MODEL_PATH・EMBEDDING_SERVER_URL・LLAMA_SERVER_EMBEDDINGSのいずれかを設定してください"
+        )
+
+
+def embeddings_configured():
+    """埋め込みを計算できるサーバーが設定されているか"""
+    return bool(EMBEDDING_SERVER_URL or EMBEDDING_SERVER is not None or LLAMA_SERVER_EMBEDDINGS)
 
 
-def generate_llm_response(prompt, temperature=0.7, max_tokens=1024):
+def _ensure_embedding_server():
     """
-    llama-serverにリクエストを送信してLLMの応答を生成する関数
+    埋め込み専用のllama-serverが実行中でなければ起動する関数
+    異常終了していた場合も次のリクエストで起動し直す
     """
-    # llama-serverが実行中か確認
-    if not check_llama_server():
-        # 実行していなければ起動
-        if not start_llama_server():
-            return None, "llama-serverの起動に失敗しました"
-    
-    try:
-        # リクエストデータ
-        payload = {
-            "prompt": prompt,
-            "temperature": temperature,
-            "n_predict": max_tokens,
-            "stop": ["</s>", "[/INST]"],  # 停止トークン
-            "stream": False,  # ストリーミングなし
-            "repeat_penalty": 1.1,
-            "top_p": 0.9
-        }
-        
-        # APIリクエスト送信
-        logger.info(f"Sending request to llama-server: {prompt[:100]}...")
-        response = requests.post(LLAMA_SERVER_URL, json=payload, timeout=30)
-        
-        # レスポンスチェック
-        if response.status_code == 200:
-            data = response.json()
-            generated_text = data.get('content', '')
-            logger.info(f"Received response from llama-server: {generated_text[:100]}...")
-            return generated_text, None
+    with _embedding_server_lock:
+        if EMBEDDING_SERVER.is_process_alive():
+            return True
+        if EMBEDDING_SERVER.process is not None:
+            EMBEDDING_SERVER.last_exit_code = EMBEDDING_SERVER.process.returncode
+            EMBEDDING_SERVER.restarts += 1
+            logger.warning(f"Embedding llama-server exited with code {EMBEDDING_SERVER.last_exit_code}, restarting")
+        elif EMBEDDING_SERVER.check():
+            EMBEDDING_SERVER.external = True
+            return True
+        if not os.path.exists(LLAMACPP_SERVER):
+            logger.error(f"llama-server executable not found at {LLAMACPP_SERVER}")
+            return False
+        if not os.path.exists(EMBEDDING_MODEL_PATH):
+            logger.error(f"Embedding model not found at {EMBEDDING_MODEL_PATH}")
+            return False
+        EMBEDDING_SERVER.spawn(EMBEDDING_MODEL_PATH)
+        return EMBEDDING_SERVER.wait_until_ready()
+
+
+def get_embedding_server_status():
+    """埋め込み専用のllama-serverの状態を取得する関数（起動しない設定の場合はNone）"""
+    return EMBEDDING_SERVER.get_status() if EMBEDDING_SERVER is not None else None
+
+
+def generate_embeddings(texts, priority=PRIORITY_BATCH):
+    """
+    llama-serverの/embeddingでテキストの埋め込みベクトルを計算する関数
+    (ベクトルのリスト, error) のタプルを返す
+    EMBEDDING_SERVER_URL・EMBEDDING_MODEL_PATHを指定した場合は、スケジューラーを通さずに専用のサーバーへ送る
+    埋め込みを計算できるサーバーが設定されていない場合はEmbeddingsNotConfiguredErrorを送出する
+    """
+    if not embeddings_configured():
+        raise EmbeddingsNotConfiguredError()
+    if not texts:
+        return [], None
+
+    if EMBEDDING_SERVER_URL or EMBEDDING_SERVER is not None:
+        if EMBEDDING_SERVER_URL:
+            url = f"{EMBEDDING_SERVER_URL.rstrip('/')}/embedding"
+        elif _ensure_embedding_server():
+            url = f"{EMBEDDING_SERVER.base_url}/embedding"
         else:
-            error_msg = f"llama-server returned error: {response.status_code} - {response.text}"
-            logger.error(error_msg)
+            return None, "埋め込み用のllama-serverの起動に失敗しました"
+        try:
+            return _request_embeddings(url, texts)
+        except Exception as e:
+            error_msg = f"Error communicating with embedding server: {str(e)}"
+            logger.exception(error_msg)
+            return None, error_msg
+
+    if not _ensure_llama_server():
+        return None, "llama-serverの起動に失敗しました"
+
+    with LLAMA_SCHEDULER.slot(priority), LLAMA_SERVER_POOL.checkout() as instance:
+        if instance is None:
+            return None, "利用可能なllama-serverがありません"
+        try:
+            return _request_embeddings(f"{instance.base_url}/embedding", texts)
+        except Exception as e:
+            error_msg = f"Error communicating with llama-server: {str(e)}"
+            logger.exception(error_msg)
+            instance.prober.request_refresh()
             return None, error_msg
-    
-    except Exception as e:
-        error_msg = f"Error communicating with llama-server: {str(e)}"
-        logger.exception(error_msg)
-        return None, error_msg
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - 文書のパッセージ分割
+大きなテキストファイルを、文の区切りで重なりのあるパッセージに分割してメモリに取り込むモジュール
+ファイルは少しずつ読み込むため、ファイル全体をメモリに載せない
+"""
+
+import re
+import uuid
+from config import (
+    MEMORY_CHUNK_MAX_CHARS, MEMORY_CHUNK_OVERLAP, MEMORY_CHUNK_READ_SIZE, MEMORY_IMPORT_BATCH_SIZE,
+    MEMORY_DEDUP_ON_IMPORT
+)
+
+# 文の終わり（句点・感嘆符・疑問符と、それに続く閉じ括弧）と改行
+# 英文のピリオドは小数点や略語と区別するため、後ろに空白がある場合だけ文の終わりとみなす
+SENTENCE_END = re.compile(
+    r'(?:[。．！？!?…]+|\.(?=\s))[」』）)\]】〉》"\'’”]*[ \t　]*(?:\r\n|\r|\n)*|(?:\r\n|\r|\n)+'
+)
+
+
+def iter_sentences(stream, max_chars=MEMORY_CHUNK_MAX_CHARS, read_size=MEMORY_CHUNK_READ_SIZE):
+    """
+    テキストのストリームを文に分割し、(ファイル先頭からの文字位置, 文) を順に返す
+    句読点の無い長い部分はmax_charsごとに区切る
+    """
+    buffer, offset = '', 0
+    while True:
+        block = stream.read(read_size)
+        buffer += block
+        position = 0
+        for match in SENTENCE_END.finditer(buffer):
+            # バッファの末尾で終わる区切りは、続きの閉じ括弧や改行が次の読み込みにあるかもしれない
+            if block and match.end() == len(buffer):
+                break
+            for start in range(position, match.end(), max_chars):
+                yield offset + start, buffer[start:min(start + max_chars, match.end())]
+            position = match.end()
+        buffer, offset = buffer[position:], offset + position
+
+        while len(buffer) > max_chars:
+            yield offset, buffer[:max_chars]
+            buffer, offset = buffer[max_chars:], offset + max_chars
+
+        if not block:
+            if buffer:
+                yield offset, buffer
+            return
+
+
+def _make_passage(sentences, index):
+    text = ''.join(sentence for _, sentence in sentences)
+    content = text.strip()
+    if not content:
+        return None
+    start = sentences[0][0] + (len(text) - len(text.lstrip()))
+    return {'index': index, 'content': content, 'start': start, 'end': start + len(content)}
+
+
+def iter_passages(stream, max_chars=MEMORY_CHUNK_MAX_CHARS, overlap=MEMORY_CHUNK_OVERLAP):
+    """
+    テキストのストリームを、max_chars以下のパッセージに文の区切りでまとめて順に返す
+    前のパッセージの末尾の文をoverlap文字まで次のパッセージの先頭に重ね、区切りで文脈が途切れないようにする
+    各パッセージは {'index', 'content', 'start', 'end'（ファイル先頭からの文字位置）} の辞書
+    """
+    current, length, has_new, index = [], 0, False, 0
+    for start, sentence in iter_sentences(stream, max_chars):
+        if current and length + len(sentence) > max_chars:
+            passage = _make_passage(current, index)
+            if passage:
+                yield passage
+                index += 1
+
+            kept, kept_length = [], 0
+            for item in reversed(current):
+                if kept_length + len(item[1]) > overlap:
+                    break
+                kept.insert(0, item)
+                kept_length += len(item[1])
+            # 重ねる部分と次の文がmax_charsに収まるようにする
+            while kept and kept_length + len(sentence) > max_chars:
+                kept_length -= len(kept.pop(0)[1])
+            current, length, has_new = kept, kept_length, False
+
+        current.append((start, sentence))
+        length += len(sentence)
+        has_new = has_new or bool(sentence.strip())
+
+    if current and has_new:
+        passage = _make_passage(current, index)
+        if passage:
+            yield passage
+
+
+def import_passages(store, stream, source, memory_type='imported', tags=None,
+                    on_duplicate=MEMORY_DEDUP_ON_IMPORT, batch_size=MEMORY_IMPORT_BATCH_SIZE, on_batch=None,
+                    document_id=None, resume=None):
+    """
+    テキストのストリームをパッセージに分割し、batch_size件ずつメモリに保存する関数
+    同じ文書のパッセージは document_id と 'document:<document_id>' タグでつながり、
+    chunk_index（文書内の順番）と source_start / source_end（元のファイルでの文字位置）を持つ
+    on_batch を指定した場合は、保存するたびにそれまでの結果の辞書を渡して呼ぶ（進捗の報告用）
+    中断した取り込みを続ける場合は、同じdocument_idと中断までにon_batchへ渡された結果をresumeに渡す
+    （保存済みのパッセージは読み飛ばし、結果の件数は続きから数える）
+    戻り値は取り込みの結果の辞書
+    """
+    document_id = document_id or uuid.uuid4().hex[:16]
+    tags = list(tags or []) + [f'document:{document_id}']
+    stats = {'document_id': document_id, 'passages': 0, 'created': 0, 'merged': 0, 'skipped': 0,
+             'duplicates': 0, 'first_id': None}
+    if resume:
+        stats.update({key: resume.get(key, 0) for key in ('passages', 'created', 'merged', 'skipped', 'duplicates')})
+    saved = stats['passages']
+
+    def flush(batch):
+        for result in store.create_deduplicated(batch, on_duplicate=on_duplicate):
+            stats[result['status']] += 1
+            stats['duplicates'] += result.get('duplicate_of') is not None
+            if stats['first_id'] is None:
+                stats['first_id'] = result['id']
+        if on_batch is not None:
+            on_batch(dict(stats))
+
+    batch = []
+    for passage in iter_passages(stream):
+        if passage['index'] < saved:
+            continue
+        batch.append({
+            'content': passage['content'],
+            'type': memory_type,
+            'tags': tags,
+            'strength': 1.0,
+            'source': source,
+            'document_id': document_id,
+            'chunk_index': passage['index'],
+            'source_start': passage['start'],
+            'source_end': passage['end']
+        })
+        stats['passages'] += 1
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return stats
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - メモリの定期整理
+アクティブなプロファイルのメモリの強度を定期的に計算し、弱くなったメモリを整理するモジュール
+ほぼ同じ内容のメモリをまとめる重複整理もバックグラウンドで実行する
+"""
+
+import time
+import threading
+import config as app_config
+from config import logger, MEMORY_CONSOLIDATION_INTERVAL, MEMORY_DEDUP_THRESHOLD
+from services.memory_store import get_memory_store
+
+_thread = None
+_stop = threading.Event()
+
+
+def _run(interval):
+    # 起動直後は他の処理を優先し、1周期待ってから実行する
+    while not _stop.wait(interval):
+        profile_id = app_config.ACTIVE_PROFILE
+        if not profile_id:
+            continue
+        try:
+            get_memory_store(profile_id).consolidate()
+        except Exception as e:
+            logger.exception(f"Memory consolidation failed for profile {profile_id}: {str(e)}")
+
+
+def start_memory_consolidation(interval=MEMORY_CONSOLIDATION_INTERVAL):
+    """定期整理のスレッドを開始する関数（間隔が0の場合や実行中の場合は何もしない）"""
+    global _thread
+    if interval <= 0 or (_thread is not None and _thread.is_alive()):
+        return False
+    _stop.clear()
+    _thread = threading.Thread(target=_run, args=(interval,), name='memory-consolidation', daemon=True)
+    _thread.start()
+    logger.info(f"Memory consolidation scheduled every {interval:.0f}s")
+    return True
+
+
+def stop_memory_consolidation():
+    _stop.set()
+
+
+_dedup_status = {}
+_dedup_lock = threading.Lock()
+
+
+def get_dedup_status(profile_id):
+    """プロファイルの重複整理の状態（一度も実行していない場合は {'state': 'idle'}）"""
+    with _dedup_lock:
+        return dict(_dedup_status.get(profile_id, {'state': 'idle'}))
+
+
+def _run_dedup(profile_id, merge, threshold):
+    started = time.perf_counter()
+    status = {'state': 'running', 'merge': merge, 'threshold': threshold}
+    try:
+        store = get_memory_store(profile_id)
+        groups = store.find_duplicate_groups(threshold)
+        status.update(groups=len(groups), duplicates=sum(len(group) - 1 for group in groups))
+        if merge:
+            merged = 0
+            for group in groups:
+                if store.merge_duplicate_group(group) is not None:
+                    merged += len(group) - 1
+            status['merged'] = merged
+        else:
+            # まとめない場合は、どのメモリが重複しているかを返す
+            clusters = []
+            for group in groups:
+                memories = store.get_by_seqs(group)
+                clusters.append([memories[seq]['id'] for seq in group if seq in memories])
+            status['clusters'] = clusters
+        status['state'] = 'completed'
+        logger.info(f"Memory dedup pass for profile {profile_id}: {status['duplicates']} duplicates "
+                    f"in {status['groups']} groups")
+    except Exception as e:
+        logger.exception(f"Memory dedup pass failed for profile {profile_id}: {str(e)}")
+        status.update(state='failed', error=str(e))
+    status['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    with _dedup_lock:
+        _dedup_status[profile_id] = status
+
+
+def start_dedup_pass(profile_id, merge=False, threshold=MEMORY_DEDUP_THRESHOLD):
+    """
+    重複整理をバックグラウンドで開始する関数（同じプロファイルで実行中の場合はFalse）
+    mergeがTrueの場合は各グループを最も古いメモリにまとめ、Falseの場合は重複の一覧だけを作る
+    """
+    with _dedup_lock:
+        if _dedup_status.get(profile_id, {}).get('state') == 'running':
+            return False
+        _dedup_status[profile_id] = {'state': 'running', 'merge': merge, 'threshold': threshold}
+    threading.Thread(target=_run_dedup, args=(profile_id, merge, threshold),
+                     name='memory-dedup', daemon=True).start()
+    return True
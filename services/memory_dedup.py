@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - メモリの重複検出
+文字のshingleのMinHashと局所性鋭敏ハッシュ（LSH）で、ほぼ同じ内容のメモリを検出するモジュール
+"""
+
+import hashlib
+import unicodedata
+import numpy as np
+from config import MEMORY_DEDUP_SHINGLE_SIZE, MEMORY_DEDUP_MAX_CHARS
+
+# MinHashの数と、LSHのバンド分割（BANDS * ROWS = NUM_PERM）
+# 8行×8バンドでは、類似度0.77前後を境に同じバケットに入る確率が急に高くなる
+NUM_PERM = 64
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+
+# (a * x + b) mod PRIME のハッシュ関数族（aは2^31未満にしてuint64で桁あふれしないようにする）
+_PRIME = np.uint64(4294967311)
+_rng = np.random.RandomState(20240601)
+_A = _rng.randint(1, 2 ** 31, size=NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, 2 ** 32, size=NUM_PERM).astype(np.uint64)
+_BASE = np.uint64(1000003)
+_MASK32 = np.uint64(0xFFFFFFFF)
+
+
+def normalize_for_dedup(text):
+    """表記ゆれ・空白の違いを無視するため、NFKC正規化・小文字化して空白を詰める"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    return ''.join(text.split())[:MEMORY_DEDUP_MAX_CHARS]
+
+
+def shingle_hashes(text, size=MEMORY_DEDUP_SHINGLE_SIZE):
+    """
+    文字のshingle（size文字ずつ重ねて切り出した部分文字列）の32bitハッシュを返す
+    文字コードの配列から多項式ハッシュをnumpyでまとめて計算する
+    """
+    normalized = normalize_for_dedup(text)
+    codes = np.frombuffer(normalized.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) == 0:
+        return codes
+    if len(codes) < size:
+        size = len(codes)
+    hashes = np.zeros(len(codes) - size + 1, dtype=np.uint64)
+    for offset in range(size):
+        hashes = ((hashes * _BASE) + codes[offset:offset + len(hashes)]) & _MASK32
+    return np.unique(hashes)
+
+
+def minhash_signature(text):
+    """本文のMinHashの署名（NUM_PERM個のuint32）を返す（本文が空の場合はNone）"""
+    hashes = shingle_hashes(text)
+    if len(hashes) == 0:
+        return None
+    permuted = (_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME
+    return permuted.min(axis=1).astype(np.uint32)
+
+
+def band_keys(signature):
+    """LSHのバンドごとのバケットのキー（SQLiteに保存できる符号付き64bit整数）"""
+    keys = []
+    for band in range(BANDS):
+        digest = hashlib.blake2b(signature[band * ROWS:(band + 1) * ROWS].tobytes(), digest_size=8).digest()
+        keys.append(int.from_bytes(digest, 'little', signed=True))
+    return keys
+
+
+def estimate_similarity(signature, other):
+    """2つの署名から本文のJaccard類似度を推定する"""
+    return float(np.count_nonzero(signature == other)) / NUM_PERM
+
+
+def signature_from_blob(blob):
+    return np.frombuffer(blob, dtype=np.uint32)
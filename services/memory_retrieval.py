@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - メモリの検索拡張（RAG）
+チャットのメッセージに関連するメモリを取り出し、プロンプトに含めるブロックを作成するモジュール
+"""
+
+import time
+import threading
+import unicodedata
+from datetime import datetime
+from config import (
+    logger, MEMORY_RAG_TOP_K, MEMORY_RAG_MAX_TOKENS, MEMORY_RAG_MIN_SIMILARITY,
+    MEMORY_RAG_RECENCY_HALF_LIFE
+)
+from services.memory_store import get_memory_store
+from services.memory_vectors import get_vector_index
+from services.llama_server import embeddings_configured
+from services.tokenizer import count_tokens_batch
+
+# 候補として多めに取り出す倍率（重み付けと重複除去の後にtop-kを選ぶ）
+CANDIDATE_FACTOR = 4
+# メモリ1件ごとの箇条書きの記号などのトークン数
+MEMORY_LINE_OVERHEAD = 2
+# 埋め込みを計算できなかった場合に意味検索を休止する秒数
+SEMANTIC_RETRY_INTERVAL = 60
+
+_semantic_disabled_until = {}
+_semantic_lock = threading.Lock()
+
+
+def format_memory_block(memories):
+    return "（あなたが覚えている関連する記憶）\n" + ''.join(f"- {m['content']}\n" for m in memories) + "\n"
+
+
+def _recency_weight(memory, now):
+    """作成（更新）からの経過日数に応じて半減する重み"""
+    timestamp = memory.get('updated_at') or memory.get('created_at')
+    try:
+        age_days = max(0.0, (now - datetime.fromisoformat(timestamp)).total_seconds() / 86400)
+    except (TypeError, ValueError):
+        return 0.5
+    return 0.5 ** (age_days / MEMORY_RAG_RECENCY_HALF_LIFE) if MEMORY_RAG_RECENCY_HALF_LIFE > 0 else 1.0
+
+
+def _semantic_candidates(profile_id, message, limit):
+    """意味検索の候補（埋め込みを使えない場合は空）"""
+    # 設定されていない場合は再試行しても成功しないので、全文検索だけを使う
+    if not embeddings_configured():
+        return []
+    with _semantic_lock:
+        if _semantic_disabled_until.get(profile_id, 0) > time.monotonic():
+            return []
+    try:
+        # チャットの応答を待たせないよう、未計算の埋め込みはバックグラウンドで計算する
+        results = get_vector_index(profile_id).search(message, k=limit, sync=False)
+    except Exception as e:
+        logger.warning(f"Semantic memory retrieval unavailable, falling back to full-text search: {str(e)}")
+        with _semantic_lock:
+            _semantic_disabled_until[profile_id] = time.monotonic() + SEMANTIC_RETRY_INTERVAL
+        return []
+    return [m for m in results if m['similarity'] >= MEMORY_RAG_MIN_SIMILARITY]
+
+
+def retrieve_memories(profile_id, message, max_tokens=MEMORY_RAG_MAX_TOKENS, k=MEMORY_RAG_TOP_K):
+    """
+    メッセージに関連するメモリを取り出し、プロンプトに含めるブロックを作成する関数
+    全文検索と意味検索の候補を関連度・強度（strength）・新しさで重み付けし、
+    同じメモリや同じ内容のメモリを除いて、max_tokensに収まるだけ関連の高い順に含める
+    戻り値は {'block', 'tokens', 'memories'（含めたメモリID）, 'retrieval_ms'} の辞書
+    """
+    started = time.perf_counter()
+    result = {'block': '', 'tokens': 0, 'memories': [], 'retrieval_ms': 0.0}
+    store = get_memory_store(profile_id)
+    if k <= 0 or max_tokens <= 0 or not message.strip() or store.count() == 0:
+        return result
+
+    limit = k * CANDIDATE_FACTOR
+    relevance, memories = {}, {}
+
+    # 全文検索のBM25は値の範囲が決まっていないため、最大値で0〜1に揃える
+    keyword = store.search(message, limit=limit, match_any=True)
+    top_score = max((m['score'] for m in keyword), default=0)
+    for memory in keyword:
+        memories[memory['id']] = memory
+        relevance[memory['id']] = memory['score'] / top_score if top_score > 0 else 0.0
+
+    for memory in _semantic_candidates(profile_id, message, limit):
+        memories.setdefault(memory['id'], memory)
+        relevance[memory['id']] = max(relevance.get(memory['id'], 0.0), memory['similarity'])
+
+    now = datetime.now()
+    ranked = []
+    for memory_id, memory in memories.items():
+        strength = min(max(float(memory.get('strength') or 0), 0.0), 1.0)
+        weight = relevance[memory_id] * (0.5 + 0.5 * strength) * (0.5 + 0.5 * _recency_weight(memory, now))
+        ranked.append((weight, memory))
+    ranked.sort(key=lambda item: item[0], reverse=True)
+
+    # 同じ内容のメモリは最も重みの高いものだけを残す
+    selected, seen = [], set()
+    for _, memory in ranked:
+        key = ' '.join(unicodedata.normalize('NFKC', memory['content']).lower().split())
+        if key and key not in seen:
+            seen.add(key)
+            selected.append(memory)
+        if len(selected) >= limit:
+            break
+
+    # トークンの予算に収まるだけ含める（収まらないものは飛ばして次を試す）
+    budget = max_tokens - count_tokens_batch([format_memory_block([])])[0]
+    included = []
+    for memory, tokens in zip(selected, count_tokens_batch([m['content'] for m in selected])):
+        if tokens + MEMORY_LINE_OVERHEAD > budget:
+            continue
+        budget -= tokens + MEMORY_LINE_OVERHEAD
+        included.append(memory)
+        if len(included) >= k:
+            break
+
+    if included:
+        result['block'] = format_memory_block(included)
+        result['tokens'] = max_tokens - budget
+        result['memories'] = [m['id'] for m in included]
+        # 思い出したメモリは強化する
+        try:
+            store.reinforce(result['memories'])
+        except Exception as e:
+            logger.warning(f"Failed to reinforce retrieved memories: {str(e)}")
+    result['retrieval_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return result
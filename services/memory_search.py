@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - メモリ全文検索
+日本語を文字bigramに分割してSQLite FTS5の索引を作成・検索するモジュール
+"""
+
+import html
+import unicodedata
+
+# 1行に含める前後の文字数（スニペット）
+SNIPPET_CONTEXT = 40
+
+# いずれかの語を含むものを検索する場合の語数の上限（長い文章で検索が遅くならないようにする）
+MAX_ANY_TERMS = 32
+
+# CJK統合漢字・かな・全角文字などはこの値以上（単語の区切りが無いためbigramに分割する）
+_CJK_START = 0x2E80
+
+
+def _normalize(text):
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def _segments(text):
+    """
+    文字列を英数字の単語と、区切りの無い日本語などの連続部分に分ける
+    (文字列, 日本語などの場合True) のリストを返す
+    """
+    segments = []
+    current, current_cjk = [], None
+    for ch in text:
+        if not ch.isalnum():
+            if current:
+                segments.append((''.join(current), current_cjk))
+            current, current_cjk = [], None
+            continue
+        is_cjk = ord(ch) >= _CJK_START
+        if current and is_cjk != current_cjk:
+            segments.append((''.join(current), current_cjk))
+            current = []
+        current.append(ch)
+        current_cjk = is_cjk
+    if current:
+        segments.append((''.join(current), current_cjk))
+    return segments
+
+
+def _bigrams(segment):
+    """日本語などの連続部分を重なりのある2文字ずつに分ける（1文字の場合はそのまま）"""
+    if len(segment) < 2:
+        return [segment]
+    return [segment[i:i + 2] for i in range(len(segment) - 1)]
+
+
+def index_text(text):
+    """
+    索引に登録するトークン列を作成する関数
+    英数字は単語単位、日本語などはbigramに分割し、1文字の検索にも一致するよう末尾の1文字も加える
+    """
+    tokens = []
+    for segment, is_cjk in _segments(_normalize(text)):
+        if is_cjk:
+            tokens.extend(_bigrams(segment))
+            if len(segment) > 1:
+                tokens.append(segment[-1])
+        else:
+            tokens.append(segment)
+    return ' '.join(tokens)
+
+
+def _quote(token):
+    return '"' + token.replace('"', '""') + '"'
+
+
+def build_match_query(query, match_any=False):
+    """
+    検索文字列をFTS5のMATCH式に変換する関数
+    空白で区切った語はすべて含むもの（AND）を検索し、英数字の単語は前方一致、
+    日本語は連続したbigramのフレーズとして検索する。検索できる語が無い場合はNone
+    match_anyがTrueの場合は、チャットのメッセージのような文章からいずれかの語を含むもの（OR）を検索する
+    """
+    if match_any:
+        return _build_any_query(query)
+
+    clauses = []
+    for segment, is_cjk in _segments(_normalize(query)):
+        if is_cjk and len(segment) > 1:
+            clauses.append(_quote(' '.join(_bigrams(segment))))
+        else:
+            # 1文字の日本語は、その文字で始まるbigramに前方一致させる
+            clauses.append(_quote(segment) + '*')
+    return ' AND '.join(clauses) if clauses else None
+
+
+def _build_any_query(query):
+    """文章中の英数字の単語と日本語のbigramを、いずれかを含むもの（OR）として検索するMATCH式"""
+    clauses = []
+    for segment, is_cjk in _segments(_normalize(query)):
+        for token in (_bigrams(segment) if is_cjk else [segment]):
+            clause = _quote(token) if is_cjk and len(token) > 1 else _quote(token) + '*'
+            if clause not in clauses:
+                clauses.append(clause)
+    return ' OR '.join(clauses[:MAX_ANY_TERMS]) if clauses else None
+
+
+def query_terms(query):
+    """スニペットで強調する語を取得する関数"""
+    return [segment for segment, _ in _segments(_normalize(query))]
+
+
+def make_snippet(content, terms, context=SNIPPET_CONTEXT):
+    """
+    最初に一致した語の前後を切り出し、一致した部分を<mark>で囲んだスニペットを作成する関数
+    本文はHTMLエスケープする
+    """
+    normalized = _normalize(content)
+    # NFKCで文字数が変わる場合は元の本文の位置と一致しないので、正規化した本文から切り出す
+    source = content if len(normalized) == len(content) else normalized
+    lowered = source.lower()
+
+    positions = [(lowered.find(term), term) for term in terms if term]
+    positions = [(pos, term) for pos, term in positions if pos >= 0]
+    if not positions:
+        excerpt = source[:context * 2]
+        suffix = '…' if len(source) > len(excerpt) else ''
+        return html.escape(excerpt) + suffix
+
+    first = min(pos for pos, _ in positions)
+    start = max(0, first - context)
+    end = min(len(source), first + context * 2)
+    excerpt, excerpt_lower = source[start:end], lowered[start:end]
+
+    # 一致した範囲を求めて<mark>で囲む
+    marked = [False] * len(excerpt)
+    for term in terms:
+        pos = excerpt_lower.find(term)
+        while term and pos >= 0:
+            for i in range(pos, pos + len(term)):
+                marked[i] = True
+            pos = excerpt_lower.find(term, pos + len(term))
+
+    parts, in_mark = [], False
+    for ch, is_marked in zip(excerpt, marked):
+        if is_marked != in_mark:
+            parts.append('<mark>' if is_marked else '</mark>')
+            in_mark = is_marked
+        parts.append(html.escape(ch))
+    if in_mark:
+        parts.append('</mark>')
+
+    return ('…' if start > 0 else '') + ''.join(parts) + ('…' if end < len(source) else '')
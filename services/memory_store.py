@@ -0,0 +1,1079 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - メモリストア
+プロファイルごとのメモリをSQLite（WALモード）で管理するモジュール
+"""
+
+import os
+import json
+import base64
+import sqlite3
+import time
+import threading
+import numpy as np
+from datetime import datetime
+from contextlib import contextmanager
+from config import (
+    logger, PROFILES_DIR, MEMORY_STRENGTH_HALF_LIFE, MEMORY_PRUNE_THRESHOLD, MEMORY_PRUNE_MODE,
+    MEMORY_DEDUP_THRESHOLD
+)
+from services.memory_search import index_text, build_match_query, query_terms, make_snippet
+from services.memory_strength import (
+    effective_strength, effective_strengths, decay_key, decay_keys, reinforced_strength, MAX_STRENGTH
+)
+from services.memory_dedup import minhash_signature, band_keys, estimate_similarity, signature_from_blob
+
+# 全文検索索引の形式のバージョン（トークン分割の方法を変えた場合は上げて再作成させる）
+FTS_INDEX_VERSION = '1'
+# タグの索引の形式のバージョン
+TAG_INDEX_VERSION = '1'
+# 重複検出の索引の形式のバージョン（署名の計算方法を変えた場合は上げて再作成させる）
+MINHASH_INDEX_VERSION = '1'
+# 重複したメモリの扱い
+DUPLICATE_MODES = ('keep', 'flag', 'skip', 'merge')
+
+# メモリの基本フィールド（それ以外のフィールドはextraにJSONで保存する）
+MEMORY_FIELDS = ('id', 'content', 'type', 'tags', 'created_at', 'strength', 'updated_at',
+                 'access_count', 'last_accessed')
+# 内部で管理する列（extraには保存しない）
+_INTERNAL_FIELDS = ('strength_at', 'decay_key', 'archived_at')
+# 強度の列を追加する前のデータベース向けの列定義
+_STRENGTH_COLUMNS = (
+    ('strength_at', 'REAL'),
+    ('decay_key', 'REAL'),
+    ('access_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('last_accessed', 'TEXT')
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS memories (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    content TEXT NOT NULL,
+    type TEXT NOT NULL DEFAULT 'general',
+    tags TEXT NOT NULL DEFAULT '[]',
+    strength REAL NOT NULL DEFAULT 1.0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT,
+    extra TEXT,
+    strength_at REAL,
+    decay_key REAL,
+    access_count INTEGER NOT NULL DEFAULT 0,
+    last_accessed TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_memories_type ON memories (type, created_at);
+CREATE INDEX IF NOT EXISTS idx_memories_created_at ON memories (created_at, seq);
+CREATE INDEX IF NOT EXISTS idx_memories_updated_at ON memories (COALESCE(updated_at, created_at));
+CREATE TABLE IF NOT EXISTS archived_memories (
+    id TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    type TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    strength REAL NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT,
+    extra TEXT,
+    strength_at REAL,
+    access_count INTEGER NOT NULL DEFAULT 0,
+    last_accessed TEXT,
+    archived_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5 (
+    content, content='', tokenize='unicode61 remove_diacritics 0'
+);
+CREATE TABLE IF NOT EXISTS memory_embeddings (
+    seq INTEGER PRIMARY KEY,
+    row INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_memory_embeddings_hash ON memory_embeddings (content_hash);
+CREATE TABLE IF NOT EXISTS memory_tags (
+    tag TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (tag, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_memory_tags_seq ON memory_tags (seq);
+CREATE TABLE IF NOT EXISTS memory_minhash (
+    seq INTEGER PRIMARY KEY,
+    signature BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS memory_lsh (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (band, bucket, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_memory_lsh_seq ON memory_lsh (seq);
+"""
+
+
+def _tag_filter(tags, mode='all', column='seq'):
+    """
+    タグで絞り込むSQLの条件と引数を作成する
+    タグごとのメモリの行番号はmemory_tagsに整列して保存しているため、
+    all（すべてを含む）は集合の積（INTERSECT）、any（いずれかを含む）は和で求める
+    """
+    if not tags:
+        return '', []
+    tags = [str(tag) for tag in tags]
+    if mode == 'any':
+        placeholders = ','.join('?' * len(tags))
+        return f" AND {column} IN (SELECT seq FROM memory_tags WHERE tag IN ({placeholders}))", tags
+    subqueries = ' INTERSECT '.join(['SELECT seq FROM memory_tags WHERE tag = ?'] * len(tags))
+    return f" AND {column} IN ({subqueries})", tags
+
+
+class _BatchAborted(Exception):
+    """一括操作のいずれかが失敗し、トランザクションを取り消すための例外"""
+
+
+# 一覧の並び替えに使える項目と、対応するSQLの式（それぞれインデックスがある）
+SORT_EXPRESSIONS = {
+    'created_at': 'created_at',
+    'updated_at': 'COALESCE(updated_at, created_at)',
+    'strength': 'decay_key'
+}
+
+
+def _current_strength(row):
+    """保存された強度を、最後に強化されてからの経過時間で減衰させた値（読み込み時に計算する）"""
+    return round(effective_strength(row['strength'], row['strength_at']), 4)
+
+
+def _row_to_memory(row, fields=None):
+    """
+    データベースの行をAPIで返すメモリの辞書に変換する
+    fieldsを指定した場合は、その項目（とid）だけを返す
+    """
+    columns = row.keys()
+    if fields is None:
+        memory = {
+            'id': row['id'],
+            'content': row['content'],
+            'type': row['type'],
+            'tags': json.loads(row['tags']) if row['tags'] else [],
+            'created_at': row['created_at'],
+            'strength': _current_strength(row)
+        }
+        if row['updated_at']:
+            memory['updated_at'] = row['updated_at']
+        if row['access_count']:
+            memory['access_count'] = row['access_count']
+            memory['last_accessed'] = row['last_accessed']
+        if 'archived_at' in columns:
+            memory['archived_at'] = row['archived_at']
+        if row['extra']:
+            memory.update(json.loads(row['extra']))
+        return memory
+
+    memory = {'id': row['id']}
+    extra = json.loads(row['extra']) if 'extra' in columns and row['extra'] else {}
+    for field in fields:
+        if field == 'tags':
+            memory['tags'] = json.loads(row['tags']) if row['tags'] else []
+        elif field == 'strength':
+            memory['strength'] = _current_strength(row)
+        elif field in MEMORY_FIELDS and field in columns:
+            if row[field] is not None:
+                memory[field] = row[field]
+        elif field in extra:
+            memory[field] = extra[field]
+    return memory
+
+
+def validate_memory_changes(changes, require_content=False):
+    """
+    メモリの作成・更新の内容を確かめる関数
+    問題がある場合はエラーメッセージを、無い場合はNoneを返す
+    """
+    if not isinstance(changes, dict):
+        return '更新内容はオブジェクトで指定してください'
+    if require_content and not changes.get('content'):
+        return 'メモリの内容が指定されていません'
+    if 'content' in changes and not (isinstance(changes['content'], str) and changes['content'].strip()):
+        return 'メモリの内容を空にすることはできません'
+    if 'tags' in changes and changes['tags'] is not None and not (
+            isinstance(changes['tags'], list) and all(isinstance(tag, str) for tag in changes['tags'])):
+        return 'タグ（tags）は文字列のリストで指定してください'
+    if 'strength' in changes:
+        strength = changes['strength']
+        if isinstance(strength, bool) or not isinstance(strength, (int, float)) or strength != strength:
+            return '強度（strength）は数値で指定してください'
+    return None
+
+
+def encode_cursor(sort, descending, value, seq):
+    """一覧の続きを取得するためのカーソル（並び替えの値と行番号）を作成する"""
+    payload = json.dumps([sort, bool(descending), value, seq], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort, descending):
+    """カーソルを(値, 行番号)に戻す（並び順が異なるカーソルや壊れたカーソルはValueError）"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, cursor_desc, value, seq = json.loads(base64.urlsafe_b64decode(padded).decode('utf-8'))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if cursor_sort != sort or cursor_desc != bool(descending):
+        raise ValueError("cursor does not match the sort order")
+    return value, int(seq)
+
+
+class MemoryStore:
+    """
+    1つのプロファイルのメモリを保存するストア
+    WALモードのため読み込みは書き込み中でもブロックされず、書き込みは1件ごとにインデックスの更新だけで済む
+    接続はスレッドごとに作成し、書き込みはロックで1つずつ実行する
+    """
+
+    def __init__(self, profile_id, profiles_dir=PROFILES_DIR):
+        self.profile_id = profile_id
+        self.memory_dir = os.path.join(profiles_dir, profile_id, 'memory')
+        self.db_path = os.path.join(self.memory_dir, 'memories.db')
+        self.json_path = os.path.join(self.memory_dir, 'memories.json')
+
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        # 同時に要求された単発の書き込みをまとめてコミットするための待ち行列
+        self._group_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending_writes = []
+
+        os.makedirs(self.memory_dir, exist_ok=True)
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        self._migrate_json()
+        self._ensure_fts_index()
+        self._ensure_tag_index()
+        self._ensure_strength_columns()
+        self._ensure_minhash_index()
+
+    def _connect(self):
+        """このスレッド用の接続を取得する"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WALではNORMALでもコミット済みのデータは壊れない（電源断時に直近のコミットが失われうるのみ）
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """書き込みトランザクション（例外が発生した場合はロールバックする）"""
+        conn = self._connect()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def execute(self, sql, params=()):
+        """読み込み用のクエリを実行する"""
+        return self._connect().execute(sql, params)
+
+    def get_meta(self, key, default=None):
+        return self._get_meta(self._connect(), key, default)
+
+    def _get_meta(self, conn, key, default=None):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else default
+
+    def _set_meta(self, conn, key, value):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _next_id(self, conn):
+        """
+        新しいメモリIDを採番する
+        旧形式と同じ連番の文字列だが、削除後も番号を再利用しないため重複しない
+        """
+        next_id = int(self._get_meta(conn, 'next_id', 1))
+        while conn.execute("SELECT 1 FROM memories WHERE id = ?", (str(next_id),)).fetchone():
+            next_id += 1
+        self._set_meta(conn, 'next_id', next_id + 1)
+        return str(next_id)
+
+    def _insert(self, conn, memory, signature=None):
+        """
+        メモリを1件挿入する（idが無い、または既に使われている場合は採番する）
+        signatureには計算済みのMinHashの署名を渡せる（書き込みのロック中に計算しないため）
+        """
+        memory_id = memory.get('id')
+        if memory_id is None or conn.execute(
+                "SELECT 1 FROM memories WHERE id = ?", (str(memory_id),)).fetchone():
+            memory_id = self._next_id(conn)
+        memory_id = str(memory_id)
+
+        extra = {key: value for key, value in memory.items()
+                 if key not in MEMORY_FIELDS and key not in _INTERNAL_FIELDS}
+        created_at = memory.get('created_at') or datetime.now().isoformat()
+        tags = memory.get('tags') or []
+        # 指定された強度は作成時点の値として、ここから減衰させる
+        strength = min(max(float(memory.get('strength', MAX_STRENGTH)), 0.0), MAX_STRENGTH)
+        strength_at = time.time()
+        cursor = conn.execute(
+            "INSERT INTO memories (id, content, type, tags, strength, created_at, updated_at, extra, "
+            "strength_at, decay_key, access_count, last_accessed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                memory_id, memory['content'], memory.get('type') or 'general',
+                json.dumps(tags, ensure_ascii=False), strength,
+                created_at, memory.get('updated_at'),
+                json.dumps(extra, ensure_ascii=False) if extra else None,
+                strength_at, decay_key(strength, strength_at),
+                int(memory.get('access_count') or 0), memory.get('last_accessed')
+            )
+        )
+        self._index_content(conn, cursor.lastrowid, memory['content'])
+        self._index_tags(conn, cursor.lastrowid, tags)
+        if signature is None:
+            signature = minhash_signature(memory['content'])
+        self._index_minhash(conn, cursor.lastrowid, signature)
+        return memory_id
+
+    def _index_content(self, conn, seq, content):
+        conn.execute("INSERT INTO memories_fts (rowid, content) VALUES (?, ?)", (seq, index_text(content)))
+
+    def _unindex_content(self, conn, seq, content):
+        # 本文を持たない索引なので、削除時は登録したときと同じトークン列を渡す
+        conn.execute(
+            "INSERT INTO memories_fts (memories_fts, rowid, content) VALUES ('delete', ?, ?)",
+            (seq, index_text(content))
+        )
+
+    def _invalidate_embedding(self, conn, seq):
+        """本文が変わった・削除されたメモリの埋め込みを無効にする（次の同期で再計算される）"""
+        if conn.execute("DELETE FROM memory_embeddings WHERE seq = ?", (seq,)).rowcount:
+            version = int(self._get_meta(conn, 'embeddings_version', 0))
+            self._set_meta(conn, 'embeddings_version', version + 1)
+
+    def _index_tags(self, conn, seq, tags):
+        conn.executemany(
+            "INSERT OR IGNORE INTO memory_tags (tag, seq) VALUES (?, ?)",
+            [(str(tag), seq) for tag in tags or []]
+        )
+
+    def _index_minhash(self, conn, seq, signature):
+        """重複検出用の署名と、LSHのバケットを登録する"""
+        if signature is None:
+            return
+        conn.execute("INSERT OR REPLACE INTO memory_minhash (seq, signature) VALUES (?, ?)",
+                     (seq, signature.tobytes()))
+        conn.executemany(
+            "INSERT OR IGNORE INTO memory_lsh (band, bucket, seq) VALUES (?, ?, ?)",
+            [(band, bucket, seq) for band, bucket in enumerate(band_keys(signature))]
+        )
+
+    def _unindex_minhash(self, conn, seq):
+        conn.execute("DELETE FROM memory_lsh WHERE seq = ?", (seq,))
+        conn.execute("DELETE FROM memory_minhash WHERE seq = ?", (seq,))
+
+    def _ensure_minhash_index(self):
+        """重複検出の索引が無い・古い場合に既存のメモリから作成する"""
+        conn = self._connect()
+        if self._get_meta(conn, 'minhash_index_version') == MINHASH_INDEX_VERSION:
+            return
+        rows = conn.execute("SELECT seq, content FROM memories").fetchall()
+        # 署名はロックの外で計算しておく
+        signatures = [(row['seq'], minhash_signature(row['content'])) for row in rows]
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM memory_lsh")
+            conn.execute("DELETE FROM memory_minhash")
+            for seq, signature in signatures:
+                self._index_minhash(conn, seq, signature)
+            self._set_meta(conn, 'minhash_index_version', MINHASH_INDEX_VERSION)
+        if signatures:
+            logger.info(f"Built duplicate index for {len(signatures)} memories of profile {self.profile_id}")
+
+    def _ensure_tag_index(self):
+        """タグの索引が無い・古い場合に既存のメモリから作成する"""
+        conn = self._connect()
+        if self._get_meta(conn, 'tag_index_version') == TAG_INDEX_VERSION:
+            return
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM memory_tags")
+            conn.execute(
+                "INSERT OR IGNORE INTO memory_tags (tag, seq) "
+                "SELECT CAST(json_each.value AS TEXT), memories.seq FROM memories, json_each(memories.tags)"
+            )
+            self._set_meta(conn, 'tag_index_version', TAG_INDEX_VERSION)
+
+    def _ensure_strength_columns(self):
+        """
+        強度の減衰に使う列が無い古いデータベースに列を追加し、並び替えキーを計算する
+        既存のメモリは、この時点から減衰を始める（古いメモリがまとめて整理されないようにする）
+        半減期の設定が変わった場合も並び替えキーを計算し直す
+        """
+        conn = self._connect()
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(memories)")}
+        with self.transaction() as conn:
+            for name, definition in _STRENGTH_COLUMNS:
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE memories ADD COLUMN {name} {definition}")
+            conn.execute("DROP INDEX IF EXISTS idx_memories_strength")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_memories_decay ON memories (decay_key)")
+            conn.execute("UPDATE memories SET strength_at = ? WHERE strength_at IS NULL", (time.time(),))
+
+            if self._get_meta(conn, 'strength_half_life') == str(MEMORY_STRENGTH_HALF_LIFE) and \
+                    conn.execute("SELECT 1 FROM memories WHERE decay_key IS NULL LIMIT 1").fetchone() is None:
+                return
+            rows = conn.execute("SELECT seq, strength, strength_at FROM memories").fetchall()
+            if rows:
+                data = np.array(rows, dtype=np.float64)
+                keys = decay_keys(data[:, 1], data[:, 2])
+                conn.executemany(
+                    "UPDATE memories SET decay_key = ? WHERE seq = ?",
+                    zip(keys.tolist(), data[:, 0].astype(np.int64).tolist())
+                )
+            self._set_meta(conn, 'strength_half_life', MEMORY_STRENGTH_HALF_LIFE)
+
+    def _ensure_fts_index(self):
+        """全文検索索引が無い・古い場合に既存のメモリから作成する"""
+        conn = self._connect()
+        if self._get_meta(conn, 'fts_index_version') == FTS_INDEX_VERSION:
+            return
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO memories_fts (memories_fts) VALUES ('delete-all')")
+            count = 0
+            for row in conn.execute("SELECT seq, content FROM memories").fetchall():
+                self._index_content(conn, row['seq'], row['content'])
+                count += 1
+            self._set_meta(conn, 'fts_index_version', FTS_INDEX_VERSION)
+        if count:
+            logger.info(f"Built full-text index for {count} memories of profile {self.profile_id}")
+
+    def _migrate_json(self):
+        """
+        旧形式のmemories.jsonを一度だけ取り込む
+        取り込み後のファイルはmemories.json.migratedとして残す
+        """
+        if not os.path.exists(self.json_path):
+            return
+
+        conn = self._connect()
+        if self._get_meta(conn, 'migrated_from_json'):
+            return
+
+        try:
+            with open(self.json_path, 'r', encoding='utf-8') as f:
+                memories = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load memories file for migration: {str(e)}")
+            return
+
+        # 数値のIDの続きから採番する
+        numeric_ids = [int(m['id']) for m in memories if str(m.get('id', '')).isdigit()]
+        renumbered = 0
+        with self.transaction() as conn:
+            self._set_meta(conn, 'next_id', max(numeric_ids + [len(memories)]) + 1)
+            for memory in memories:
+                if not isinstance(memory, dict) or 'content' not in memory:
+                    continue
+                # 旧形式では削除後に同じIDが重複することがあるため、重複分は振り直す
+                if self._insert(conn, memory) != str(memory.get('id')):
+                    renumbered += 1
+            self._set_meta(conn, 'migrated_from_json', datetime.now().isoformat())
+
+        os.replace(self.json_path, self.json_path + '.migrated')
+        logger.info(f"Migrated {len(memories)} memories of profile {self.profile_id} to SQLite "
+                    f"({renumbered} duplicate ids renumbered)")
+
+    def get(self, memory_id):
+        """IDでメモリを取得する（無い場合はNone）"""
+        row = self._connect().execute("SELECT * FROM memories WHERE id = ?", (str(memory_id),)).fetchone()
+        return _row_to_memory(row) if row else None
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+
+    def get_by_seqs(self, seqs):
+        """内部の行番号（seq）でメモリをまとめて取得する（{seq: メモリ}の辞書を返す）"""
+        seqs = [int(seq) for seq in seqs]
+        if not seqs:
+            return {}
+        placeholders = ','.join('?' * len(seqs))
+        rows = self._connect().execute(f"SELECT * FROM memories WHERE seq IN ({placeholders})", seqs)
+        return {row['seq']: _row_to_memory(row) for row in rows}
+
+    def iter_memories(self, memory_type=None, tags=None, sort='created_at', descending=False,
+                      fields=None, after=None, limit=None, with_cursor=False, tag_mode='all'):
+        """
+        メモリを並び替えて返すジェネレータ（全件をリストに読み込まない）
+        sortはSORT_EXPRESSIONSのいずれか（同じ値の場合は作成順）
+        tagsはtag_modeが'all'ならすべて、'any'ならいずれかを含むものに絞り込む
+        fieldsを指定すると必要な列だけを読み込む（contentを除くと大きな本文を読まずに済む）
+        afterにはencode_cursorで作成したカーソルを指定し、その続きから返す
+        with_cursorがTrueの場合は (メモリ, そのメモリの次から続けるカーソル) を返す
+        """
+        expression = SORT_EXPRESSIONS.get(sort)
+        if expression is None:
+            raise ValueError(f"unsupported sort: {sort}")
+
+        if fields is None:
+            columns = '*'
+        else:
+            unknown = [field for field in fields if field not in MEMORY_FIELDS]
+            needed = {'id'} | {field for field in fields if field in MEMORY_FIELDS} | ({'extra'} if unknown else set())
+            if 'strength' in needed:
+                needed.add('strength_at')
+            columns = ', '.join(sorted(needed))
+        direction = 'DESC' if descending else 'ASC'
+
+        sql = f"SELECT seq, {expression} AS sort_value, {columns} FROM memories WHERE 1 = 1"
+        params = []
+        if memory_type:
+            sql += " AND type = ?"
+            params.append(memory_type)
+        tag_sql, tag_params = _tag_filter(tags, tag_mode)
+        sql += tag_sql
+        params.extend(tag_params)
+        if after:
+            value, seq = decode_cursor(after, sort, descending)
+            sql += f" AND ({expression}, seq) {'<' if descending else '>'} (?, ?)"
+            params.extend([value, seq])
+        sql += f" ORDER BY {expression} {direction}, seq {direction}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+
+        for row in self._connect().execute(sql, params):
+            memory = _row_to_memory(row, fields)
+            if with_cursor:
+                yield memory, encode_cursor(sort, descending, row['sort_value'], row['seq'])
+            else:
+                yield memory
+
+    def list_page(self, limit=50, **options):
+        """
+        1ページ分のメモリと、次のページのカーソル（最後のページの場合はNone）を返す
+        optionsはiter_memoriesと同じ
+        """
+        rows = list(self.iter_memories(limit=limit + 1, with_cursor=True, **options))
+        next_cursor = rows[limit - 1][1] if len(rows) > limit else None
+        return [memory for memory, _ in rows[:limit]], next_cursor
+
+    def _group_write(self, operation):
+        """
+        operation(conn)を、同時に要求された他のスレッドの書き込みとまとめて1回のコミットで実行する
+        先に待っていたスレッドがまとめて実行する役になり、各書き込みはSAVEPOINTで分けるため
+        1件が失敗しても他の書き込みには影響しない。operationの戻り値を返す（例外はそのまま送出する）
+        """
+        entry = {'operation': operation, 'done': False, 'result': None, 'error': None}
+        with self._pending_lock:
+            self._pending_writes.append(entry)
+
+        with self._group_lock:
+            if not entry['done']:
+                with self._pending_lock:
+                    group, self._pending_writes = self._pending_writes, []
+                try:
+                    with self.transaction() as conn:
+                        for item in group:
+                            conn.execute("SAVEPOINT group_write")
+                            try:
+                                item['result'] = item['operation'](conn)
+                            except Exception as e:
+                                conn.execute("ROLLBACK TO group_write")
+                                item['error'] = e
+                            conn.execute("RELEASE group_write")
+                except Exception as e:
+                    # コミットに失敗した場合はすべての書き込みが失敗
+                    for item in group:
+                        item['error'] = item['error'] or e
+                finally:
+                    for item in group:
+                        item['done'] = True
+                if len(group) > 1:
+                    logger.debug(f"Group-committed {len(group)} memory writes")
+
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['result']
+
+    def create(self, content, memory_type='general', tags=None, strength=1.0, created_at=None, **extra):
+        """メモリを1件作成する"""
+        memory = dict(extra, content=content, type=memory_type, tags=tags or [],
+                      strength=strength, created_at=created_at)
+        memory.pop('id', None)
+        memory_id = self._group_write(lambda conn: self._insert(conn, memory))
+        return self.get(memory_id)
+
+    def create_many(self, memories):
+        """複数のメモリを1つのトランザクションで作成する"""
+        memories = [dict(memory) for memory in memories]
+        signatures = [minhash_signature(memory.get('content')) for memory in memories]
+        memory_ids = []
+        with self.transaction() as conn:
+            for memory, signature in zip(memories, signatures):
+                memory.pop('id', None)
+                memory_ids.append(self._insert(conn, memory, signature))
+        return memory_ids
+
+    def create_deduplicated(self, memories, on_duplicate='flag', threshold=MEMORY_DEDUP_THRESHOLD):
+        """
+        既存のメモリとほぼ同じ内容かを確かめながらメモリを作成する
+        on_duplicateが'flag'なら作成して重複先を報告し、'skip'なら作成せず、
+        'merge'なら作成せずに既存のメモリへタグを統合して強化する（'keep'は確かめない）
+        同じ呼び出しの中で先に作成したメモリとの重複も検出する
+        戻り値はメモリごとの {'status': 'created' | 'skipped' | 'merged', 'id', 'duplicate_of', 'similarity'} のリスト
+        内容が不正なメモリがある場合は、何も作成せずにValueError（何件目のメモリかを含む）を送出する
+        """
+        if on_duplicate not in DUPLICATE_MODES:
+            raise ValueError(f"不明な重複の扱いです: {on_duplicate}")
+        memories = [dict(memory) for memory in memories]
+        for index, memory in enumerate(memories):
+            error = validate_memory_changes(memory, require_content=True)
+            if error:
+                raise ValueError(f"{index + 1}件目のメモリ: {error}")
+        signatures = [minhash_signature(memory.get('content')) for memory in memories]
+
+        def operation(conn):
+            results = []
+            for memory, signature in zip(memories, signatures):
+                memory.pop('id', None)
+                duplicate = None
+                if on_duplicate != 'keep' and signature is not None:
+                    duplicate = self._find_duplicate(conn, signature, threshold)
+                if duplicate is None:
+                    results.append({'status': 'created', 'id': self._insert(conn, memory, signature)})
+                    continue
+
+                seq, duplicate_id, similarity = duplicate
+                result = {'duplicate_of': duplicate_id, 'similarity': round(similarity, 4)}
+                if on_duplicate == 'flag':
+                    results.append(dict(result, status='created', id=self._insert(conn, memory, signature)))
+                elif on_duplicate == 'merge':
+                    self._merge_into(conn, seq, [memory.get('tags') or []])
+                    results.append(dict(result, status='merged', id=duplicate_id))
+                else:
+                    results.append(dict(result, status='skipped', id=None))
+            return results
+
+        return self._group_write(operation)
+
+    def _find_duplicate(self, conn, signature, threshold, exclude_seq=None):
+        """
+        LSHで同じバケットに入るメモリを候補にし、署名から推定した類似度がthreshold以上で
+        最も近いメモリの (seq, id, 類似度) を返す（無い場合はNone）
+        """
+        keys = band_keys(signature)
+        conditions = ' OR '.join(['(band = ? AND bucket = ?)'] * len(keys))
+        params = [value for band, bucket in enumerate(keys) for value in (band, bucket)]
+        rows = conn.execute(
+            f"SELECT memory_minhash.seq, memory_minhash.signature, memories.id FROM memory_minhash "
+            f"JOIN memories ON memories.seq = memory_minhash.seq "
+            f"WHERE memory_minhash.seq IN (SELECT seq FROM memory_lsh WHERE {conditions})",
+            params
+        ).fetchall()
+        best = None
+        for row in rows:
+            if row['seq'] == exclude_seq:
+                continue
+            similarity = estimate_similarity(signature, signature_from_blob(row['signature']))
+            if similarity >= threshold and (best is None or similarity > best[2]):
+                best = (row['seq'], row['id'], similarity)
+        return best
+
+    def find_duplicates_of(self, content, threshold=MEMORY_DEDUP_THRESHOLD):
+        """本文とほぼ同じ内容の既存のメモリのうち、最も近いものの (id, 類似度) を返す（無い場合はNone）"""
+        signature = minhash_signature(content)
+        if signature is None:
+            return None
+        duplicate = self._find_duplicate(self._connect(), signature, threshold)
+        return (duplicate[1], duplicate[2]) if duplicate else None
+
+    def _merge_into(self, conn, seq, tag_lists):
+        """重複したメモリのタグを既存のメモリ（seq）に加え、思い出したときと同じように強化する"""
+        row = conn.execute("SELECT tags FROM memories WHERE seq = ?", (seq,)).fetchone()
+        tags = json.loads(row['tags'] or '[]')
+        merged = list(dict.fromkeys(tags + [str(tag) for tag_list in tag_lists for tag in tag_list]))
+        if len(merged) != len(tags):
+            conn.execute("UPDATE memories SET tags = ? WHERE seq = ?",
+                         (json.dumps(merged, ensure_ascii=False), seq))
+            self._index_tags(conn, seq, merged)
+        self._reinforce_rows(conn, [seq])
+
+    def find_duplicate_groups(self, threshold=MEMORY_DEDUP_THRESHOLD):
+        """
+        ほぼ同じ内容のメモリのグループを探す（各グループは古い順のseqのリスト）
+        2件以上が入ったLSHのバケットだけを調べ、バケットの先頭のメモリとの類似度を確かめて
+        union-findでまとめるため、全件の組み合わせは比較しない
+        """
+        conn = self._connect()
+        parent = {}
+
+        def find(seq):
+            root = seq
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while parent.get(seq, seq) != root:
+                parent[seq], seq = root, parent[seq]
+            return root
+
+        signatures = {}
+
+        def signature_of(seq):
+            if seq not in signatures:
+                row = conn.execute("SELECT signature FROM memory_minhash WHERE seq = ?", (seq,)).fetchone()
+                signatures[seq] = signature_from_blob(row['signature']) if row else None
+            return signatures[seq]
+
+        buckets = conn.execute(
+            "SELECT group_concat(seq) AS seqs FROM memory_lsh GROUP BY band, bucket HAVING COUNT(*) > 1"
+        ).fetchall()
+        for bucket in buckets:
+            seqs = sorted(int(seq) for seq in bucket['seqs'].split(','))
+            first = signature_of(seqs[0])
+            for seq in seqs[1:]:
+                if find(seq) == find(seqs[0]):
+                    continue
+                other = signature_of(seq)
+                if first is not None and other is not None and \
+                        estimate_similarity(first, other) >= threshold:
+                    a, b = find(seqs[0]), find(seq)
+                    parent[max(a, b)] = min(a, b)
+
+        groups = {}
+        for seq in list(parent):
+            groups.setdefault(find(seq), set()).update((seq, find(seq)))
+        return [sorted(group) for group in sorted(groups.values(), key=min)]
+
+    def merge_duplicate_group(self, seqs):
+        """
+        重複したメモリのグループを最も古いメモリ1件にまとめる（他のメモリのタグを加えて削除する）
+        まとめたメモリのIDを返す（既に削除されていて1件以下の場合はNone）
+        """
+        with self.transaction() as conn:
+            placeholders = ','.join('?' * len(seqs))
+            rows = conn.execute(
+                f"SELECT seq, id, content, tags FROM memories WHERE seq IN ({placeholders}) ORDER BY seq",
+                list(seqs)
+            ).fetchall()
+            if len(rows) < 2:
+                return None
+            keeper, others = rows[0], rows[1:]
+            self._merge_into(conn, keeper['seq'], [json.loads(row['tags'] or '[]') for row in others])
+            for row in others:
+                self._delete_row(conn, row['seq'], row['content'])
+            return keeper['id']
+
+    def _update(self, conn, memory_id, changes):
+        """メモリを更新する（更新できた場合はTrue）"""
+        assignments, params = [], []
+        for field in ('content', 'type', 'tags', 'strength'):
+            if field in changes:
+                value = changes[field]
+                if field == 'tags':
+                    value = json.dumps(value or [], ensure_ascii=False)
+                elif field == 'strength':
+                    value = min(max(float(value), 0.0), MAX_STRENGTH)
+                assignments.append(f"{field} = ?")
+                params.append(value)
+        if 'strength' in changes:
+            # 指定された強度は現時点の値として、ここから減衰させる
+            now = time.time()
+            strength = min(max(float(changes['strength']), 0.0), MAX_STRENGTH)
+            assignments.extend(["strength_at = ?", "decay_key = ?"])
+            params.extend([now, decay_key(strength, now)])
+        assignments.append("updated_at = ?")
+        params.append(datetime.now().isoformat())
+
+        row = conn.execute("SELECT seq, content FROM memories WHERE id = ?", (str(memory_id),)).fetchone()
+        if row is None:
+            return False
+        conn.execute(f"UPDATE memories SET {', '.join(assignments)} WHERE seq = ?", params + [row['seq']])
+        if 'content' in changes and changes['content'] != row['content']:
+            self._unindex_content(conn, row['seq'], row['content'])
+            self._index_content(conn, row['seq'], changes['content'])
+            self._invalidate_embedding(conn, row['seq'])
+            self._unindex_minhash(conn, row['seq'])
+            self._index_minhash(conn, row['seq'], minhash_signature(changes['content']))
+        if 'tags' in changes:
+            conn.execute("DELETE FROM memory_tags WHERE seq = ?", (row['seq'],))
+            self._index_tags(conn, row['seq'], changes['tags'])
+        return True
+
+    def _delete(self, conn, memory_id):
+        """メモリを削除する（削除できた場合はTrue）"""
+        row = conn.execute("SELECT seq, content FROM memories WHERE id = ?", (str(memory_id),)).fetchone()
+        if row is None:
+            return False
+        self._delete_row(conn, row['seq'], row['content'])
+        return True
+
+    def _delete_row(self, conn, seq, content):
+        """メモリの行と、全文検索・タグ・埋め込み・重複検出の索引から削除する"""
+        self._unindex_content(conn, seq, content)
+        self._invalidate_embedding(conn, seq)
+        self._unindex_minhash(conn, seq)
+        conn.execute("DELETE FROM memory_tags WHERE seq = ?", (seq,))
+        conn.execute("DELETE FROM memories WHERE seq = ?", (seq,))
+
+    def update(self, memory_id, changes):
+        """
+        メモリを更新する（content, type, tags, strengthのみ）
+        更新後のメモリを返し、無い場合はNoneを返す
+        """
+        if not self._group_write(lambda conn: self._update(conn, memory_id, changes)):
+            return None
+        return self.get(memory_id)
+
+    def delete(self, memory_id):
+        """メモリを削除する（削除できた場合はTrue）"""
+        return self._group_write(lambda conn: self._delete(conn, memory_id))
+
+    def reinforce(self, memory_ids):
+        """
+        チャットや検索で思い出したメモリの強度を強化する
+        現在の（減衰した）強度から強化し、思い出した回数と日時を記録する（更新日時は変えない）
+        """
+        memory_ids = [str(memory_id) for memory_id in dict.fromkeys(memory_ids)]
+        if not memory_ids:
+            return 0
+
+        def operation(conn):
+            placeholders = ','.join('?' * len(memory_ids))
+            seqs = [row['seq'] for row in conn.execute(
+                f"SELECT seq FROM memories WHERE id IN ({placeholders})", memory_ids)]
+            return self._reinforce_rows(conn, seqs)
+
+        return self._group_write(operation)
+
+    def _reinforce_rows(self, conn, seqs):
+        now, accessed_at = time.time(), datetime.now().isoformat()
+        placeholders = ','.join('?' * len(seqs))
+        updates = []
+        for row in conn.execute(
+                f"SELECT seq, strength, strength_at FROM memories WHERE seq IN ({placeholders})", list(seqs)):
+            strength = reinforced_strength(effective_strength(row['strength'], row['strength_at'], now))
+            updates.append((strength, now, decay_key(strength, now), accessed_at, row['seq']))
+        conn.executemany(
+            "UPDATE memories SET strength = ?, strength_at = ?, decay_key = ?, "
+            "access_count = access_count + 1, last_accessed = ? WHERE seq = ?",
+            updates
+        )
+        return len(updates)
+
+    def consolidate(self, threshold=MEMORY_PRUNE_THRESHOLD, mode=MEMORY_PRUNE_MODE, dry_run=False,
+                    chunk_size=500):
+        """
+        プロファイルの全メモリの強度をまとめて（numpyで）計算し、threshold未満のメモリを整理する
+        modeが'archive'ならアーカイブに移し、'delete'なら削除する
+        検索・チャットを長く待たせないよう、整理はchunk_size件ごとのトランザクションに分ける
+        戻り値は強度の分布と整理した件数
+        """
+        if mode not in ('archive', 'delete'):
+            raise ValueError(f"unsupported prune mode: {mode}")
+
+        started = time.perf_counter()
+        rows = self._connect().execute("SELECT seq, strength, strength_at FROM memories").fetchall()
+        data = np.array(rows, dtype=np.float64).reshape(-1, 3)
+        strengths = effective_strengths(data[:, 1], np.where(np.isnan(data[:, 2]), time.time(), data[:, 2]))
+        weak = data[strengths < threshold, 0].astype(np.int64).tolist()
+        histogram, _ = np.histogram(strengths, bins=10, range=(0.0, MAX_STRENGTH))
+
+        pruned = 0
+        if not dry_run:
+            archived_at = datetime.now().isoformat()
+            for start in range(0, len(weak), chunk_size):
+                with self.transaction() as conn:
+                    for seq in weak[start:start + chunk_size]:
+                        row = conn.execute(
+                            "SELECT content, strength, strength_at FROM memories WHERE seq = ?", (seq,)).fetchone()
+                        # 判定してから削除・強化された場合は整理しない
+                        if row is None or effective_strength(row['strength'], row['strength_at']) >= threshold:
+                            continue
+                        if mode == 'archive':
+                            conn.execute(
+                                "INSERT OR REPLACE INTO archived_memories (id, content, type, tags, strength, "
+                                "created_at, updated_at, extra, strength_at, access_count, last_accessed, archived_at) "
+                                "SELECT id, content, type, tags, strength, created_at, updated_at, extra, strength_at, "
+                                "access_count, last_accessed, ? FROM memories WHERE seq = ?",
+                                (archived_at, seq)
+                            )
+                        self._delete_row(conn, seq, row['content'])
+                        pruned += 1
+
+        result = {
+            'total': len(rows),
+            'below_threshold': len(weak),
+            'archived' if mode == 'archive' else 'deleted': pruned,
+            'threshold': threshold,
+            'mean_strength': round(float(strengths.mean()), 4) if len(rows) else None,
+            'histogram': histogram.tolist(),
+            'dry_run': dry_run,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)
+        }
+        if pruned:
+            logger.info(f"Consolidated memories of profile {self.profile_id}: {pruned} of {len(rows)} "
+                        f"memories below strength {threshold} were {mode}d")
+        return result
+
+    def list_archived(self, limit=50, after=None):
+        """アーカイブしたメモリを古い順に1ページ分返す（次のページのカーソルも返す）"""
+        sql, params = "SELECT rowid AS archive_seq, * FROM archived_memories", []
+        if after:
+            sql += " WHERE rowid > ?"
+            params.append(int(after))
+        sql += " ORDER BY rowid LIMIT ?"
+        params.append(int(limit) + 1)
+        rows = self._connect().execute(sql, params).fetchall()
+        next_cursor = str(rows[limit - 1]['archive_seq']) if len(rows) > limit else None
+        return [_row_to_memory(row) for row in rows[:limit]], next_cursor
+
+    def count_archived(self):
+        return self._connect().execute("SELECT COUNT(*) FROM archived_memories").fetchone()[0]
+
+    def restore(self, memory_id):
+        """アーカイブしたメモリを元に戻す（強度は最大に戻す）。戻したメモリを返し、無い場合はNone"""
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT * FROM archived_memories WHERE id = ?", (str(memory_id),)).fetchone()
+            if row is None:
+                return None
+            memory = _row_to_memory(row)
+            memory.pop('archived_at', None)
+            memory['strength'] = MAX_STRENGTH
+            restored_id = self._insert(conn, memory)
+            conn.execute("DELETE FROM archived_memories WHERE id = ?", (str(memory_id),))
+        return self.get(restored_id)
+
+    def apply_batch(self, operations):
+        """
+        作成・更新・削除の操作をまとめて1つのトランザクションで実行する
+        operationsの各要素は {'op': 'create' | 'update' | 'delete', 'id', ...メモリの項目} の辞書
+        1件でも失敗した場合はすべて取り消す（不可分）
+        戻り値は (成功したか, 操作ごとの結果のリスト)
+        """
+        results, failed = [], False
+        try:
+            with self.transaction() as conn:
+                for index, operation in enumerate(operations):
+                    try:
+                        result = self._apply_operation(conn, index, operation)
+                    except (TypeError, ValueError) as e:
+                        result = {'index': index, 'op': operation.get('op'), 'id': operation.get('id'),
+                                  'status': 'invalid', 'error': str(e)}
+                    failed = failed or result['status'] in ('invalid', 'not_found')
+                    results.append(result)
+                if failed:
+                    raise _BatchAborted()
+        except _BatchAborted:
+            for result in results:
+                if result['status'] in ('created', 'updated', 'deleted'):
+                    result['status'] = 'rolled_back'
+            return False, results
+        return True, results
+
+    def _apply_operation(self, conn, index, operation):
+        """一括操作の1件を実行し、その結果を返す"""
+        if not isinstance(operation, dict):
+            return {'index': index, 'status': 'invalid', 'error': '操作は辞書で指定してください'}
+        op = operation.get('op')
+        memory_id = operation.get('id')
+        result = {'index': index, 'op': op, 'id': str(memory_id) if memory_id is not None else None}
+
+        if op == 'create':
+            error = validate_memory_changes(operation, require_content=True)
+            if error:
+                return dict(result, status='invalid', error=error)
+            memory = {key: value for key, value in operation.items() if key not in ('op', 'id')}
+            return dict(result, status='created', id=self._insert(conn, memory))
+
+        if op in ('update', 'delete'):
+            if memory_id is None:
+                return dict(result, status='invalid', error='メモリIDが指定されていません')
+            if op == 'update':
+                error = validate_memory_changes(operation)
+                if error:
+                    return dict(result, status='invalid', error=error)
+                done = self._update(conn, memory_id, operation)
+            else:
+                done = self._delete(conn, memory_id)
+            if not done:
+                return dict(result, status='not_found', error=f'メモリID {memory_id} が見つかりません')
+            return dict(result, status='updated' if op == 'update' else 'deleted')
+
+        return dict(result, status='invalid', error=f'不明な操作です: {op}')
+
+    def tag_counts(self, memory_type=None, prefix=None, limit=None):
+        """
+        タグごとのメモリ数を多い順に返す（タグの索引だけを読み、メモリの本文は読まない）
+        memory_typeを指定した場合は、そのタイプのメモリだけを数える
+        """
+        sql = "SELECT tag, COUNT(*) AS count FROM memory_tags WHERE 1 = 1"
+        params = []
+        if memory_type:
+            # タイプのインデックスにはseqも含まれるため、メモリの行を読まずに済む
+            sql += " AND seq IN (SELECT seq FROM memories WHERE type = ?)"
+            params.append(memory_type)
+        if prefix:
+            sql += " AND tag >= ? AND tag < ?"
+            params.extend([prefix, prefix + '\U0010ffff'])
+        sql += " GROUP BY tag ORDER BY count DESC, tag"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        return [(row['tag'], row['count']) for row in self._connect().execute(sql, params)]
+
+    def type_counts(self):
+        """タイプごとのメモリ数を返す（タイプのインデックスだけを読む）"""
+        rows = self._connect().execute("SELECT type, COUNT(*) AS count FROM memories GROUP BY type ORDER BY count DESC")
+        return [(row['type'], row['count']) for row in rows]
+
+    def search(self, query, memory_type=None, tags=None, limit=50, match_any=False, tag_mode='all'):
+        """
+        全文検索でメモリを検索する
+        BM25の関連度順に返し、各メモリにはscore（大きいほど関連が高い）とsnippetを付ける
+        match_anyがTrueの場合は、クエリのいずれかの語を含むメモリを検索する
+        tagsの絞り込み方はiter_memoriesと同じ
+        """
+        match = build_match_query(query, match_any=match_any)
+        if match is None:
+            return []
+
+        sql = ("SELECT m.*, bm25(memories_fts) AS rank FROM memories_fts "
+               "JOIN memories m ON m.seq = memories_fts.rowid WHERE memories_fts MATCH ?")
+        params = [match]
+        if memory_type:
+            sql += " AND m.type = ?"
+            params.append(memory_type)
+        tag_sql, tag_params = _tag_filter(tags, tag_mode, column='m.seq')
+        sql += tag_sql
+        params.extend(tag_params)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(int(limit))
+
+        terms = query_terms(query)
+        results = []
+        for row in self._connect().execute(sql, params):
+            memory = _row_to_memory(row)
+            memory['score'] = round(-row['rank'], 4)
+            memory['snippet'] = make_snippet(row['content'], terms)
+            results.append(memory)
+        return results
+
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_memory_store(profile_id):
+    """プロファイルのメモリストアを取得する関数（初回のみ作成・移行する）"""
+    with _STORES_LOCK:
+        store = _STORES.get(profile_id)
+        if store is None:
+            store = MemoryStore(profile_id)
+            _STORES[profile_id] = store
+        return store
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - メモリの強度
+時間とともに減衰し、思い出す（検索される）たびに強化されるメモリの強度を計算するモジュール
+"""
+
+import math
+import time
+import numpy as np
+from config import MEMORY_STRENGTH_HALF_LIFE, MEMORY_REINFORCE_BOOST
+
+# 強度の上限
+MAX_STRENGTH = 1.0
+# 強度が0の場合の並び替えキー（log2(0)の代わり）
+MIN_DECAY_KEY = -1e9
+
+
+def half_life_seconds():
+    return MEMORY_STRENGTH_HALF_LIFE * 86400
+
+
+def effective_strength(strength, strength_at, now=None):
+    """
+    保存された強度（strength_at時点の値）から、現在の強度を計算する
+    強度は半減期ごとに半分になる。strength_atが無い場合は保存された値をそのまま返す
+    """
+    if strength_at is None or half_life_seconds() <= 0:
+        return strength
+    now = time.time() if now is None else now
+    return strength * 0.5 ** (max(0.0, now - strength_at) / half_life_seconds())
+
+
+def effective_strengths(strengths, strength_at, now=None):
+    """effective_strengthのnumpy版（プロファイルの全メモリをまとめて計算する）"""
+    strengths = np.asarray(strengths, dtype=np.float64)
+    if half_life_seconds() <= 0:
+        return strengths
+    now = time.time() if now is None else now
+    elapsed = np.maximum(0.0, now - np.asarray(strength_at, dtype=np.float64))
+    return strengths * np.exp2(-elapsed / half_life_seconds())
+
+
+def decay_key(strength, strength_at):
+    """
+    現在の強度の順に並べるためのキー
+    すべてのメモリが同じ半減期で減衰するため、log2(強度) + 時刻 / 半減期 の大小は
+    いつの時点でも現在の強度の大小と一致する（SQLのインデックスで並び替え・絞り込みができる）
+    """
+    if strength <= 0:
+        return MIN_DECAY_KEY
+    if half_life_seconds() <= 0:
+        return math.log2(strength)
+    return math.log2(strength) + strength_at / half_life_seconds()
+
+
+def decay_keys(strengths, strength_at):
+    """decay_keyのnumpy版"""
+    strengths = np.asarray(strengths, dtype=np.float64)
+    keys = np.full(strengths.shape, MIN_DECAY_KEY)
+    positive = strengths > 0
+    keys[positive] = np.log2(strengths[positive])
+    if half_life_seconds() > 0:
+        keys[positive] += np.asarray(strength_at, dtype=np.float64)[positive] / half_life_seconds()
+    return keys
+
+
+def reinforced_strength(current, boost=MEMORY_REINFORCE_BOOST):
+    """思い出したときの新しい強度（上限までの残りのboostの割合だけ強くなる）"""
+    return min(MAX_STRENGTH, current + boost * (MAX_STRENGTH - current))
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - メモリのベクトル検索
+メモリの埋め込みベクトルをfloat32の行列ファイルに保存し、コサイン類似度で検索するモジュール
+"""
+
+import os
+import math
+import time
+import hashlib
+import threading
+import numpy as np
+import config as app_config
+from config import (
+    logger, EMBEDDING_SERVER_URL, EMBEDDING_MODEL_PATH, EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_CHARS,
+    VECTOR_IVF_THRESHOLD, VECTOR_IVF_NPROBE
+)
+from services.llama_server import (
+    generate_embeddings, embeddings_configured, EmbeddingsNotConfiguredError, PRIORITY_BATCH, PRIORITY_INTERACTIVE
+)
+from services.memory_store import get_memory_store
+from services.response_cache import get_model_identity
+
+# IVFを作り直すメモリ数の変化率
+IVF_REBUILD_RATIO = 0.2
+# 空き行がこの割合を超えたら行列ファイルを詰め直す
+COMPACT_RATIO = 0.5
+
+
+def content_hash(content):
+    return hashlib.sha256((content or '')[:EMBEDDING_MAX_CHARS].encode('utf-8')).hexdigest()
+
+
+def _normalize_rows(vectors):
+    """各行を単位ベクトルにする（内積がコサイン類似度になる）"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class IvfIndex:
+    """
+    転置ファイル（IVF）による近似検索の索引
+    ベクトルをk-meansでクラスタに分け、検索時はクエリに近いnprobe個のクラスタだけを調べる
+    """
+
+    def __init__(self, matrix, rows, seed=0):
+        self.built_rows = matrix.shape[0]
+        nlist = max(1, int(math.sqrt(len(rows))))
+        rng = np.random.default_rng(seed)
+
+        # クラスタの中心はサンプルから求める
+        sample_size = min(len(rows), nlist * 40)
+        sample = np.asarray(matrix[np.sort(rng.choice(rows, sample_size, replace=False))])
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(8):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=nlist)
+            filled = counts > 0
+            centroids[filled] = _normalize_rows(sums[filled])
+
+        # すべての行をクラスタに割り当てる（大きな行列を一度に読み込まないよう分割する）
+        assignments = np.empty(len(rows), dtype=np.int32)
+        for start in range(0, len(rows), 8192):
+            chunk = rows[start:start + 8192]
+            assignments[start:start + len(chunk)] = np.argmax(np.asarray(matrix[chunk]) @ centroids.T, axis=1)
+
+        order = np.argsort(assignments, kind='stable')
+        self.centroids = centroids
+        self.sorted_rows = rows[order]
+        self.offsets = np.searchsorted(assignments[order], np.arange(nlist + 1))
+        self.size = len(rows)
+
+    def candidates(self, query, nprobe):
+        """クエリに近いクラスタに含まれる行を返す"""
+        nprobe = min(nprobe, len(self.centroids))
+        nearest = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.concatenate([self.sorted_rows[self.offsets[c]:self.offsets[c + 1]] for c in nearest])
+
+
+class MemoryVectorIndex:
+    """
+    1つのプロファイルのメモリの埋め込みベクトルを管理するクラス
+    ベクトルは正規化したfloat32の行列としてファイルに追記し、検索時はメモリマップして読む
+    メモリと行の対応・本文のハッシュはメモリストアのmemory_embeddingsテーブルに保存する
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.vector_dir = os.path.join(store.memory_dir, 'vectors')
+        os.makedirs(self.vector_dir, exist_ok=True)
+
+        self._sync_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._cache_key = None
+        self._matrix = None
+        self._row_seq = None
+        self._ivf = None
+        self._ivf_building = False
+        self._background_sync = None
+
+    # --- 行列ファイル ---
+
+    def _matrix_path(self):
+        generation = self.store.get_meta('embeddings_file', 'embeddings-0.f32')
+        return os.path.join(self.vector_dir, generation)
+
+    def _dim(self):
+        return int(self.store.get_meta('embedding_dim', 0))
+
+    def _row_count(self):
+        dim = self._dim()
+        path = self._matrix_path()
+        if not dim or not os.path.exists(path):
+            return 0
+        return os.path.getsize(path) // (dim * 4)
+
+    def _append_vectors(self, vectors):
+        """
+        行列ファイルの末尾にベクトルを追記し、先頭の行番号を返す
+        前回の書き込みが途中で止まって行の途中までのデータが残っている場合は、切り捨ててから追記する
+        """
+        first_row = self._row_count()
+        with open(self._matrix_path(), 'ab') as f:
+            f.truncate(first_row * vectors.shape[1] * 4)
+            vectors.astype(np.float32).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        return first_row
+
+    def _load(self):
+        """行列と、行ごとのメモリの対応を読み込む（変更が無ければキャッシュを使う）"""
+        key = (self.store.get_meta('embeddings_version', 0), self.store.get_meta('embeddings_file'),
+               self._row_count())
+        with self._lock:
+            if key == self._cache_key:
+                return self._matrix, self._row_seq, self._ivf
+
+            dim, rows = self._dim(), key[2]
+            matrix = None
+            row_seq = np.full(rows, -1, dtype=np.int64)
+            if rows:
+                matrix = np.memmap(self._matrix_path(), dtype=np.float32, mode='r', shape=(rows, dim))
+                pairs = np.array(self.store.execute("SELECT row, seq FROM memory_embeddings").fetchall(),
+                                 dtype=np.int64).reshape(-1, 2)
+                pairs = pairs[pairs[:, 0] < rows]
+                row_seq[pairs[:, 0]] = pairs[:, 1]
+
+            # 行の位置が変わった（ファイルを詰め直した）場合は近似索引を破棄する
+            if self._cache_key is None or self._cache_key[1] != key[1]:
+                self._ivf = None
+            self._cache_key, self._matrix, self._row_seq = key, matrix, row_seq
+            return matrix, row_seq, self._ivf
+
+    # --- 同期 ---
+
+    def _embedding_model(self):
+        """埋め込みに使うモデルの識別子（変わった場合はすべて再計算する）"""
+        if EMBEDDING_SERVER_URL:
+            return EMBEDDING_SERVER_URL
+        if EMBEDDING_MODEL_PATH:
+            return get_model_identity(EMBEDDING_MODEL_PATH)
+        return get_model_identity(app_config.SELECTED_MODEL_PATH)
+
+    def pending_count(self):
+        """埋め込みが未計算のメモリ数"""
+        embedded = self.store.execute("SELECT COUNT(*) FROM memory_embeddings").fetchone()[0]
+        return max(0, self.store.count() - embedded)
+
+    def _reset(self, model):
+        """モデルが変わった場合にすべての埋め込みを破棄する"""
+        generation = f"embeddings-{int(time.time() * 1000)}.f32"
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM memory_embeddings")
+            self.store._set_meta(conn, 'embedding_model', model)
+            self.store._set_meta(conn, 'embedding_dim', 0)
+            self.store._set_meta(conn, 'embeddings_file', generation)
+        logger.info(f"Embedding model changed for profile {self.store.profile_id}, recomputing all embeddings")
+
+    def sync(self, priority=PRIORITY_BATCH, limit=None):
+        """
+        埋め込みが未計算・本文が変更されたメモリの埋め込みをバッチで計算する
+        同じ本文のベクトルが既にあれば再計算せずに再利用する
+        戻り値は新たに追加した件数（失敗した場合はNone）
+        埋め込みを計算できるサーバーが設定されていない場合はEmbeddingsNotConfiguredErrorを送出する
+        """
+        if not embeddings_configured():
+            raise EmbeddingsNotConfiguredError()
+        with self._sync_lock:
+            model = self._embedding_model()
+            if self.store.get_meta('embedding_model') != model:
+                self._reset(model)
+
+            if self.pending_count() == 0:
+                return 0
+
+            pending = self.store.execute(
+                "SELECT m.seq, m.content FROM memories m "
+                "LEFT JOIN memory_embeddings e ON e.seq = m.seq WHERE e.seq IS NULL ORDER BY m.seq"
+            ).fetchall()
+            if limit is not None:
+                pending = pending[:limit]
+
+            added = 0
+            for start in range(0, len(pending), EMBEDDING_BATCH_SIZE):
+                batch = pending[start:start + EMBEDDING_BATCH_SIZE]
+                if not self._embed_batch(batch, priority):
+                    return None
+                added += len(batch)
+
+            self._compact_if_needed()
+            logger.info(f"Computed embeddings for {added} memories of profile {self.store.profile_id}")
+            return added
+
+    def _embed_batch(self, batch, priority):
+        """
+        1バッチ分の埋め込みを計算して保存する
+        検索時に行とメモリを1対1で対応させるため、同じ本文でもメモリごとに1行を追記する
+        """
+        hashes = [content_hash(row['content']) for row in batch]
+        vectors = {}
+
+        # 同じ本文のベクトルが既にあれば、行列ファイルから読み出して再利用する
+        dim = self._dim()
+        rows = self._row_count()
+        if rows:
+            matrix = np.memmap(self._matrix_path(), dtype=np.float32, mode='r', shape=(rows, dim))
+            for digest in set(hashes):
+                found = self.store.execute(
+                    "SELECT row FROM memory_embeddings WHERE content_hash = ? LIMIT 1", (digest,)
+                ).fetchone()
+                if found and found['row'] < rows:
+                    vectors[digest] = np.array(matrix[found['row']])
+            del matrix
+
+        to_embed = {}
+        for row, digest in zip(batch, hashes):
+            if digest not in vectors and digest not in to_embed:
+                to_embed[digest] = row['content'][:EMBEDDING_MAX_CHARS]
+
+        if to_embed:
+            embedded, error = generate_embeddings(list(to_embed.values()), priority=priority)
+            if error or not embedded:
+                logger.warning(f"Failed to compute embeddings: {error}")
+                return False
+            normalized = _normalize_rows(embedded)
+            if dim and normalized.shape[1] != dim:
+                # 埋め込みの次元が変わった（モデルが変わった）場合は作り直す
+                self._reset(self._embedding_model())
+                return self._embed_batch(batch, priority)
+            if not dim:
+                with self.store.transaction() as conn:
+                    self.store._set_meta(conn, 'embedding_dim', normalized.shape[1])
+            vectors.update(zip(to_embed.keys(), normalized))
+
+        first_row = self._append_vectors(np.stack([vectors[digest] for digest in hashes]))
+
+        with self.store.transaction() as conn:
+            for i, (row, digest) in enumerate(zip(batch, hashes)):
+                # 計算中に本文が変更・削除されたメモリは保存しない
+                current = conn.execute("SELECT content FROM memories WHERE seq = ?", (row['seq'],)).fetchone()
+                if current is None or content_hash(current['content']) != digest:
+                    continue
+                conn.execute(
+                    "INSERT OR REPLACE INTO memory_embeddings (seq, row, content_hash) VALUES (?, ?, ?)",
+                    (row['seq'], first_row + i, digest)
+                )
+            version = int(self.store._get_meta(conn, 'embeddings_version', 0))
+            self.store._set_meta(conn, 'embeddings_version', version + 1)
+        return True
+
+    def _compact_if_needed(self):
+        """
+        使われていない行が多くなった場合に、使用中の行だけの新しいファイルに書き直す
+        検索中のスレッドが古いファイルをメモリマップしていても影響しないよう、別名のファイルに書き出す
+        """
+        rows = self._row_count()
+        pairs = self.store.execute("SELECT seq, row FROM memory_embeddings ORDER BY row").fetchall()
+        used = [pair['row'] for pair in pairs]
+        if rows < 1024 or len(used) > rows * (1 - COMPACT_RATIO):
+            return
+
+        old_path, dim = self._matrix_path(), self._dim()
+        matrix = np.memmap(old_path, dtype=np.float32, mode='r', shape=(rows, dim))
+        generation = f"embeddings-{int(time.time() * 1000)}.f32"
+        new_path = os.path.join(self.vector_dir, generation)
+        with open(new_path, 'wb') as f:
+            for start in range(0, len(used), 8192):
+                np.asarray(matrix[used[start:start + 8192]]).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        del matrix
+
+        new_row = {old: new for new, old in enumerate(used)}
+        with self.store.transaction() as conn:
+            conn.executemany(
+                "UPDATE memory_embeddings SET row = ? WHERE seq = ?",
+                [(new_row[pair['row']], pair['seq']) for pair in pairs]
+            )
+            self.store._set_meta(conn, 'embeddings_file', generation)
+        logger.info(f"Compacted embedding matrix of profile {self.store.profile_id}: {rows} -> {len(used)} rows")
+
+        # 古いファイルは削除する（Windowsでメモリマップ中の場合は次回に削除する）
+        for name in os.listdir(self.vector_dir):
+            if name != generation and name.endswith('.f32'):
+                try:
+                    os.remove(os.path.join(self.vector_dir, name))
+                except OSError:
+                    pass
+
+    def sync_async(self):
+        """バックグラウンドで同期する（実行中の場合・埋め込みを計算できない設定の場合は何もしない）"""
+        if not embeddings_configured():
+            return
+        if self._background_sync is not None and self._background_sync.is_alive():
+            return
+        self._background_sync = threading.Thread(
+            target=self.sync, name=f'memory-embeddings-{self.store.profile_id}', daemon=True
+        )
+        self._background_sync.start()
+
+    # --- 検索 ---
+
+    def _maybe_build_ivf(self, matrix, row_seq):
+        """メモリ数が閾値以上の場合、バックグラウンドで近似索引を作成する"""
+        live = int(np.count_nonzero(row_seq >= 0))
+        if not VECTOR_IVF_THRESHOLD or live < VECTOR_IVF_THRESHOLD or self._ivf_building:
+            return
+        if self._ivf is not None and abs(live - self._ivf.size) <= self._ivf.size * IVF_REBUILD_RATIO:
+            return
+
+        self._ivf_building = True
+        cache_key = self._cache_key
+
+        def build():
+            try:
+                started = time.perf_counter()
+                ivf = IvfIndex(matrix, np.flatnonzero(row_seq >= 0))
+                with self._lock:
+                    if self._cache_key is not None and cache_key is not None and self._cache_key[1] == cache_key[1]:
+                        self._ivf = ivf
+                logger.info(f"Built IVF index over {ivf.size} embeddings with {len(ivf.centroids)} lists "
+                            f"in {time.perf_counter() - started:.2f}s")
+            except Exception as e:
+                logger.exception(f"Failed to build IVF index: {str(e)}")
+            finally:
+                self._ivf_building = False
+
+        threading.Thread(target=build, name='memory-ivf-builder', daemon=True).start()
+
+    def search(self, query, k=10, memory_type=None, tags=None, timings=None, sync=True):
+        """
+        クエリに意味が近いメモリを検索する
+        各メモリにsimilarity（コサイン類似度）を付けて、類似度の高い順に返す
+        syncがFalseの場合は未計算の埋め込みを待たずに、計算済みの分だけで検索する
+        埋め込みを計算できるサーバーが設定されていない場合はEmbeddingsNotConfiguredErrorを送出する
+        """
+        if not embeddings_configured():
+            raise EmbeddingsNotConfiguredError()
+
+        # 未計算が少なければその場で計算し、多ければバックグラウンドで計算して現在の分だけで検索する
+        pending = self.pending_count()
+        if pending:
+            if sync and pending <= EMBEDDING_BATCH_SIZE:
+                self.sync(priority=PRIORITY_INTERACTIVE)
+            else:
+                self.sync_async()
+
+        started = time.perf_counter()
+        embedded, error = generate_embeddings([query[:EMBEDDING_MAX_CHARS]], priority=PRIORITY_INTERACTIVE)
+        if error or not embedded:
+            raise RuntimeError(f"クエリの埋め込みを計算できませんでした: {error}")
+        query_vector = _normalize_rows(embedded)[0]
+        embed_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        matrix, row_seq, ivf = self._load()
+        results = []
+        if matrix is not None and query_vector.shape[0] == matrix.shape[1]:
+            self._maybe_build_ivf(matrix, row_seq)
+            if ivf is not None:
+                # 索引の作成後に追加された行は全件を調べる
+                candidates = np.sort(np.concatenate([
+                    ivf.candidates(query_vector, VECTOR_IVF_NPROBE),
+                    np.arange(ivf.built_rows, matrix.shape[0])
+                ]))
+                scores = np.asarray(matrix[candidates]) @ query_vector
+            else:
+                candidates = np.arange(matrix.shape[0])
+                scores = np.asarray(matrix) @ query_vector
+            scores[row_seq[candidates] < 0] = -np.inf
+
+            # フィルタで除外される分を見込んで多めに取り出す
+            wanted = min(len(scores), k * 4 if (memory_type or tags) else k)
+            if wanted:
+                top = np.argpartition(-scores, wanted - 1)[:wanted]
+                top = top[np.argsort(-scores[top])]
+                top = top[np.isfinite(scores[top])]
+                seqs = row_seq[candidates[top]]
+                memories = self.store.get_by_seqs(seqs.tolist())
+                for seq, score in zip(seqs.tolist(), scores[top].tolist()):
+                    memory = memories.get(seq)
+                    if memory is None:
+                        continue
+                    if memory_type and memory['type'] != memory_type:
+                        continue
+                    if tags and not all(tag in memory['tags'] for tag in tags):
+                        continue
+                    memory['similarity'] = round(float(score), 4)
+                    results.append(memory)
+                    if len(results) >= k:
+                        break
+
+        if timings is not None:
+            timings['embed_ms'] = round(embed_ms, 2)
+            timings['search_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            timings['approximate'] = ivf is not None
+            timings['pending_embeddings'] = self.pending_count() if pending else 0
+        return results
+
+    def get_status(self):
+        matrix, row_seq, ivf = self._load()
+        return {
+            'embedded': int(np.count_nonzero(row_seq >= 0)) if row_seq is not None else 0,
+            'pending': self.pending_count(),
+            'dim': self._dim(),
+            'rows': self._row_count(),
+            'model': self.store.get_meta('embedding_model'),
+            'configured': embeddings_configured(),
+            'ivf': {'lists': len(ivf.centroids), 'size': ivf.size} if ivf is not None else None,
+            'syncing': self._background_sync is not None and self._background_sync.is_alive()
+        }
+
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_vector_index(profile_id):
+    """プロファイルのベクトル索引を取得する関数"""
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(profile_id)
+        if index is None:
+            index = MemoryVectorIndex(get_memory_store(profile_id))
+            _INDEXES[profile_id] = index
+        return index
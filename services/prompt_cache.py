@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - プロンプトプレフィックスキャッシュ
+プロファイルごとのシステムプロンプトを固定し、llama-serverのKVキャッシュを再利用させるモジュール
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from config import logger, PROFILES_DIR, LLAMA_SERVER_INSTANCES, LLAMA_SERVER_PARALLEL
+
+# アフィニティマップに保持するプロファイル数の上限
+MAX_AFFINITY_ENTRIES = 256
+
+
+class PromptPrefixCache:
+    """
+    プロファイルごとのプロンプトプレフィックスとスロットの対応を管理するクラス
+    同じプロファイルのリクエストを同じllama-serverスロットに送ることで、
+    プレフィックス部分のプリフィル（プロンプト処理）を省略させる
+    """
+
+    def __init__(self, instances=LLAMA_SERVER_INSTANCES, slots_per_instance=LLAMA_SERVER_PARALLEL):
+        self.instances = max(1, instances)
+        self.slots_per_instance = max(1, slots_per_instance)
+
+        self._lock = threading.Lock()
+        self._prefixes = {}  # profile_id -> (config.jsonのmtime, prefix)
+        self._affinity = OrderedDict()  # profile_id -> (instance_index, slot_id)
+        self._slot_usage = {}  # (instance_index, slot_id) -> 割り当て済みプロファイル数
+        self._busy = set()
+        self._stats = {}
+
+    def get_prefix(self, profile_id):
+        """
+        プロファイルの固定プレフィックスを取得する
+        config.jsonが変更されない限り、毎回バイト単位で同一の文字列を返す
+        """
+        if not profile_id:
+            return ""
+
+        config_path = os.path.join(PROFILES_DIR, profile_id, 'config.json')
+        try:
+            mtime = os.path.getmtime(config_path)
+        except OSError:
+            return ""
+
+        with self._lock:
+            cached = self._prefixes.get(profile_id)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+        with open(config_path, 'r', encoding='utf-8') as f:
+            profile_name = json.load(f).get('name', profile_id)
+
+        system_prompt = f"あなたは{profile_name}です。ユーザーの質問に丁寧に答えてください。"
+        prefix = f"<s>[INST] {system_prompt} [/INST]</s>\n\n"
+
+        with self._lock:
+            self._prefixes[profile_id] = (mtime, prefix)
+        return prefix
+
+    def _assign(self, key):
+        """プロファイルに割り当てるスロットを決める（割り当て数が最も少ないスロット）"""
+        if key in self._affinity:
+            self._affinity.move_to_end(key)
+            return self._affinity[key]
+
+        candidates = [
+            (instance, slot)
+            for instance in range(self.instances)
+            for slot in range(self.slots_per_instance)
+        ]
+        target = min(candidates, key=lambda target: self._slot_usage.get(target, 0))
+        self._affinity[key] = target
+        self._slot_usage[target] = self._slot_usage.get(target, 0) + 1
+
+        # 古いプロファイルの割り当てを破棄する
+        if len(self._affinity) > MAX_AFFINITY_ENTRIES:
+            _, evicted = self._affinity.popitem(last=False)
+            self._slot_usage[evicted] -= 1
+        return target
+
+    @contextmanager
+    def pin(self, key):
+        """
+        プロファイルに対応するスロットを確保する
+        (instance_index, slot_id) を返す。スロットが使用中の場合slot_idはNoneになり、
+        インスタンスの希望だけを伝えて空いているスロットで処理させる
+        """
+        if key is None:
+            yield None, None
+            return
+
+        with self._lock:
+            target = self._assign(key)
+            acquired = target not in self._busy
+            if acquired:
+                self._busy.add(target)
+
+        try:
+            yield target[0], target[1] if acquired else None
+        finally:
+            if acquired:
+                with self._lock:
+                    self._busy.discard(target)
+
+    def record(self, key, result):
+        """
+        llama-serverの応答からプレフィックスキャッシュの効果を記録する
+        tokens_cachedは再利用されたトークン数、timings.prompt_nは新たに処理したトークン数
+        """
+        if key is None or not isinstance(result, dict):
+            return
+
+        timings = result.get('timings') or {}
+        cached = int(result.get('tokens_cached') or 0)
+        evaluated = int(timings.get('prompt_n') or 0)
+        prompt_ms = float(timings.get('prompt_ms') or 0.0)
+
+        with self._lock:
+            stats = self._stats.setdefault(key, {
+                'requests': 0,
+                'hits': 0,
+                'cached_tokens': 0,
+                'evaluated_tokens': 0,
+                'prompt_ms': 0.0,
+                'saved_ms_estimate': 0.0
+            })
+            stats['requests'] += 1
+            stats['cached_tokens'] += cached
+            stats['evaluated_tokens'] += evaluated
+            stats['prompt_ms'] += prompt_ms
+            if cached > 0:
+                stats['hits'] += 1
+                # 実測のトークンあたり処理時間から、省略できたプリフィル時間を見積もる
+                if evaluated > 0:
+                    stats['saved_ms_estimate'] += cached * prompt_ms / evaluated
+
+    def get_stats(self):
+        """プレフィックスキャッシュのヒット率と節約できた時間を取得する"""
+        with self._lock:
+            profiles = {}
+            totals = {'requests': 0, 'hits': 0, 'cached_tokens': 0, 'evaluated_tokens': 0, 'saved_ms_estimate': 0.0}
+            for key, stats in self._stats.items():
+                profiles[key] = dict(stats, **_rates(stats), slot=self._affinity.get(key))
+                for name in totals:
+                    totals[name] += stats[name]
+            totals.update(_rates(totals))
+            totals['saved_ms_estimate'] = round(totals['saved_ms_estimate'], 2)
+            return {'total': totals, 'profiles': profiles}
+
+
+def _rates(stats):
+    """ヒット率とトークン再利用率を計算する"""
+    requests = stats['requests']
+    total_tokens = stats['cached_tokens'] + stats['evaluated_tokens']
+    return {
+        'hit_rate': round(stats['hits'] / requests, 4) if requests else 0.0,
+        'token_reuse_ratio': round(stats['cached_tokens'] / total_tokens, 4) if total_tokens else 0.0
+    }
+
+
+# アプリケーション全体で共有するキャッシュ
+PROMPT_PREFIX_CACHE = PromptPrefixCache()
+
+
+def get_profile_prefix(profile_id):
+    """プロファイルの固定プロンプトプレフィックスを取得する関数"""
+    try:
+        return PROMPT_PREFIX_CACHE.get_prefix(profile_id)
+    except Exception as e:
+        logger.error(f"Failed to build prompt prefix for profile {profile_id}: {str(e)}")
+        return ""
+
+
+def get_prefix_cache_stats():
+    """プレフィックスキャッシュの統計を取得する関数"""
+    return PROMPT_PREFIX_CACHE.get_stats()
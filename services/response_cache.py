@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - 応答キャッシュ
+同一・ほぼ同一のプロンプトに対するLLMの応答を再利用するモジュール
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from config import (
+    logger, RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_PATH, RESPONSE_CACHE_SAMPLED
+)
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_prompt(prompt):
+    """
+    キャッシュキー用にプロンプトを正規化する関数
+    全角・半角の違いと連続する空白の違いを吸収する
+    （大文字・小文字は応答が変わりうるため区別する）
+    """
+    text = unicodedata.normalize('NFKC', prompt or '')
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+def get_model_identity(model_path):
+    """
+    モデルファイルの識別子を作成する関数
+    同じパスでもファイルが置き換えられた場合は別のモデルとして扱う
+    """
+    if not model_path:
+        return ''
+    try:
+        stat = os.stat(model_path)
+        return f"{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    except OSError:
+        return os.path.abspath(model_path)
+
+
+def build_cache_key(model_identity, profile_id, prompt, params):
+    """モデル・プロファイル・正規化したプロンプト・サンプリング設定からキーを作成する関数"""
+    material = json.dumps({
+        'model': model_identity,
+        'profile': profile_id or '',
+        'prompt': normalize_prompt(prompt),
+        'params': params
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    LRUとTTLで管理する応答キャッシュ
+    メモリ使用量の上限を超えると古いものから破棄し、pathを指定するとSQLiteにも保存する
+    """
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES, path=RESPONSE_CACHE_PATH):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, text, size)
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expirations': 0}
+        self._db = None
+
+        if path:
+            self._open_db()
+
+    def _open_db(self):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, text TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+            # 期限切れでないものを新しい順にメモリ上限まで読み込む
+            rows = self._db.execute(
+                "SELECT key, text, expires_at FROM responses ORDER BY expires_at DESC"
+            ).fetchall()
+            for key, text, expires_at in reversed(rows):
+                self._put_memory(key, text, expires_at)
+            logger.info(f"Loaded {len(self._entries)} cached responses from {self.path}")
+        except Exception as e:
+            logger.error(f"Failed to open response cache database: {str(e)}")
+            self._db = None
+
+    def _put_memory(self, key, text, expires_at):
+        # 大きすぎて保持しない場合も、同じキーの古い応答は返さないよう先に取り除く
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[2]
+        size = len(text.encode('utf-8')) + len(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (expires_at, text, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self._stats['evictions'] += 1
+
+    def get(self, key):
+        """キャッシュされた応答を取得する（無い場合・期限切れの場合はNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            expires_at, text, size = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                self._bytes -= size
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return text
+
+    def put(self, key, text):
+        """応答をキャッシュに保存する"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._put_memory(key, text, expires_at)
+            self._stats['stores'] += 1
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO responses (key, text, expires_at) VALUES (?, ?, ?)",
+                        (key, text, expires_at)
+                    )
+                    self._db.commit()
+                except Exception as e:
+                    logger.error(f"Failed to persist cached response: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return dict(
+                self._stats,
+                enabled=True,
+                entries=len(self._entries),
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+                ttl=self.ttl,
+                persistent=self._db is not None,
+                hit_rate=round(self._stats['hits'] / lookups, 4) if lookups else 0.0
+            )
+
+
+# アプリケーション全体で共有するキャッシュ（無効の場合はNone）
+RESPONSE_CACHE = ResponseCache() if RESPONSE_CACHE_ENABLED else None
+
+
+def should_cache(temperature, use_cache=None):
+    """
+    リクエストをキャッシュの対象にするか判定する関数
+    use_cache=True/Falseで個別に指定でき、未指定でtemperatureが0でない場合はRESPONSE_CACHE_SAMPLEDに従う
+    /api/chatはtemperature 0.7で生成するため、RESPONSE_CACHE_SAMPLEDか"cache": trueを指定しない限り対象にならない
+    """
+    if RESPONSE_CACHE is None or use_cache is False:
+        return False
+    if use_cache is None and temperature and not RESPONSE_CACHE_SAMPLED:
+        return False
+    return True
+
+
+def get_response_cache_stats():
+    """応答キャッシュの統計を取得する関数"""
+    if RESPONSE_CACHE is None:
+        return {'enabled': False}
+    return RESPONSE_CACHE.get_stats()
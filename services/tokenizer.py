@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - トークン数計算サービス
+llama-serverの/tokenizeでトークン数を数え、結果をキャッシュするモジュール
+"""
+
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+import config as app_config
+from config import logger, TOKEN_CACHE_SIZE
+from services.llama_client import get_llama_client
+from services.llama_server import LLAMA_SERVER_POOL
+from services.response_cache import get_model_identity
+
+
+def estimate_tokens(text):
+    """
+    トークン数を文字数から推定する関数（llama-serverを利用できない場合の代替）
+    日本語などの非ASCII文字は1文字を約1トークン、ASCIIは約4文字を1トークンとして数える
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + math.ceil(ascii_chars / 4)
+
+
+class TokenCounter:
+    """
+    トークン数を数えるクラス
+    結果はモデルと本文のハッシュをキーにLRUでキャッシュし、同じ文字列の問い合わせを省略する
+    推定値はモデルごとに異なる実測値と混ざらないようキャッシュしない
+    """
+
+    def __init__(self, max_entries=TOKEN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (model, sha256) -> トークン数
+        self._stats = {'hits': 0, 'misses': 0, 'remote_calls': 0, 'estimated': 0, 'errors': 0}
+
+    @staticmethod
+    def _key(model, text):
+        return model, hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _lookup(self, key):
+        with self._lock:
+            tokens = self._entries.get(key)
+            if tokens is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return tokens
+
+    def _store(self, key, tokens):
+        with self._lock:
+            self._entries[key] = tokens
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def count(self, text):
+        """1つの文字列のトークン数を数える"""
+        return self.count_many([text])[0]
+
+    def count_many(self, texts):
+        """
+        複数の文字列のトークン数をまとめて数える
+        重複とキャッシュ済みのものを除き、残りだけを同じllama-serverに続けて問い合わせる
+        """
+        model = get_model_identity(app_config.SELECTED_MODEL_PATH)
+        results = [0] * len(texts)
+        missing = {}  # キー -> (本文, 結果の位置のリスト)
+
+        for position, text in enumerate(texts):
+            if not text:
+                continue
+            key = self._key(model, text)
+            if key in missing:
+                missing[key][1].append(position)
+                continue
+            tokens = self._lookup(key)
+            if tokens is None:
+                missing[key] = (text, [position])
+            else:
+                results[position] = tokens
+
+        if missing:
+            counted = self._tokenize_remote([text for text, _ in missing.values()])
+            for (key, (text, positions)), tokens in zip(missing.items(), counted):
+                if tokens is None:
+                    tokens = estimate_tokens(text)
+                    with self._lock:
+                        self._stats['estimated'] += 1
+                else:
+                    self._store(key, tokens)
+                for position in positions:
+                    results[position] = tokens
+
+        return results
+
+    def _tokenize_remote(self, texts):
+        """llama-serverで数える（数えられなかったものはNone）"""
+        counted = [None] * len(texts)
+        # 起動待ちはせず、応答できるインスタンスがある場合だけ問い合わせる
+        if not any(inst.is_routable() for inst in LLAMA_SERVER_POOL.instances):
+            return counted
+
+        client = get_llama_client()
+        with LLAMA_SERVER_POOL.checkout() as instance:
+            if instance is None:
+                return counted
+            for i, text in enumerate(texts):
+                try:
+                    response = client.post(
+                        f"{instance.base_url}/tokenize", json={'content': text},
+                        read_timeout=5, retries=0
+                    )
+                    with self._lock:
+                        self._stats['remote_calls'] += 1
+                    if response.status_code == 200:
+                        counted[i] = len(response.json().get('tokens', []))
+                    else:
+                        logger.warning(f"llama-server /tokenize returned {response.status_code}")
+                        break
+                except Exception as e:
+                    with self._lock:
+                        self._stats['errors'] += 1
+                    logger.warning(f"Failed to tokenize with llama-server: {str(e)}")
+                    # 残りは推定値で代用する
+                    break
+        return counted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return dict(
+                self._stats,
+                entries=len(self._entries),
+                max_entries=self.max_entries,
+                hit_rate=round(self._stats['hits'] / lookups, 4) if lookups else 0.0
+            )
+
+
+# アプリケーション全体で共有するカウンター
+TOKEN_COUNTER = TokenCounter()
+
+
+def count_tokens(text):
+    """
+    文字列のトークン数を数える関数
+    llama-serverを利用できない場合は推定値を返す
+    """
+    return TOKEN_COUNTER.count(text)
+
+
+def count_tokens_batch(texts):
+    """複数の文字列のトークン数をまとめて数える関数"""
+    return TOKEN_COUNTER.count_many(list(texts))
+
+
+def get_tokenizer_stats():
+    """トークン数キャッシュの統計を取得する関数"""
+    return TOKEN_COUNTER.get_stats()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Second Me Windows - アップロード記録
+アップロードディレクトリごとのアップロード記録を、索引付きのSQLite（uploads.db）で管理するモジュール
+記録の追加・削除は1行ずつ書き込み、一覧全体を読み書きしない
+"""
+
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from config import logger, PROFILES_DIR, UPLOAD_FOLDER
+from services.memory_store import encode_cursor, decode_cursor
+from services.blob_store import BLOB_STORE
+
+# 記録の基本フィールド（それ以外のフィールドはextraにJSONで保存する）
+UPLOAD_FIELDS = ('filename', 'path', 'size', 'sha256', 'upload_time', 'profile_id')
+# 並び替えに使える項目
+UPLOAD_SORTS = ('upload_time', 'filename', 'size')
+# 以前の形式のアップロード記録
+LEGACY_MANIFEST = 'uploads.json'
+# アップロードディレクトリ内の、記録の対象ではないファイル
+_MANIFEST_FILES = ('uploads.db', 'uploads.db-wal', 'uploads.db-shm', LEGACY_MANIFEST,
+                   LEGACY_MANIFEST + '.tmp', LEGACY_MANIFEST + '.migrated')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL UNIQUE,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    sha256 TEXT,
+    upload_time TEXT NOT NULL,
+    profile_id TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_uploads_sha256 ON uploads (sha256);
+CREATE INDEX IF NOT EXISTS idx_uploads_path ON uploads (path);
+CREATE INDEX IF NOT EXISTS idx_uploads_time ON uploads (upload_time, id);
+CREATE INDEX IF NOT EXISTS idx_uploads_size ON uploads (size, id);
+"""
+
+
+def _row_to_record(row):
+    record = {field: row[field] for field in UPLOAD_FIELDS}
+    if record['sha256'] is None:
+        del record['sha256']
+    if row['extra']:
+        record.update(json.loads(row['extra']))
+    return record
+
+
+def _unique_filename(conn, filename):
+    """既に使われているファイル名の場合は「名前 (2).拡張子」のように番号を付ける"""
+    if not conn.execute("SELECT 1 FROM uploads WHERE filename = ?", (filename,)).fetchone():
+        return filename
+    stem, ext = os.path.splitext(filename)
+    number = 2
+    while conn.execute("SELECT 1 FROM uploads WHERE filename = ?", (f"{stem} ({number}){ext}",)).fetchone():
+        number += 1
+    return f"{stem} ({number}){ext}"
+
+
+class UploadManifest:
+    """
+    1つのアップロードディレクトリのアップロード記録
+    ファイル名は一意で、ファイル名・ハッシュ・保存先のパスの索引から1件ずつ探せる
+    """
+
+    def __init__(self, upload_dir):
+        self.upload_dir = upload_dir
+        self.db_path = os.path.join(upload_dir, 'uploads.db')
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        os.makedirs(upload_dir, exist_ok=True)
+        self._connect().executescript(_SCHEMA)
+        self._migrate_json()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._connect()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _insert(self, conn, record):
+        extra = {key: value for key, value in record.items() if key not in UPLOAD_FIELDS}
+        conn.execute(
+            "INSERT INTO uploads (filename, path, size, sha256, upload_time, profile_id, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                record['filename'], record['path'], int(record.get('size') or 0), record.get('sha256'),
+                record.get('upload_time') or datetime.now().isoformat(), record.get('profile_id'),
+                json.dumps(extra, ensure_ascii=False) if extra else None
+            )
+        )
+
+    def _migrate_json(self):
+        """以前の形式のuploads.jsonがある場合は記録を取り込み、uploads.json.migratedに名前を変える"""
+        json_path = os.path.join(self.upload_dir, LEGACY_MANIFEST)
+        if not os.path.exists(json_path):
+            return
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                uploads = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load {json_path}: {str(e)}")
+            return
+        with self.transaction() as conn:
+            for upload in uploads:
+                if isinstance(upload, dict) and upload.get('filename') and upload.get('path'):
+                    # 同じ名前で上書きされていた記録は新しいものを残す
+                    conn.execute("DELETE FROM uploads WHERE filename = ?", (upload['filename'],))
+                    self._insert(conn, upload)
+        os.replace(json_path, json_path + '.migrated')
+        logger.info(f"Migrated {len(uploads)} upload records from {json_path}")
+
+    def add(self, filename, path, size, sha256=None, profile_id=None, **extra):
+        """
+        アップロード記録を追加する
+        同じ名前・同じ内容の記録が既にある場合は追加せず、同じ名前で内容が違う場合は番号を付けた名前で追加する
+        戻り値は (記録, 既に同じ記録があったか)
+        """
+        with self.transaction() as conn:
+            if sha256:
+                row = conn.execute(
+                    "SELECT * FROM uploads WHERE filename = ? AND sha256 = ?", (filename, sha256)).fetchone()
+                if row is not None:
+                    return _row_to_record(row), True
+            record = dict(extra, filename=_unique_filename(conn, filename), path=path, size=size,
+                          sha256=sha256, upload_time=datetime.now().isoformat(), profile_id=profile_id)
+            self._insert(conn, record)
+        if record['sha256'] is None:
+            del record['sha256']
+        return record, False
+
+    def get(self, filename):
+        row = self._connect().execute("SELECT * FROM uploads WHERE filename = ?", (filename,)).fetchone()
+        return _row_to_record(row) if row else None
+
+    def find_by_path(self, path):
+        row = self._connect().execute(
+            "SELECT * FROM uploads WHERE path = ? ORDER BY id DESC LIMIT 1", (path,)).fetchone()
+        return _row_to_record(row) if row else None
+
+    def find_by_sha256(self, sha256):
+        rows = self._connect().execute("SELECT * FROM uploads WHERE sha256 = ? ORDER BY id", (sha256,))
+        return [_row_to_record(row) for row in rows]
+
+    def remove(self, filename):
+        """記録を削除し、削除した記録を返す（無い場合はNone）"""
+        with self.transaction() as conn:
+            row = conn.execute("SELECT * FROM uploads WHERE filename = ?", (filename,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM uploads WHERE id = ?", (row['id'],))
+        return _row_to_record(row)
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+
+    def list_page(self, limit=None, after=None, sort='upload_time', descending=False):
+        """
+        記録を並び替えて1ページ分返す（limitがNoneの場合はすべて）
+        戻り値は (記録のリスト, 次のページのカーソル（最後のページの場合はNone）)
+        """
+        if sort not in UPLOAD_SORTS:
+            raise ValueError(f"Unknown sort: {sort}")
+        direction, comparison = ('DESC', '<') if descending else ('ASC', '>')
+        sql, params = "SELECT * FROM uploads", []
+        if after:
+            value, last_id = decode_cursor(after, sort, descending)
+            sql += f" WHERE ({sort}, id) {comparison} (?, ?)"
+            params.extend([value, last_id])
+        sql += f" ORDER BY {sort} {direction}, id {direction}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit) + 1)
+        rows = self._connect().execute(sql, params).fetchall()
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(sort, descending, rows[-1][sort], rows[-1]['id'])
+        return [_row_to_record(row) for row in rows], next_cursor
+
+    def reference_counts(self):
+        """ブロブごとの参照数（{ハッシュ: 記録の数}）"""
+        rows = self._connect().execute(
+            "SELECT sha256, COUNT(*) AS count FROM uploads WHERE sha256 IS NOT NULL GROUP BY sha256")
+        return {row['sha256']: row['count'] for row in rows}
+
+    def rescan(self, profile_id=None):
+        """
+        アップロード記録をディレクトリの内容から作り直す
+        保存先のファイルが無くなった記録を削除し、記録の無いファイルをディレクトリから見つけて追加する
+        既存の記録のサイズは実際のファイルに合わせる。戻り値は修復の結果の辞書
+        ディレクトリから見つけたファイルはブロブストアのファイルではないため、sha256は記録しない
+        （sha256がある記録はブロブの参照として数える）
+        """
+        stats = {'removed': 0, 'added': 0, 'updated': 0, 'kept': 0}
+        with self.transaction() as conn:
+            tracked = set()
+            for row in conn.execute("SELECT id, path, size FROM uploads").fetchall():
+                if not os.path.isfile(row['path']):
+                    conn.execute("DELETE FROM uploads WHERE id = ?", (row['id'],))
+                    stats['removed'] += 1
+                    continue
+                tracked.add(os.path.normcase(os.path.abspath(row['path'])))
+                size = os.path.getsize(row['path'])
+                if size != row['size']:
+                    conn.execute("UPDATE uploads SET size = ? WHERE id = ?", (size, row['id']))
+                    stats['updated'] += 1
+                else:
+                    stats['kept'] += 1
+
+            for name in sorted(os.listdir(self.upload_dir)):
+                path = os.path.join(self.upload_dir, name)
+                if name in _MANIFEST_FILES or name.startswith('.') or not os.path.isfile(path) or \
+                        os.path.normcase(os.path.abspath(path)) in tracked:
+                    continue
+                modified = datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+                self._insert(conn, {
+                    'filename': _unique_filename(conn, name),
+                    'path': path,
+                    'size': os.path.getsize(path),
+                    'upload_time': modified,
+                    'profile_id': profile_id
+                })
+                stats['added'] += 1
+        logger.info(f"Rescanned uploads in {self.upload_dir}: {stats}")
+        return stats
+
+
+def get_upload_dir(profile_id):
+    """プロファイル専用のアップロードディレクトリ（プロファイルが無い場合は共通のディレクトリ）"""
+    if profile_id:
+        return os.path.join(PROFILES_DIR, profile_id, 'uploads')
+    return UPLOAD_FOLDER
+
+
+def iter_upload_dirs():
+    """アップロード記録があるディレクトリ（共通のディレクトリと各プロファイルのディレクトリ）を返す"""
+    upload_dirs = [UPLOAD_FOLDER]
+    if os.path.isdir(PROFILES_DIR):
+        upload_dirs.extend(get_upload_dir(name) for name in sorted(os.listdir(PROFILES_DIR))
+                           if os.path.isdir(os.path.join(PROFILES_DIR, name)))
+    for upload_dir in upload_dirs:
+        if os.path.isdir(upload_dir):
+            yield upload_dir
+
+
+def count_blob_references():
+    """すべてのアップロード記録から、ブロブごとの参照数を数える関数"""
+    references = {}
+    for upload_dir in iter_upload_dirs():
+        for sha256, count in get_upload_manifest(upload_dir).reference_counts().items():
+            references[sha256] = references.get(sha256, 0) + count
+    return references
+
+
+def _profile_of(upload_dir):
+    """プロファイルのディレクトリ（profiles/<id>/uploads）の場合はプロファイルID、それ以外はNone"""
+    parent = os.path.dirname(os.path.abspath(upload_dir))
+    return os.path.basename(parent) if os.path.dirname(parent) == os.path.abspath(PROFILES_DIR) else None
+
+
+def _recover_blob_records(results):
+    """
+    どのアップロード記録からも参照されていないブロブの記録を、最初に参照した記録の場所に作り直す
+    （場所が分からないブロブは共通のディレクトリに、ハッシュを名前にして記録する）
+    """
+    targets = {os.path.normcase(os.path.abspath(upload_dir)): upload_dir for upload_dir in results}
+    references = count_blob_references()
+    for blob in BLOB_STORE.list_blobs():
+        if blob['refcount'] <= 0 or references.get(blob['sha256'], 0) > 0:
+            continue
+        upload_dir = targets.get(os.path.normcase(os.path.abspath(blob['origin_dir'] or UPLOAD_FOLDER)))
+        if upload_dir is None:
+            continue
+        get_upload_manifest(upload_dir).add(
+            blob['origin_name'] or blob['sha256'], BLOB_STORE.path_of(blob['sha256']), blob['size'],
+            sha256=blob['sha256'], profile_id=_profile_of(upload_dir), recovered=True
+        )
+        BLOB_STORE.ensure_referenced(blob['sha256'])
+        results[upload_dir]['recovered'] += 1
+
+
+def rescan_upload_dirs(upload_dirs):
+    """
+    アップロードディレクトリごとに記録を作り直し、{ディレクトリ: 修復の結果} を返す関数
+    ブロブストアのファイルはアップロードディレクトリの外にあるため、参照の無いブロブからも記録を作り直す
+    """
+    results = {}
+    for upload_dir in upload_dirs:
+        if not os.path.isdir(upload_dir):
+            continue
+        # プロファイルのディレクトリで見つけたファイルは、そのプロファイルの記録にする
+        results[upload_dir] = get_upload_manifest(upload_dir).rescan(profile_id=_profile_of(upload_dir))
+        results[upload_dir]['recovered'] = 0
+    _recover_blob_records(results)
+    return results
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def get_upload_manifest(upload_dir):
+    """アップロードディレクトリのアップロード記録を取得する（ディレクトリごとに1つ）"""
+    key = os.path.normcase(os.path.abspath(upload_dir))
+    with _manifests_lock:
+        manifest = _manifests.get(key)
+        if manifest is None:
+            manifest = UploadManifest(upload_dir)
+            _manifests[key] = manifest
+        return manifest